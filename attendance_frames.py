@@ -0,0 +1,147 @@
+"""
+Engine "pandas": tính ngày công và số ngày nghỉ theo cột (DataFrame + numpy) thay vì duyệt từng bản ghi.
+
+- compute_attendance_days_frame: cùng kết quả với attendance_hours.compute_attendance_days
+  (FirstIn/LastOut, Seconds, CheckinCount, MonthSeconds cộng dồn theo tháng) bằng groupby/cumsum.
+- leave_days_for_month: cùng kết quả với calculate_leave_days_for_month trong main.py,
+  số ngày làm việc (thứ 2 - thứ 7) đếm bằng numpy.busday_count.
+
+pandas là phụ thuộc tuỳ chọn: module này chỉ được import khi HOURS_ENGINE="pandas".
+Kiểm tra kết quả hai engine: python benchmarks/check_pandas_parity.py
+"""
+import calendar
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+VN_TZ = timezone(timedelta(hours=7))
+WORK_WEEKMASK = "1111110"  # thứ 2 - thứ 7
+DATE_RE = r"\d{4}-\d{2}-\d{2}"
+
+CHECKIN_COLUMNS = ["EmployeeId", "CheckinDate", "CheckType", "Timestamp"]
+LEAVE_COLUMNS = ["DisplayDate", "StartDate", "EndDate", "LeaveDate", "Session", "Status1", "Status2"]
+
+def _py_datetimes(series):
+    """Cột datetime -> list datetime của Python (NaT -> None) để lưu được vào MongoDB."""
+    return [None if value is pd.NaT else value for value in series.dt.to_pydatetime()]
+
+def _text(frame, column):
+    """Cột chuỗi đã lower(); giá trị thiếu/None -> ''."""
+    return frame[column].fillna("").astype(str).str.lower()
+
+# ---- Giờ làm ----
+def compute_attendance_days_frame(records, day_key="CheckinDate"):
+    """Tính ngày công từ các bản ghi check-in/check-out đã tải về, gom nhóm bằng pandas."""
+    df = pd.DataFrame.from_records(list(records), columns=CHECKIN_COLUMNS)
+    if df.empty: return []
+    # Timestamp: BSON date (naive = UTC) hoặc chuỗi cũ; giá trị khác -> NaT
+    ts = pd.to_datetime(df["Timestamp"], utc=True, errors="coerce", format="ISO8601").dt.tz_convert(VN_TZ)
+    # Theo Timestamp: gom theo ngày giờ VN (datetime64), chỉ đổi sang chuỗi 'dd/mm/YYYY' sau khi gom nhóm
+    day_column = "Date" if day_key == "CheckinDate" else "DayDate"
+    df[day_column] = df["CheckinDate"] if day_key == "CheckinDate" else ts.dt.tz_localize(None).dt.normalize()
+    is_in = df["CheckType"] == "checkin"
+    df["_in"] = ts.where(is_in)
+    df["_out"] = ts.where(df["CheckType"] == "checkout")
+    df["_is_in"] = is_in.astype(int)
+    df = df[df["EmployeeId"].notna() & (df["EmployeeId"] != "") & df[day_column].notna() & (df[day_column] != "")]
+    if df.empty: return []
+
+    days = df.groupby(["EmployeeId", day_column], sort=False).agg(
+        FirstIn=("_in", "min"), LastOut=("_out", "max"), CheckinCount=("_is_in", "sum")).reset_index()
+    worked = days["FirstIn"].notna() & days["LastOut"].notna() & (days["LastOut"] > days["FirstIn"])
+    days["Seconds"] = (days["LastOut"] - days["FirstIn"]).dt.total_seconds().where(worked, 0.0)
+    if day_key == "CheckinDate":
+        days["DayDate"] = pd.to_datetime(days["Date"], format="%d/%m/%Y", errors="coerce")
+    else:
+        # strftime chậm theo từng dòng: chỉ định dạng các ngày khác nhau rồi ánh xạ lại
+        codes, unique_days = pd.factorize(days["DayDate"])
+        days["Date"] = np.asarray(unique_days.strftime("%d/%m/%Y"), dtype=object)[codes]
+
+    # Cộng dồn từ đầu tháng: sắp xếp theo ngày rồi cumsum trong từng (nhân viên, tháng)
+    dated = days[days["DayDate"].notna()].sort_values("DayDate", kind="stable")
+    month_seconds = dated.groupby(
+        [dated["EmployeeId"], dated["DayDate"].dt.year, dated["DayDate"].dt.month], sort=False)["Seconds"].cumsum()
+    days["MonthSeconds"] = month_seconds.reindex(days.index).fillna(0.0)
+
+    return [
+        {"EmployeeId": emp_id, "Date": date_str, "DayDate": day_date, "FirstIn": first_in, "LastOut": last_out,
+         "Seconds": seconds, "CheckinCount": count, "MonthSeconds": month_total}
+        for emp_id, date_str, day_date, first_in, last_out, seconds, count, month_total in zip(
+            days["EmployeeId"].tolist(), days["Date"].tolist(), _py_datetimes(days["DayDate"]),
+            _py_datetimes(days["FirstIn"]), _py_datetimes(days["LastOut"]), days["Seconds"].tolist(),
+            days["CheckinCount"].tolist(), days["MonthSeconds"].tolist())
+    ]
+
+# ---- Ngày nghỉ ----
+def _parse_days(values):
+    return pd.to_datetime(values, format="%Y-%m-%d", errors="coerce")
+
+def leave_intervals_frame(leaves):
+    """
+    DataFrame các đơn nghỉ với cột Start/End (NaT nếu không đọc được ngày), theo đúng thứ tự ưu tiên của
+    calculate_leave_days_for_month: DisplayDate ('từ ... đến ...' hoặc ngày đầu tiên), StartDate/EndDate, LeaveDate.
+    """
+    df = pd.DataFrame.from_records(list(leaves), columns=LEAVE_COLUMNS)
+    display = df["DisplayDate"].fillna("").astype(str).str.strip().str.lower()
+    df["_display"] = display
+    has_display = display != ""
+    is_range = has_display & display.str.contains("từ", regex=False) & display.str.contains("đến", regex=False)
+
+    range_parts = display.where(is_range, "").str.findall(DATE_RE)
+    range_ok = is_range & (range_parts.str.len() == 2)
+    range_start, range_end = _parse_days(range_parts.str[0].where(range_ok)), _parse_days(range_parts.str[1].where(range_ok))
+    single = _parse_days(display.where(has_display & ~is_range).str.split().str[0])
+
+    by_fields = ~has_display & df["StartDate"].fillna("").map(bool) & df["EndDate"].fillna("").map(bool)
+    field_start = _parse_days(df["StartDate"].where(by_fields & df["StartDate"].map(lambda v: isinstance(v, str))))
+    field_end = _parse_days(df["EndDate"].where(by_fields & df["EndDate"].map(lambda v: isinstance(v, str))))
+    by_leave_date = ~has_display & ~by_fields & df["LeaveDate"].map(lambda v: isinstance(v, str))
+    leave_date = _parse_days(df["LeaveDate"].where(by_leave_date))
+
+    df["Start"] = range_start.where(is_range, single.where(has_display, field_start.where(by_fields, leave_date)))
+    df["End"] = range_end.where(is_range, single.where(has_display, field_end.where(by_fields, leave_date)))
+    # Một trong hai đầu không đọc được thì cả đơn coi như không có ngày
+    invalid = df["Start"].isna() | df["End"].isna()
+    df.loc[invalid, ["Start", "End"]] = pd.NaT
+    return df
+
+def leave_days_for_month(leaves, export_year, export_month):
+    """
+    [(số ngày nghỉ trong tháng, có giao với tháng)] cho từng đơn, theo thứ tự của leaves;
+    cùng kết quả với calculate_leave_days_for_month nhưng tính cho cả danh sách một lần.
+    """
+    leaves = list(leaves)
+    if not leaves: return []
+    df = leave_intervals_frame(leaves)
+    _, last_day = calendar.monthrange(export_year, export_month)
+    month_start = np.datetime64(datetime(export_year, export_month, 1).date(), "D")
+    month_end = np.datetime64(datetime(export_year, export_month, last_day).date(), "D")
+
+    valid = df["Start"].notna().to_numpy()
+    start = df["Start"].to_numpy(dtype="datetime64[D]")
+    end = df["End"].to_numpy(dtype="datetime64[D]")
+    start[~valid] = month_start
+    end[~valid] = month_start
+
+    # Đơn một ngày: 1 ngày, hoặc 0.5 nếu nghỉ buổi sáng/chiều
+    single = start == end
+    in_month = (start >= month_start) & (start <= month_end) & np.is_busday(start, weekmask=WORK_WEEKMASK)
+    display = df["_display"]
+    half_day = (display.str.contains("sáng", regex=False) | display.str.contains("chiều", regex=False)
+                | _text(df, "Session").isin(["sáng", "chiều"])) & ~display.str.contains("cả ngày", regex=False)
+    single_days = np.where(in_month, np.where(half_day.to_numpy(), 0.5, 1.0), 0.0)
+
+    # Đơn nhiều ngày: số ngày thứ 2 - thứ 7 trong phần giao với tháng
+    begin = np.maximum(start, month_start)
+    stop = np.minimum(end, month_end) + np.timedelta64(1, "D")
+    range_days = np.where(begin < stop, np.busday_count(begin, np.maximum(begin, stop), weekmask=WORK_WEEKMASK), 0)
+
+    days = np.where(valid, np.where(single, single_days, range_days.astype(float)), 0.0)
+    overlap = days != 0
+
+    status1, status2 = _text(df, "Status1"), _text(df, "Status2")
+    rejected = status2.str.contains("từ chối", regex=False).to_numpy()
+    approved = (status2.str.contains("duyệt", regex=False) | status1.str.contains("duyệt", regex=False)).to_numpy()
+    days = np.where(overlap & ~rejected & approved, days, 0.0)
+    return list(zip(days.tolist(), overlap.tolist()))
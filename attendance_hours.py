@@ -0,0 +1,196 @@
+"""
+Tính giờ làm theo ngày (check-in đầu tiên -> check-out cuối cùng) và tổng cộng dồn theo tháng.
+
+Có ba cách tính cho cùng một kết quả:
+- "mongo": aggregation pipeline chạy trên MongoDB ($group + $setWindowFields).
+- "python": gom nhóm các bản ghi đã tải về, mỗi bản ghi chỉ duyệt một lần, mỗi nhân viên
+  chỉ sắp xếp một lần, tổng cộng dồn tính trong một lượt (tuyến tính theo số bản ghi).
+- "pandas": như "python" nhưng gom nhóm theo cột bằng pandas (attendance_frames, phụ thuộc tuỳ chọn).
+
+Mỗi ngày công là một dict {EmployeeId, Date ('dd/mm/YYYY'), DayDate, FirstIn, LastOut,
+Seconds, CheckinCount, MonthSeconds}.
+"""
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import OperationFailure
+
+VN_TZ = timezone(timedelta(hours=7))
+
+CHECKIN_PROJECTION = {"_id": 0, "EmployeeId": 1, "CheckinDate": 1, "CheckType": 1, "Timestamp": 1}
+
+_window_functions_supported = None
+
+# ---- Thời gian ----
+def parse_timestamp_string(value):
+    """Parse chuỗi thời gian cũ ('%Y-%m-%d %H:%M:%S' hoặc ISO 8601, mặc định UTC) thành datetime UTC."""
+    try: parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except (ValueError, AttributeError): return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def to_vn_time(value):
+    """
+    Timestamp/CreationTime -> datetime giờ VN (None nếu không hợp lệ).
+    Sau migration normalize-timestamps mọi giá trị là BSON date nên chỉ cần đổi múi giờ;
+    chuỗi chưa được chuyển đổi vẫn được parse để dự phòng.
+    """
+    if isinstance(value, datetime):
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).astimezone(VN_TZ)
+    if isinstance(value, str) and value:
+        parsed = parse_timestamp_string(value)
+        return parsed.astimezone(VN_TZ) if parsed else None
+    return None
+
+def format_seconds(seconds):
+    """Định dạng số giây thành chuỗi 'Xh Ym Zs' (rỗng nếu bằng 0)."""
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f"{int(h)}h {int(m)}m {int(s)}s" if seconds > 0 else ""
+
+# ---- Tính bằng aggregation pipeline ----
+def hours_pipeline(query, day_key, with_window):
+    """
+    Pipeline gom check-in/check-out theo (EmployeeId, ngày): FirstIn, LastOut, Seconds, CheckinCount
+    và MonthSeconds (cộng dồn trong tháng, chỉ khi with_window=True).
+    day_key="CheckinDate": ngày lấy theo chuỗi CheckinDate (API danh sách).
+    day_key="Timestamp": ngày lấy theo giờ VN của Timestamp (xuất Excel).
+    """
+    if day_key == "Timestamp":
+        day_expr = {"$dateToString": {"date": "$_ts", "format": "%d/%m/%Y", "timezone": "+07:00"}}
+    else:
+        day_expr = "$CheckinDate"
+    pipeline = [
+        {"$match": query},
+        {"$project": {
+            "_id": 0, "EmployeeId": 1, "CheckType": 1, "CheckinDate": 1,
+            "_ts": {"$switch": {"branches": [
+                {"case": {"$eq": [{"$type": "$Timestamp"}, "date"]}, "then": "$Timestamp"},
+                # Chuỗi cũ '%Y-%m-%d %H:%M:%S', không khớp thì parse như ISO 8601 (giống parse_timestamp_string)
+                {"case": {"$eq": [{"$type": "$Timestamp"}, "string"]}, "then": {"$dateFromString": {
+                    "dateString": "$Timestamp", "format": "%Y-%m-%d %H:%M:%S", "onNull": None,
+                    "onError": {"$dateFromString": {"dateString": "$Timestamp", "onError": None, "onNull": None}}}}}
+            ], "default": None}}
+        }},
+        {"$addFields": {"_day": day_expr}},
+        {"$match": {"EmployeeId": {"$nin": [None, ""]}, "_day": {"$nin": [None, ""]}}},
+        {"$group": {
+            "_id": {"EmployeeId": "$EmployeeId", "Date": "$_day"},
+            "FirstIn": {"$min": {"$cond": [{"$eq": ["$CheckType", "checkin"]}, "$_ts", None]}},
+            "LastOut": {"$max": {"$cond": [{"$eq": ["$CheckType", "checkout"]}, "$_ts", None]}},
+            "CheckinCount": {"$sum": {"$cond": [{"$eq": ["$CheckType", "checkin"]}, 1, 0]}}
+        }},
+        {"$project": {
+            "_id": 0, "EmployeeId": "$_id.EmployeeId", "Date": "$_id.Date", "FirstIn": 1, "LastOut": 1, "CheckinCount": 1,
+            "Seconds": {"$cond": [
+                {"$and": [{"$ne": ["$FirstIn", None]}, {"$ne": ["$LastOut", None]}, {"$gt": ["$LastOut", "$FirstIn"]}]},
+                {"$divide": [{"$subtract": ["$LastOut", "$FirstIn"]}, 1000]}, 0
+            ]},
+            "DayDate": {"$dateFromString": {"dateString": "$_id.Date", "format": "%d/%m/%Y", "onError": None, "onNull": None}}
+        }}
+    ]
+    if with_window:
+        pipeline.append({"$setWindowFields": {
+            "partitionBy": {"EmployeeId": "$EmployeeId", "Month": {"$dateToString": {"date": "$DayDate", "format": "%Y-%m"}}},
+            "sortBy": {"DayDate": 1},
+            "output": {"MonthSeconds": {"$sum": "$Seconds", "window": {"documents": ["unbounded", "current"]}}}
+        }})
+    return pipeline
+
+def aggregate_attendance_days(collection, query, day_key="CheckinDate"):
+    """
+    Tính ngày công hoàn toàn trên MongoDB. Nếu server không hỗ trợ $setWindowFields (MongoDB < 5.0)
+    thì chỉ gom nhóm trên server và cộng dồn theo tháng bằng Python.
+    """
+    global _window_functions_supported
+    if _window_functions_supported is not False:
+        try:
+            days = list(collection.aggregate(hours_pipeline(query, day_key, with_window=True)))
+            _window_functions_supported = True
+        except OperationFailure as e:
+            if e.code != 40324: raise  # 40324: Unrecognized pipeline stage name
+            print(f"⚠️ Server không hỗ trợ $setWindowFields, chuyển sang cộng dồn bằng Python: {e}")
+            _window_functions_supported = False
+    if _window_functions_supported is False:
+        days = accumulate_monthly_seconds(list(collection.aggregate(hours_pipeline(query, day_key, with_window=False))))
+    for day in days:
+        if day.get("DayDate") is None: day["MonthSeconds"] = 0
+    return days
+
+# ---- Tính bằng Python ----
+def accumulate_monthly_seconds(days):
+    """
+    Gán MonthSeconds (cộng dồn Seconds từ đầu tháng) cho từng ngày công.
+    Gom theo nhân viên một lần, sắp xếp theo ngày một lần, rồi cộng dồn trong một lượt.
+    """
+    days_by_emp = {}
+    for day in days:
+        if day.get("DayDate") is None:
+            day["MonthSeconds"] = 0
+            continue
+        days_by_emp.setdefault(day["EmployeeId"], []).append(day)
+    for emp_days in days_by_emp.values():
+        emp_days.sort(key=lambda d: d["DayDate"])
+        month, running_total = None, 0
+        for day in emp_days:
+            if (day["DayDate"].year, day["DayDate"].month) != month:
+                month, running_total = (day["DayDate"].year, day["DayDate"].month), 0
+            running_total += day["Seconds"]
+            day["MonthSeconds"] = running_total
+    return days
+
+def compute_attendance_days(records, day_key="CheckinDate"):
+    """Tính ngày công từ các bản ghi check-in/check-out đã tải về; cùng kết quả với hours_pipeline."""
+    days = {}
+    day_dates = {}  # 'dd/mm/YYYY' -> datetime, mỗi chuỗi ngày chỉ parse một lần
+    for rec in records:
+        emp_id = rec.get("EmployeeId")
+        if not emp_id: continue
+        ts = to_vn_time(rec.get("Timestamp"))
+        date_str = rec.get("CheckinDate") if day_key == "CheckinDate" else (ts.strftime("%d/%m/%Y") if ts else None)
+        if not date_str: continue
+        day = days.get((emp_id, date_str))
+        if day is None:
+            day = days[(emp_id, date_str)] = {
+                "EmployeeId": emp_id, "Date": date_str, "FirstIn": None, "LastOut": None, "CheckinCount": 0
+            }
+        check_type = rec.get("CheckType")
+        if check_type == "checkin":
+            day["CheckinCount"] += 1
+            if ts is not None and (day["FirstIn"] is None or ts < day["FirstIn"]): day["FirstIn"] = ts
+        elif check_type == "checkout":
+            if ts is not None and (day["LastOut"] is None or ts > day["LastOut"]): day["LastOut"] = ts
+
+    for day in days.values():
+        first_in, last_out = day["FirstIn"], day["LastOut"]
+        day["Seconds"] = (last_out - first_in).total_seconds() if first_in and last_out and last_out > first_in else 0
+        date_str = day["Date"]
+        if date_str not in day_dates:
+            try: day_dates[date_str] = datetime.strptime(date_str, "%d/%m/%Y")
+            except (ValueError, TypeError): day_dates[date_str] = None
+        day["DayDate"] = day_dates[date_str]
+    return accumulate_monthly_seconds(list(days.values()))
+
+# ---- Điểm vào dùng chung ----
+def load_attendance_days(collection, query, day_key="CheckinDate", engine="mongo"):
+    """Tính ngày công cho các check-in khớp query bằng engine "mongo" (mặc định), "python" hoặc "pandas"."""
+    if engine == "python":
+        return compute_attendance_days(collection.find(query, CHECKIN_PROJECTION), day_key)
+    if engine == "pandas":
+        from attendance_frames import compute_attendance_days_frame  # pandas chỉ cần khi chọn engine này
+        return compute_attendance_days_frame(collection.find(query, CHECKIN_PROJECTION), day_key)
+    return aggregate_attendance_days(collection, query, day_key)
+
+def hours_maps(days):
+    """Danh sách ngày công -> (daily_hours_map, monthly_hours_map) với key (EmployeeId, 'dd/mm/YYYY') -> số giây."""
+    daily_hours_map, monthly_hours_map = {}, {}
+    for day in days:
+        key = (day["EmployeeId"], day["Date"])
+        daily_hours_map[key] = day["Seconds"]
+        if day.get("MonthSeconds"): monthly_hours_map[key] = day["MonthSeconds"]
+    return daily_hours_map, monthly_hours_map
+
+def get_attendance_hours(collection, query, day_key="CheckinDate", engine="mongo"):
+    """
+    Trả về (daily_hours_map, monthly_hours_map) cho các check-in khớp query.
+    Dùng chung cho API danh sách, các route xuất Excel và job ghi giờ làm.
+    """
+    return hours_maps(load_attendance_days(collection, query, day_key, engine))
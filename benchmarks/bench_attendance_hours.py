@@ -0,0 +1,90 @@
+"""
+Benchmark tính giờ làm bằng Python (attendance_hours.compute_attendance_days).
+
+Sinh dữ liệu giả: N nhân viên x số ngày x (check-in + check-out), đo thời gian ở nhiều quy mô
+để thấy thời gian tăng tuyến tính theo số bản ghi (µs/bản ghi gần như không đổi).
+Thêm --legacy để so sánh với cách gom nhóm cũ (duyệt toàn bộ map cho từng nhân viên).
+
+    python benchmarks/bench_attendance_hours.py
+    python benchmarks/bench_attendance_hours.py --employees 500 1000 2000 5000 --days 31 --legacy
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attendance_hours import compute_attendance_days  # noqa: E402
+
+
+def make_records(employees, days, checkins_per_day=2, year=2025, month=1):
+    records = []
+    for e in range(employees):
+        emp_id = f"NV{e:05d}"
+        for d in range(days):
+            day = datetime(year, month, 1) + timedelta(days=d)
+            date_str = day.strftime("%d/%m/%Y")
+            for c in range(checkins_per_day):
+                records.append({"EmployeeId": emp_id, "CheckinDate": date_str, "CheckType": "checkin",
+                                "Timestamp": day + timedelta(hours=1 + c, minutes=e % 60)})
+            records.append({"EmployeeId": emp_id, "CheckinDate": date_str, "CheckType": "checkout",
+                            "Timestamp": day + timedelta(hours=10, minutes=e % 60)})
+    return records
+
+
+def legacy_hours(records):
+    """Cách tính cũ của get_attendances: với mỗi nhân viên lại duyệt toàn bộ daily_hours_map."""
+    daily_hours_map, monthly_hours_map, emp_data = {}, {}, {}
+    for rec in records:
+        emp_data.setdefault(rec["EmployeeId"], []).append(rec)
+    for emp_id, emp_records in emp_data.items():
+        daily_groups = {}
+        for rec in emp_records:
+            daily_groups.setdefault(rec["CheckinDate"], []).append(rec)
+        for date_str, day_records in daily_groups.items():
+            checkins = sorted(r["Timestamp"] for r in day_records if r["CheckType"] == "checkin")
+            checkouts = sorted(r["Timestamp"] for r in day_records if r["CheckType"] == "checkout")
+            seconds = 0
+            if checkins and checkouts and checkouts[-1] > checkins[0]:
+                seconds = (checkouts[-1] - checkins[0]).total_seconds()
+            daily_hours_map[(emp_id, date_str)] = seconds
+        monthly_groups = {}
+        for (map_emp_id, map_date_str), seconds in daily_hours_map.items():
+            if map_emp_id == emp_id:
+                month_key = datetime.strptime(map_date_str, "%d/%m/%Y").strftime("%Y-%m")
+                monthly_groups.setdefault(month_key, []).append((map_date_str, seconds))
+        for days in monthly_groups.values():
+            running_total = 0
+            for date_str, seconds in sorted(days, key=lambda x: datetime.strptime(x[0], "%d/%m/%Y")):
+                running_total += seconds
+                monthly_hours_map[(emp_id, date_str)] = running_total
+    return daily_hours_map, monthly_hours_map
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--employees", type=int, nargs="+", default=[500, 1000, 2000, 5000])
+    parser.add_argument("--days", type=int, default=31)
+    parser.add_argument("--legacy", action="store_true", help="Đo thêm cách tính cũ (chậm, O(nhân viên x ngày) cho mỗi nhân viên).")
+    args = parser.parse_args()
+
+    print(f"{'nhân viên':>10} {'bản ghi':>10} {'giây':>8} {'µs/bản ghi':>11}" + (f" {'cũ (giây)':>10}" if args.legacy else ""))
+    for employees in args.employees:
+        records = make_records(employees, args.days)
+        elapsed = timed(compute_attendance_days, records)
+        line = f"{employees:>10} {len(records):>10} {elapsed:>8.2f} {elapsed / len(records) * 1e6:>11.2f}"
+        if args.legacy:
+            line += f" {timed(legacy_hours, records):>10.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Benchmark các API danh sách và xuất Excel trên dữ liệu giả, chạy offline.
+
+Sinh alt_checkins theo quy mô cấu hình được (nhân viên x ngày x số lần check-in mỗi ngày + check-out,
+một phần Timestamp/CreationTime để dạng chuỗi như dữ liệu cũ, đơn nghỉ có DisplayDate một ngày / buổi /
+khoảng 'Từ ... đến ...'), rồi gọi qua Flask test client:
+/api/attendances, /api/leaves, /api/export-excel, /api/export-leaves-excel, /api/export-combined-excel
+và /api/export-bulk-excel (cả quý chứa --month).
+
+Mỗi endpoint báo p50/p95 thời gian (ms), số lượt gọi MongoDB, bộ nhớ đỉnh (tracemalloc, MB) và kích thước
+phản hồi. --save lưu kết quả làm baseline, --compare so với baseline đã lưu (thoát mã 1 nếu p50 chậm hơn
+ngưỡng --threshold).
+
+Mặc định chạy trên mongomock (pip install mongomock). Với mongomock: giờ làm tính bằng engine "python"
+($setWindowFields không có), cột HasPhoto bị bỏ (không hỗ trợ biểu thức trong projection), xuất file gộp
+chạy tuần tự (mongomock không an toàn đa luồng), không sinh Timestamp dạng chuỗi trừ khi đặt --string-ratio
+($max trên kiểu lẫn lộn lỗi trong mongomock), lượt gọi là số lần gọi hàm của Collection.
+Với --mongo-uri: dùng mongod thật, database --db-name bị xoá và tạo lại; lượt gọi đếm bằng command monitoring
+(kể cả getMore).
+
+    python benchmarks/bench_endpoints.py
+    python benchmarks/bench_endpoints.py --employees 200 --days 31 --repeat 10 --save benchmarks/baseline.json
+    python benchmarks/bench_endpoints.py --compare benchmarks/baseline.json
+    python benchmarks/bench_endpoints.py --mongo-uri mongodb://localhost:27017 --employees 1000 --backfill
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADMIN_EMAIL = "bench-admin@example.com"
+USER_EMAIL = "bench-user@example.com"
+COLLECTION_METHODS = ("find", "find_one", "aggregate", "count_documents", "distinct", "insert_one", "insert_many",
+                      "update_one", "update_many", "bulk_write", "delete_one", "delete_many")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--employees", type=int, default=50)
+    parser.add_argument("--days", type=int, default=31, help="Số ngày dữ liệu tính từ đầu tháng --year/--month.")
+    parser.add_argument("--checkins", type=int, default=2, help="Số lần check-in mỗi ngày (thêm 1 check-out).")
+    parser.add_argument("--leaves", type=int, default=3, help="Số đơn nghỉ mỗi nhân viên.")
+    parser.add_argument("--string-ratio", type=float, help="Tỉ lệ Timestamp/CreationTime dạng chuỗi (mặc định 0.1; 0 với mongomock).")
+    parser.add_argument("--year", type=int, default=2025)
+    parser.add_argument("--month", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5, help="Số lần đo mỗi endpoint (sau 1 lần chạy làm nóng).")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="+", help="Chỉ chạy các endpoint có tên chứa một trong các chuỗi này.")
+    parser.add_argument("--mongo-uri", help="Chạy trên mongod thật thay vì mongomock.")
+    parser.add_argument("--db-name", default="attendance_bench", help="Database dùng cho benchmark (bị xoá khi bắt đầu).")
+    parser.add_argument("--backfill", action="store_true", help="Chạy các migration (VnDate, LeaveStart, SearchKeys, index) trước khi đo; chỉ với --mongo-uri.")
+    parser.add_argument("--cache", action="store_true", help="Giữ cache phản hồi danh sách và cache kết quả theo kỳ (mặc định tắt để đo phần tính toán).")
+    parser.add_argument("--save", help="Lưu kết quả vào file JSON (baseline).")
+    parser.add_argument("--compare", help="So sánh với baseline JSON đã lưu.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Ngưỡng chậm hơn baseline (0.2 = 20%%) để báo lỗi.")
+    return parser.parse_args()
+
+
+# ---- Dữ liệu giả ----
+def make_checkins(rng, args):
+    docs = []
+    start = datetime(args.year, args.month, 1)
+    for e in range(args.employees):
+        emp_id, name = f"NV{e:05d}", f"Nguyễn Văn {e}"
+        for d in range(args.days):
+            day = start + timedelta(days=d)
+            if day.weekday() == 6 and rng.random() < 0.8: continue
+            times = sorted(rng.randint(7 * 60, 12 * 60) for _ in range(args.checkins))
+            events = [("checkin", minute) for minute in times] + [("checkout", rng.randint(16 * 60, 19 * 60))]
+            for check_type, minute in events:
+                ts = day + timedelta(minutes=minute) - timedelta(hours=7)  # giờ VN -> UTC
+                vn_day = day.strftime("%d/%m/%Y")
+                docs.append({
+                    "EmployeeId": emp_id, "EmployeeName": name, "CheckType": check_type, "CheckinDate": vn_day,
+                    "Timestamp": ts.strftime("%Y-%m-%d %H:%M:%S") if rng.random() < args.string_ratio else ts,
+                    "ProjectId": f"P{e % 7}", "Tasks": ["Lắp đặt", "Kiểm tra"], "Address": f"Công trình {e % 13}",
+                    "CheckinNote": "", "FaceImage": "data:image/jpeg;base64," + "A" * 2000,
+                })
+    return docs
+
+
+def make_leaves(rng, args):
+    docs = []
+    start = datetime(args.year, args.month, 1)
+    statuses = [("Đã duyệt", "Đã duyệt"), ("Đã duyệt", ""), ("", ""), ("Đã duyệt", "Từ chối")]
+    for e in range(args.employees):
+        emp_id, name = f"NV{e:05d}", f"Nguyễn Văn {e}"
+        for _ in range(args.leaves):
+            first = start + timedelta(days=rng.randint(-5, args.days))
+            kind = rng.random()
+            if kind < 0.4:
+                display = f"Từ {first:%Y-%m-%d} đến {first + timedelta(days=rng.randint(1, 10)):%Y-%m-%d}"
+            elif kind < 0.7:
+                display = f"{first:%Y-%m-%d} ({rng.choice(['Buổi sáng', 'Buổi chiều'])})"
+            else:
+                display = f"{first:%Y-%m-%d} (Cả ngày)"
+            created = first - timedelta(days=rng.randint(1, 7), hours=rng.randint(0, 23))
+            status1, status2 = rng.choice(statuses)
+            docs.append({
+                "EmployeeId": emp_id, "EmployeeName": name, "Tasks": ["Nghỉ phép: việc riêng"], "Reason": "Việc riêng",
+                "DisplayDate": display,
+                "CreationTime": created.strftime("%Y-%m-%d %H:%M:%S") if rng.random() < args.string_ratio else created,
+                "Status1": status1, "Status2": status2, "ApprovalDate1": created + timedelta(days=1),
+                "ApprovalDate2": created + timedelta(days=2) if status2 else None, "LeaveNote": "",
+            })
+    return docs
+
+
+# ---- Đếm lượt gọi MongoDB ----
+class RoundTrips:
+    count = 0
+
+    def started(self, event):  # pymongo.monitoring.CommandListener
+        RoundTrips.count += 1
+
+    def succeeded(self, event): pass
+
+    def failed(self, event): pass
+
+
+def count_mongomock_calls(mongomock):
+    """mongomock không có command monitoring: đếm lời gọi các hàm truy vấn/ghi của Collection."""
+    def counted(method):
+        def wrapper(self, *args, **kwargs):
+            RoundTrips.count += 1
+            return method(self, *args, **kwargs)
+        return wrapper
+    for name in COLLECTION_METHODS:
+        setattr(mongomock.collection.Collection, name, counted(getattr(mongomock.collection.Collection, name)))
+
+
+def connect(args):
+    """Tạo client (mongomock hoặc mongod) trước khi import main để cấu hình qua biến môi trường."""
+    os.environ["DB_NAME"] = args.db_name
+    os.environ.setdefault("HOURS_JOB_INTERVAL", "0")
+    if not args.cache: os.environ.update(LISTING_CACHE_SIZE="0", RESULT_CACHE_MAX_MB="0")
+    if args.mongo_uri:
+        if args.string_ratio is None: args.string_ratio = 0.1
+        from pymongo import MongoClient
+        return MongoClient(args.mongo_uri, event_listeners=[RoundTrips()]), "mongod"
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("Cần mongomock (pip install mongomock) hoặc --mongo-uri")
+    os.environ["HOURS_ENGINE"] = "python"
+    if args.string_ratio is None: args.string_ratio = 0.0
+    elif args.string_ratio: print("⚠️ mongomock không so sánh được chuỗi với date trong $max: /api/leaves có thể lỗi")
+    os.environ.setdefault("ATTENDANCE_SUMMARY_ENABLED", "0")
+    count_mongomock_calls(mongomock)
+    return mongomock.MongoClient(), "mongomock"
+
+
+def adapt_for_mongomock(main):
+    import concurrent.futures
+    main.HAS_PHOTO_PROJECTION = {}
+    main.ThreadPoolExecutor = lambda max_workers=None, **kw: concurrent.futures.ThreadPoolExecutor(max_workers=1, **kw)
+
+
+# ---- Đo ----
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+
+def endpoints(args):
+    last_day = (datetime(args.year, args.month, 1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    month = f"startDate={args.year}-{args.month:02d}-01&endDate={last_day:%Y-%m-%d}"
+    export = f"month={args.month}&year={args.year}"
+    return [
+        ("attendances page", f"/api/attendances?email={ADMIN_EMAIL}&filter=custom&{month}&page=1&pageSize=50"),
+        ("attendances month", f"/api/attendances?email={ADMIN_EMAIL}&filter=custom&{month}"),
+        ("attendances month (user)", f"/api/attendances?email={USER_EMAIL}&filter=custom&{month}"),
+        ("attendances search", f"/api/attendances?email={ADMIN_EMAIL}&filter=custom&{month}&search=NV0000&page=1&pageSize=50"),
+        ("leaves all", f"/api/leaves?email={ADMIN_EMAIL}&filter=tất cả"),
+        ("leaves LeaveDate", f"/api/leaves?email={ADMIN_EMAIL}&filter=custom&{month}&dateType=LeaveDate&page=1&pageSize=50"),
+        ("export attendance", f"/api/export-excel?email={ADMIN_EMAIL}&{export}"),
+        ("export leaves", f"/api/export-leaves-excel?email={ADMIN_EMAIL}&{export}"),
+        ("export combined", f"/api/export-combined-excel?email={ADMIN_EMAIL}&{export}"),
+        ("export bulk quarter", f"/api/export-bulk-excel?email={ADMIN_EMAIL}&year={args.year}&quarter={(args.month - 1) // 3 + 1}"),
+    ]
+
+
+def measure(client, url, repeat):
+    def call():
+        response = client.get(url)
+        body = response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: HTTP {response.status_code} {body[:200]!r}")
+        return len(body)
+
+    call()  # làm nóng (cache template, kết nối)
+    timings, trips = [], []
+    for _ in range(repeat):
+        before = RoundTrips.count
+        start = time.perf_counter()
+        size = call()
+        timings.append((time.perf_counter() - start) * 1000)
+        trips.append(RoundTrips.count - before)
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"p50_ms": round(percentile(timings, 0.5), 2), "p95_ms": round(percentile(timings, 0.95), 2),
+            "roundtrips": max(trips), "peak_mb": round(peak / 1e6, 2), "bytes": size}
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["meta"]["scale"] != results["meta"]["scale"] or baseline["meta"]["backend"] != results["meta"]["backend"]:
+        print("⚠️ Baseline được đo với quy mô/backend khác, so sánh chỉ mang tính tham khảo")
+    regressions = []
+    print(f"\n{'endpoint':<28} {'p50 cũ':>9} {'p50 mới':>9} {'thay đổi':>9} {'lượt DB':>9} {'MB':>11}")
+    for name, new in results["results"].items():
+        old = baseline["results"].get(name)
+        if not old: continue
+        change = (new["p50_ms"] - old["p50_ms"]) / old["p50_ms"] if old["p50_ms"] else 0
+        if change > threshold: regressions.append(name)
+        print(f"{name:<28} {old['p50_ms']:>9.1f} {new['p50_ms']:>9.1f} {change:>+8.0%} "
+              f"{old['roundtrips']:>4}->{new['roundtrips']:<4} {old['peak_mb']:>5.1f}->{new['peak_mb']:<5.1f}")
+    if regressions:
+        print(f"❌ Chậm hơn baseline quá {threshold:.0%}: {', '.join(regressions)}")
+    return not regressions
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    if args.backfill and not args.mongo_uri:
+        sys.exit("--backfill cần --mongo-uri (mongomock không chạy được bulk_write của các migration)")
+    client, backend = connect(args)
+    import main as app_module  # noqa: E402  (đọc cấu hình từ biến môi trường đã đặt ở trên)
+    app_module._mongo_client, app_module._mongo_client_pid = client, os.getpid()
+    if backend == "mongomock": adapt_for_mongomock(app_module)
+
+    client.drop_database(args.db_name)
+    db = client[args.db_name]
+    db.admins.insert_one({"email": ADMIN_EMAIL, "username": "bench-admin", "password": ""})
+    db.users.insert_one({"email": USER_EMAIL, "username": "Nguyễn Văn 1", "password": ""})
+    checkins, leaves = make_checkins(rng, args), make_leaves(rng, args)
+    db.alt_checkins.insert_many(checkins + leaves)
+    print(f"{backend}: {len(checkins)} check-in, {len(leaves)} đơn nghỉ ({args.employees} nhân viên x {args.days} ngày)")
+    if args.backfill:
+        with app_module.app.app_context():
+            app_module.ensure_indexes(db)
+            app_module.backfill_vn_date(db)
+            app_module.backfill_leave_dates(db)
+            app_module.backfill_search_keys(db)
+            if app_module.ATTENDANCE_SUMMARY_ENABLED: app_module.rebuild_attendance_summary(db)
+
+    test_client = app_module.app.test_client()
+    results = {"meta": {
+        "backend": backend, "scale": {k: getattr(args, k) for k in ("employees", "days", "checkins", "leaves", "string_ratio")},
+        "hours_engine": app_module.HOURS_ENGINE, "summary": app_module.ATTENDANCE_SUMMARY_ENABLED,
+        "python": platform.python_version(), "date": datetime.now().isoformat(timespec="seconds"),
+    }, "results": {}}
+    print(f"{'endpoint':<28} {'p50 ms':>9} {'p95 ms':>9} {'lượt DB':>8} {'đỉnh MB':>8} {'KB':>9}")
+    for name, url in endpoints(args):
+        if args.only and not any(part in name for part in args.only): continue
+        result = results["results"][name] = measure(test_client, url, args.repeat)
+        print(f"{name:<28} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['roundtrips']:>8} "
+              f"{result['peak_mb']:>8.1f} {result['bytes'] / 1024:>9.1f}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Đã lưu baseline: {args.save}")
+    if args.compare and not compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
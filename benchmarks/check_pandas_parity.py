@@ -0,0 +1,124 @@
+"""
+So sánh engine "pandas" (attendance_frames) với cách tính từng bản ghi hiện tại.
+
+Sinh dữ liệu giả có cả trường hợp biên (Timestamp dạng chuỗi, thiếu check-out, check-out trước
+check-in, nhiều tháng, CheckinDate sai định dạng; đơn nghỉ nửa ngày, nhiều ngày vắt qua tháng,
+chủ nhật, trạng thái duyệt/từ chối, ngày không đọc được) rồi kiểm tra hai cách cho cùng kết quả:
+- compute_attendance_days  <-> compute_attendance_days_frame (cả day_key CheckinDate và Timestamp)
+- calculate_leave_days_for_month (main.py) <-> leave_days_for_month
+In thời gian của từng cách; thoát với mã 1 nếu có khác biệt.
+
+    python benchmarks/check_pandas_parity.py
+    python benchmarks/check_pandas_parity.py --employees 2000 --days 62 --leaves 50000 --seed 7
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attendance_frames import compute_attendance_days_frame, leave_days_for_month  # noqa: E402
+from attendance_hours import compute_attendance_days  # noqa: E402
+from main import calculate_leave_days_for_month  # noqa: E402
+
+START = datetime(2025, 1, 1)
+
+
+def make_checkins(rng, employees, days):
+    records = []
+    for e in range(employees):
+        emp_id = f"NV{e:05d}"
+        for d in range(days):
+            day = START + timedelta(days=d)
+            date_str = day.strftime("%d/%m/%Y") if rng.random() > 0.01 else "ngày lỗi"
+            for _ in range(rng.randint(0, 3)):
+                ts = day + timedelta(hours=rng.randint(0, 12), minutes=rng.randint(0, 59))
+                records.append({"EmployeeId": emp_id, "CheckinDate": date_str, "CheckType": "checkin",
+                                "Timestamp": ts.strftime("%Y-%m-%d %H:%M:%S") if rng.random() < 0.1 else ts})
+            if rng.random() < 0.8:
+                records.append({"EmployeeId": emp_id, "CheckinDate": date_str, "CheckType": "checkout",
+                                "Timestamp": day + timedelta(hours=rng.randint(2, 16), minutes=rng.randint(0, 59))})
+        if rng.random() < 0.05:
+            records.append({"EmployeeId": "", "CheckinDate": "01/01/2025", "CheckType": "checkin", "Timestamp": START})
+            records.append({"EmployeeId": emp_id, "CheckinDate": "02/01/2025", "CheckType": "checkin", "Timestamp": None})
+    return records
+
+
+def make_leaves(rng, count, days):
+    statuses = [("", ""), ("Đã duyệt", ""), ("", "Đã duyệt"), ("Đã duyệt", "Từ chối"), ("Chờ", "Chờ")]
+    leaves = []
+    for _ in range(count):
+        start = START + timedelta(days=rng.randint(-20, days))
+        end = start + timedelta(days=rng.choice([0, 0, 1, 3, 10, 40]))
+        status1, status2 = rng.choice(statuses)
+        leave = {"Status1": status1, "Status2": status2}
+        kind = rng.random()
+        if kind < 0.4:
+            leave["DisplayDate"] = f"Từ {start:%Y-%m-%d} đến {end:%Y-%m-%d}"
+        elif kind < 0.7:
+            leave["DisplayDate"] = f"{start:%Y-%m-%d} " + rng.choice(["(Cả ngày)", "(Buổi sáng)", "(Buổi chiều)", ""])
+        elif kind < 0.8:
+            leave.update(StartDate=f"{start:%Y-%m-%d}", EndDate=f"{end:%Y-%m-%d}")
+        elif kind < 0.9:
+            leave.update(LeaveDate=f"{start:%Y-%m-%d}", Session=rng.choice(["Sáng", "Chiều", "Cả ngày"]))
+        else:
+            leave["DisplayDate"] = rng.choice(["Từ 2025-13-01 đến 2025-01-02", "không rõ", "từ 2025-01-02"])
+        leaves.append(leave)
+    return leaves
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def check_days(expected, actual):
+    """Số ngày công khác nhau giữa hai engine (so theo (EmployeeId, Date))."""
+    by_key = {(d["EmployeeId"], d["Date"]): d for d in actual}
+    mismatches = abs(len(expected) - len(actual))
+    for day in expected:
+        other = by_key.get((day["EmployeeId"], day["Date"]))
+        if other is None or any(
+            abs(day[field] - other[field]) > 1e-6 for field in ("Seconds", "MonthSeconds")
+        ) or any(day[field] != other[field] for field in ("FirstIn", "LastOut", "DayDate", "CheckinCount")):
+            mismatches += 1
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--employees", type=int, default=500)
+    parser.add_argument("--days", type=int, default=62)
+    parser.add_argument("--leaves", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    failed = False
+    records = make_checkins(rng, args.employees, args.days)
+    for day_key in ("CheckinDate", "Timestamp"):
+        expected, loop_time = timed(compute_attendance_days, records, day_key)
+        actual, frame_time = timed(compute_attendance_days_frame, records, day_key)
+        mismatches = check_days(expected, actual)
+        failed |= bool(mismatches)
+        print(f"giờ làm ({day_key}): {len(records)} bản ghi, {len(expected)} ngày công, "
+              f"python {loop_time:.2f}s, pandas {frame_time:.2f}s, khác nhau: {mismatches}")
+
+    leaves = make_leaves(rng, args.leaves, args.days)
+    for year, month in ((2025, 1), (2025, 2)):
+        expected, loop_time = timed(lambda: [calculate_leave_days_for_month(rec, year, month) for rec in leaves])
+        actual, frame_time = timed(leave_days_for_month, leaves, year, month)
+        mismatches = sum(1 for a, b in zip(expected, actual) if a[0] != b[0] or a[1] != b[1]) + abs(len(expected) - len(actual))
+        failed |= bool(mismatches)
+        print(f"ngày nghỉ {month:02d}/{year}: {len(leaves)} đơn, python {loop_time:.2f}s, "
+              f"pandas {frame_time:.2f}s, khác nhau: {mismatches}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Kiểm tra dựng dòng chấm công song song (export_rows.attendance_rows, processes > 1) cho kết quả giống hệt
+cách tuần tự: cùng thứ tự dòng, cùng nội dung từng ô, và cùng giá trị ô trong file Excel đã ghi.
+
+Sinh dữ liệu giả có cả trường hợp biên (Timestamp dạng chuỗi, thiếu EmployeeId, Timestamp không hợp lệ,
+bản ghi ngoài khoảng xuất, nhân viên trùng tên, hơn 9 lần check-in một ngày, nhiều check-out), giờ làm
+tính bằng engine "python". In thời gian từng cách; thoát với mã 1 nếu có khác biệt.
+
+    python benchmarks/check_parallel_export.py
+    python benchmarks/check_parallel_export.py --employees 2000 --days 31 --processes 2 4 8
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from openpyxl import load_workbook  # noqa: E402
+
+from attendance_hours import compute_attendance_days, hours_maps  # noqa: E402
+from excel_export import export_workbook  # noqa: E402
+from export_rows import ATTENDANCE_COLUMNS, attendance_rows  # noqa: E402
+
+TEMPLATE = os.path.join(ROOT, "templates", "Copy of Form chấm công.xlsx")
+START = date(2025, 1, 1)
+
+
+def make_records(rng, employees, days):
+    records = []
+    for d in range(days):
+        day = datetime(START.year, START.month, START.day) + timedelta(days=d)
+        for e in range(employees):
+            if rng.random() < 0.1: continue
+            emp_id, name = f"NV{e:05d}", f"Nguyễn Văn {e % (employees // 2 or 1)}"
+            for _ in range(rng.choice([1, 2, 3, 11])):
+                ts = day + timedelta(hours=rng.randint(0, 5), minutes=rng.randint(0, 59), seconds=rng.randint(0, 59))
+                records.append({"EmployeeId": emp_id, "EmployeeName": name, "CheckType": "checkin",
+                                "Timestamp": ts.strftime("%Y-%m-%d %H:%M:%S") if rng.random() < 0.1 else ts,
+                                "ProjectId": f"P{e % 5}", "Tasks": rng.choice([["Lắp đặt", "Kiểm tra"], "Bảo trì", None]),
+                                "Address": f"Công trình {e % 9}", "CheckinNote": rng.choice(["", "Đến muộn"])})
+            for _ in range(rng.choice([0, 1, 1, 2])):
+                records.append({"EmployeeId": emp_id, "EmployeeName": name, "CheckType": "checkout",
+                                "Timestamp": day + timedelta(hours=rng.randint(9, 12), minutes=rng.randint(0, 59)),
+                                "ProjectId": "", "Tasks": [], "Address": ""})
+        records.append({"EmployeeId": "", "EmployeeName": "", "CheckType": "checkin", "Timestamp": day})
+        records.append({"EmployeeId": "NV00000", "EmployeeName": "x", "CheckType": "checkin", "Timestamp": "không rõ"})
+    # Sắp theo thời gian như index checktype_timestamp trả về, các nhân viên xen kẽ nhau
+    records.sort(key=lambda rec: rec["Timestamp"] if isinstance(rec["Timestamp"], datetime) else datetime.min)
+    return records
+
+
+def workbook_cells(rows):
+    with export_workbook(TEMPLATE, [(None, ATTENDANCE_COLUMNS, rows)]) as output:
+        ws = load_workbook(output, read_only=True).active
+        return [list(row) for row in ws.iter_rows(values_only=True)]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--employees", type=int, default=300)
+    parser.add_argument("--days", type=int, default=31)
+    parser.add_argument("--processes", type=int, nargs="+", default=[2, 3, os.cpu_count() or 4])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    records = make_records(rng, args.employees, args.days)
+    daily_hours_map, monthly_hours_map = hours_maps(compute_attendance_days(records, day_key="Timestamp"))
+    # Bỏ ngày đầu: có bản ghi ngoài khoảng xuất như khi xuất từ giữa tháng
+    start_day, end_day = START + timedelta(days=1), START + timedelta(days=args.days - 1)
+
+    def run(processes):
+        return list(attendance_rows([dict(rec) for rec in records], start_day, end_day,
+                                    daily_hours_map, monthly_hours_map, processes=processes))
+
+    expected, serial_time = timed(lambda: run(1))
+    expected_cells = workbook_cells(expected)
+    print(f"{len(records)} bản ghi, {len(expected)} dòng, tuần tự {serial_time:.2f}s")
+    failed = False
+    for processes in args.processes:
+        run(processes)  # khởi động pool, không tính vào thời gian
+        actual, parallel_time = timed(lambda: run(processes))
+        mismatches = sum(a != b for a, b in zip(expected, actual)) + abs(len(expected) - len(actual))
+        if not mismatches and workbook_cells(actual) != expected_cells: mismatches = 1
+        failed |= bool(mismatches)
+        print(f"{processes} process: {parallel_time:.2f}s, khác nhau: {mismatches}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
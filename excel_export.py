@@ -0,0 +1,182 @@
+"""
+Ghi file Excel xuất báo cáo theo mẫu trong templates/.
+
+Hai cách ghi cho cùng một nội dung:
+- "stream": workbook write-only của openpyxl. Dòng tiêu đề (giá trị, style, độ rộng cột) chép từ
+  file mẫu, các dòng dữ liệu dùng chung một NamedStyle; từng dòng được ghi thẳng ra file tạm
+  và file kết quả cũng nằm trên đĩa, nên bộ nhớ không tăng theo số dòng.
+- "template": workbook thường dựng từ file mẫu, ghi từng ô như trước.
+
+Mỗi sheet là một tuple (tên sheet trong file mẫu hoặc None = sheet đang active, số cột, các dòng),
+trong đó các dòng là iterable các list giá trị, có thể là generator. Phần tử thứ tư (tuỳ chọn) là tên
+sheet trong file kết quả: khi đó sheet mẫu được dùng làm khuôn, có thể nhiều lần (xuất nhiều tháng).
+
+File mẫu chỉ được parse một lần mỗi process (cache theo mtime); mỗi lần xuất dựng workbook mới
+từ phần tiêu đề đã cache thay vì gọi load_workbook.
+"""
+import os
+import tempfile
+import threading
+from copy import copy
+from io import BytesIO
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, NamedStyle, Side
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+BODY_STYLE = "export_body"
+THIN_BORDER = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
+ALIGN_LEFT = Alignment(horizontal="left", vertical="center", wrap_text=True)
+
+# ---- Cache file mẫu ----
+_template_cache = {}  # đường dẫn -> (mtime, {"sheets": [tiêu đề từng sheet], "active": chỉ số sheet active})
+_template_cache_lock = threading.Lock()
+
+def _sheet_header(ws, header_rows):
+    """
+    Giá trị + style các dòng tiêu đề, độ rộng cột và chiều cao dòng của một sheet mẫu.
+    Ô có cùng style được đánh cùng style_id để khi dựng lại chỉ gán style đầy đủ một lần.
+    """
+    style_ids = {}
+    rows = []
+    for row in ws.iter_rows(min_row=1, max_row=header_rows):
+        specs = []
+        for cell in row:
+            spec = {
+                "value": cell.value, "font": copy(cell.font), "fill": copy(cell.fill), "border": copy(cell.border),
+                "alignment": copy(cell.alignment), "number_format": cell.number_format
+            }
+            style_key = (spec["font"], spec["fill"], spec["border"], spec["alignment"], spec["number_format"])
+            spec["style_id"] = style_ids.setdefault(style_key, len(style_ids))
+            specs.append(spec)
+        rows.append(specs)
+    return {
+        "title": ws.title,
+        "rows": rows,
+        "widths": {letter: dim.width for letter, dim in ws.column_dimensions.items() if dim.width},
+        "heights": {index: ws.row_dimensions[index].height for index in range(1, header_rows + 1)
+                    if ws.row_dimensions[index].height}
+    }
+
+def _parse_template(template_path, header_rows=1):
+    wb = load_workbook(template_path)
+    return {"sheets": [_sheet_header(ws, header_rows) for ws in wb.worksheets], "active": wb.index(wb.active)}
+
+def template_headers(template_path):
+    """Tiêu đề mọi sheet của file mẫu; parse lần đầu rồi dùng lại, đọc lại khi file mẫu thay đổi (mtime)."""
+    mtime = os.path.getmtime(template_path)
+    cached = _template_cache.get(template_path)
+    if cached is None or cached[0] != mtime:
+        with _template_cache_lock:
+            cached = _template_cache.get(template_path)
+            if cached is None or cached[0] != mtime:
+                cached = _template_cache[template_path] = (mtime, _parse_template(template_path))
+    return cached[1]
+
+def read_template_header(template_path, sheet_name=None):
+    template = template_headers(template_path)
+    if sheet_name is None: return template["sheets"][template["active"]]
+    for header in template["sheets"]:
+        if header["title"] == sheet_name: return header
+    raise KeyError(f"Sheet '{sheet_name}' không có trong {template_path}")
+
+def _apply_dimensions(ws, header):
+    for letter, width in header["widths"].items():
+        ws.column_dimensions[letter].width = width
+    for index, height in header["heights"].items():
+        ws.row_dimensions[index].height = height
+
+def _apply_header_style(cell, spec, applied):
+    """Gán style của ô mẫu; style đã gán trong workbook này (applied: style_id -> StyleArray) thì chép chỉ số."""
+    if spec["style_id"] in applied:
+        cell._style = copy(applied[spec["style_id"]])
+        return
+    cell.font, cell.fill, cell.border = spec["font"], spec["fill"], spec["border"]
+    cell.alignment, cell.number_format = spec["alignment"], spec["number_format"]
+    applied[spec["style_id"]] = cell._style
+
+def clone_template(template_path):
+    """Workbook mới (có thể sửa) gồm các sheet và dòng tiêu đề của file mẫu, dựng từ cache."""
+    template = template_headers(template_path)
+    wb = Workbook()
+    wb.remove(wb.active)
+    for header in template["sheets"]:
+        ws = wb.create_sheet(header["title"])
+        _apply_dimensions(ws, header)
+        applied = {}
+        for row, header_row in enumerate(header["rows"], start=1):
+            for col, spec in enumerate(header_row, start=1):
+                _apply_header_style(ws.cell(row=row, column=col, value=spec["value"]), spec, applied)
+    wb.active = template["active"]
+    return wb
+
+# ---- Ghi streaming (write-only) ----
+def _header_cells(ws, header_row, applied):
+    cells = []
+    for spec in header_row:
+        cell = WriteOnlyCell(ws, value=spec["value"])
+        _apply_header_style(cell, spec, applied)
+        cells.append(cell)
+    return cells
+
+def _body_cells(ws, values, columns):
+    cells = []
+    for index in range(columns):
+        cell = WriteOnlyCell(ws, value=values[index] if index < len(values) else None)
+        cell.style = BODY_STYLE
+        cells.append(cell)
+    return cells
+
+def write_streaming_workbook(template_path, sheets, output):
+    wb = Workbook(write_only=True)
+    wb.add_named_style(NamedStyle(name=BODY_STYLE, border=THIN_BORDER, alignment=ALIGN_LEFT))
+    for sheet in sheets:
+        sheet_name, columns, rows = sheet[:3]
+        header = read_template_header(template_path, sheet_name)
+        ws = wb.create_sheet(sheet[3] if len(sheet) > 3 else header["title"])
+        _apply_dimensions(ws, header)
+        applied = {}
+        for header_row in header["rows"]:
+            ws.append(_header_cells(ws, header_row, applied))
+        for values in rows:
+            ws.append(_body_cells(ws, values, columns))
+    wb.save(output)
+
+# ---- Ghi vào bản sao file mẫu ----
+def write_template_workbook(template_path, sheets, output, start_row=2):
+    wb = clone_template(template_path)
+    layouts = []  # sheet mẫu đã được chép sang sheet mới đặt tên: xoá sau khi ghi xong
+    for sheet in sheets:
+        sheet_name, columns, rows = sheet[:3]
+        ws = wb[sheet_name] if sheet_name else wb.active
+        if len(sheet) > 3:
+            if ws not in layouts: layouts.append(ws)
+            ws = wb.copy_worksheet(ws)
+            ws.title = sheet[3]
+        for row, values in enumerate(rows, start=start_row):
+            for col in range(1, columns + 1):
+                cell = ws.cell(row=row, column=col, value=values[col - 1] if col <= len(values) else None)
+                cell.border = THIN_BORDER
+                cell.alignment = ALIGN_LEFT
+    for ws in layouts: wb.remove(ws)
+    if layouts: wb.active = 0
+    wb.save(output)
+
+def export_workbook(template_path, sheets, mode="stream"):
+    """
+    Ghi workbook và trả về file object đã seek(0), sẵn sàng cho send_file (gửi theo từng khối).
+    mode="stream": file tạm trên đĩa; mode="template": BytesIO.
+    """
+    output = tempfile.TemporaryFile() if mode == "stream" else BytesIO()
+    try:
+        if mode == "stream":
+            write_streaming_workbook(template_path, sheets, output)
+        else:
+            write_template_workbook(template_path, sheets, output)
+    except Exception:
+        output.close()
+        raise
+    output.seek(0)
+    return output
@@ -0,0 +1,102 @@
+"""
+Dựng các dòng của sheet chấm công từ bản ghi check-in: phần tốn CPU của xuất Excel (đổi giờ VN,
+gom theo (nhân viên, ngày), định dạng từng ô bằng strftime/join).
+
+Module không dùng Flask/MongoDB nên chạy được trong process con:
+- attendance_rows(..., processes=1): tuần tự trong process hiện tại, trả về generator như trước.
+- processes > 1: chia bản ghi theo EmployeeId cho một ProcessPoolExecutor dùng chung; mỗi khối trả về
+  (vị trí bản ghi đầu tiên của nhóm, dòng) rồi được trộn lại theo vị trí đó, nên thứ tự và nội dung
+  các dòng giống hệt cách tuần tự. Kiểm tra: python benchmarks/check_parallel_export.py
+  Process con tạo bằng forkserver (spawn nếu không có), không fork process web đang có thread
+  của pymongo/job nền. Bản ghi và dòng đều phải pickle qua lại nên chỉ nhanh hơn khi có nhiều CPU rảnh.
+"""
+import heapq
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+from attendance_hours import format_seconds, to_vn_time
+
+ATTENDANCE_COLUMNS = 15
+
+_pool = None
+_pool_pid = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+_mp_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+def format_checkin_cell(rec):
+    """Nội dung một ô check-in/check-out: 'giờ; dự án; công việc; địa chỉ; ghi chú'."""
+    tasks = rec.get("Tasks", [])
+    tasks_str = ", ".join(tasks) if isinstance(tasks, list) else str(tasks or "")
+    return "; ".join(filter(None, [rec["_vn_time"].strftime("%H:%M:%S"), rec.get("ProjectId", ""), tasks_str,
+                                   rec.get("Address", ""), rec.get("CheckinNote", "")]))
+
+def attendance_export_rows(grouped, daily_hours_map, monthly_hours_map):
+    """Mỗi (nhân viên, ngày) -> một dòng: 9 ô check-in, 1 ô check-out, giờ làm trong ngày và trong tháng."""
+    for (emp_id, emp_name, date_str), records in grouped.items():
+        row = [emp_id, emp_name, date_str] + [None] * (ATTENDANCE_COLUMNS - 3)
+        row[13] = format_seconds(daily_hours_map.get((emp_id, date_str), 0))
+        row[14] = format_seconds(monthly_hours_map.get((emp_id, date_str), 0))
+        checkin_counter = 0
+        for rec in sorted(records, key=lambda x: x["_vn_time"]):
+            if rec.get("CheckType") == "checkin" and checkin_counter < 9:
+                row[3 + checkin_counter] = format_checkin_cell(rec)
+                checkin_counter += 1
+            elif rec.get("CheckType") == "checkout":
+                row[12] = format_checkin_cell(rec)
+        yield row
+
+def _group_by_day(indexed_records, start_day, end_day):
+    """Gom (vị trí, bản ghi) theo (nhân viên, tên, ngày giờ VN) trong [start_day, end_day] -> (nhóm, vị trí đầu tiên)."""
+    grouped, first_index = {}, {}
+    for index, rec in indexed_records:
+        if not rec.get("EmployeeId"): continue
+        rec["_vn_time"] = to_vn_time(rec.get("Timestamp"))
+        if not rec["_vn_time"] or not start_day <= rec["_vn_time"].date() <= end_day: continue
+        key = (rec.get("EmployeeId", ""), rec.get("EmployeeName", ""), rec["_vn_time"].strftime("%d/%m/%Y"))
+        if key not in grouped:
+            grouped[key] = []
+            first_index[key] = index
+        grouped[key].append(rec)
+    return grouped, first_index
+
+def _indexed_rows(indexed_records, start_day, end_day, daily_hours_map, monthly_hours_map):
+    """Chạy trong process con: [(vị trí bản ghi đầu tiên, dòng)] theo thứ tự vị trí."""
+    grouped, first_index = _group_by_day(indexed_records, start_day, end_day)
+    return [(first_index[key], row) for key, row in zip(grouped, attendance_export_rows(grouped, daily_hours_map, monthly_hours_map))]
+
+def _get_pool(processes):
+    """Pool dùng chung cho process, tạo lại sau khi fork hoặc khi cần nhiều process hơn."""
+    global _pool, _pool_pid, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid() or _pool_size < processes:
+            if _pool is not None and _pool_pid == os.getpid(): _pool.shutdown(wait=False)
+            _pool, _pool_pid, _pool_size = ProcessPoolExecutor(max_workers=processes, mp_context=_mp_context), os.getpid(), processes
+    return _pool
+
+def attendance_rows(records, start_day, end_day, daily_hours_map, monthly_hours_map, processes=1):
+    """Các dòng của sheet chấm công, theo thứ tự xuất hiện đầu tiên của mỗi (nhân viên, ngày) trong records."""
+    if processes <= 1:
+        grouped, _ = _group_by_day(enumerate(records), start_day, end_day)
+        return attendance_export_rows(grouped, daily_hours_map, monthly_hours_map)
+
+    # Nhân viên chia vòng tròn theo thứ tự xuất hiện; mỗi khối chỉ mang giờ làm của nhân viên trong khối
+    slots, blocks = {}, [[] for _ in range(processes)]
+    for index, rec in enumerate(records):
+        emp_id = rec.get("EmployeeId")
+        if not emp_id: continue
+        blocks[slots.setdefault(emp_id, len(slots) % processes)].append((index, rec))
+    daily_parts, monthly_parts = [{} for _ in blocks], [{} for _ in blocks]
+    for source, parts in ((daily_hours_map, daily_parts), (monthly_hours_map, monthly_parts)):
+        for key, value in source.items():
+            slot = slots.get(key[0])
+            if slot is not None: parts[slot][key] = value
+    used = [i for i, block in enumerate(blocks) if block]
+    results = _get_pool(processes).map(
+        _indexed_rows, [blocks[i] for i in used], [start_day] * len(used), [end_day] * len(used),
+        [daily_parts[i] for i in used], [monthly_parts[i] for i in used])
+    return [row for _, row in heapq.merge(*results, key=itemgetter(0))]
@@ -1,17 +1,53 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for, send_file, g
-from pymongo import MongoClient
+from flask import Flask, Response, render_template, jsonify, request, redirect, url_for, send_file, g, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from pymongo import MongoClient, UpdateMany, UpdateOne, DeleteMany, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import parse_options_header
 from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 import os
 import re
+import json
+import base64
+import unicodedata
+import hashlib
 import calendar
-from io import BytesIO
-from openpyxl import load_workbook
-from openpyxl.styles import Border, Side, Alignment
+import tempfile
+import zipfile
+import shutil
+import gzip
+import zlib
+from itertools import islice
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
 import secrets
+import socket
+import threading
+import time
 import requests
 from dotenv import load_dotenv
+import click
+try:
+    import orjson  # tuỳ chọn: JSON nhanh hơn cho danh sách lớn
+except ImportError:
+    orjson = None
+try:
+    import brotli  # tuỳ chọn: nén br
+except ImportError:
+    brotli = None
+from attendance_hours import (
+    to_vn_time, parse_timestamp_string, format_seconds,
+    load_attendance_days, get_attendance_hours
+)
+from excel_export import XLSX_MIMETYPE, export_workbook
+from export_rows import ATTENDANCE_COLUMNS, attendance_rows
+from request_metrics import CommandTimer, MetricsRegistry, start_profile, end_profile, step as metrics_step
+from result_cache import make_result_cache
 
 app = Flask(__name__, template_folder="templates")
 CORS(app, methods=["GET", "POST"])
@@ -29,38 +65,107 @@ load_dotenv() # Tải các biến từ file .env
 MONGO_URI = os.getenv("MONGO_URI") 
 DB_NAME = os.getenv("DB_NAME", "Sun_Database_1") 
 
+# ---- MongoDB Pool Config ----
+# Trên Vercel (serverless) mỗi instance chỉ phục vụ ít request đồng thời nên pool nhỏ
+# và không giữ kết nối nền; trên gunicorn/Railway dùng pool lớn hơn.
+IS_SERVERLESS = bool(os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "5" if IS_SERVERLESS else "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "10000" if IS_SERVERLESS else "60000"))
+MONGO_WARMUP = os.getenv("MONGO_WARMUP", "0") == "1"
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "0") == "1"
+
+# ---- Cách tính giờ làm: "mongo" (aggregation pipeline), "python" hoặc "pandas" ----
+# "pandas" tính cả số ngày nghỉ khi xuất Excel theo cột (attendance_frames, cần pandas/numpy).
+HOURS_ENGINE = os.getenv("HOURS_ENGINE", "mongo")
+
+# ---- Phiên đăng nhập: token ký bằng SECRET_KEY + cache tài khoản trong process ----
+# Cần đặt SECRET_KEY khi chạy thật. Chưa đặt thì suy ra từ MONGO_URI để mọi worker dùng chung một khoá,
+# nhưng ai biết chuỗi kết nối cũng ký được token. ACCOUNT_CACHE_TTL ngắn vì đổi mật khẩu chỉ xoá cache
+# của worker xử lý request đó: worker khác nhận token cũ tối đa ACCOUNT_CACHE_TTL giây.
+SECRET_KEY = os.getenv("SECRET_KEY")
+if not SECRET_KEY:
+    print("⚠️ Chưa đặt SECRET_KEY: khoá ký token suy ra từ MONGO_URI, hãy đặt SECRET_KEY riêng khi chạy thật")
+    SECRET_KEY = hashlib.sha256(f"session-token:{MONGO_URI or secrets.token_hex(16)}".encode()).hexdigest()
+SESSION_TOKEN_MAX_AGE = int(os.getenv("SESSION_TOKEN_MAX_AGE", str(7 * 24 * 3600)))
+ACCOUNT_CACHE_TTL = int(os.getenv("ACCOUNT_CACHE_TTL", "30"))
+ACCOUNT_CACHE_SIZE = int(os.getenv("ACCOUNT_CACHE_SIZE", "1024"))
+
+# ---- Đo thời gian request: Server-Timing, log JSON mỗi request và /metrics (tắt mặc định) ----
+# METRICS_TOKEN: nếu đặt, /metrics yêu cầu header "Authorization: Bearer <METRICS_TOKEN>".
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# ---- Cache kết quả theo kỳ: trong process (LRU) hoặc Redis nếu đặt RESULT_CACHE_URL (redis://...) ----
+# RESULT_CACHE_MAX_MB=0 tắt cache. Kỳ kết thúc trước tháng hiện tại (và quá PERIOD_CLOSE_GRACE_DAYS ngày)
+# coi như đã đóng: giữ RESULT_CACHE_CLOSED_TTL giây; kỳ đang mở giữ RESULT_CACHE_OPEN_TTL giây.
+RESULT_CACHE_URL = os.getenv("RESULT_CACHE_URL")
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "64"))
+RESULT_CACHE_CLOSED_TTL = int(os.getenv("RESULT_CACHE_CLOSED_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_OPEN_TTL = int(os.getenv("RESULT_CACHE_OPEN_TTL", "600"))
+PERIOD_CLOSE_GRACE_DAYS = int(os.getenv("PERIOD_CLOSE_GRACE_DAYS", "2"))
+
 # ---- Resend API Config ----
 RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 RESEND_FROM_EMAIL = os.getenv("RESEND_FROM_EMAIL")
 
 # ==============================================================================
-# CẤU HÌNH KẾT NỐI MONGODB MỚI (HỖ TRỢ SERVERLESS)
+# CẤU HÌNH KẾT NỐI MONGODB (POOL DÙNG CHUNG TOÀN PROCESS)
 # ==============================================================================
 
-def get_db():
+_mongo_client = None
+_mongo_client_pid = None
+_mongo_client_lock = threading.Lock()
+
+def get_client():
     """
-    Tạo kết nối DB và lưu vào biến toàn cục `g` của request hiện tại.
-    Chỉ kết nối khi cần thiết.
+    Trả về MongoClient dùng chung cho toàn process, chỉ tạo khi cần lần đầu.
+    Client được gắn với PID: sau khi gunicorn fork worker, worker sẽ tự tạo client mới
+    thay vì dùng lại socket của process cha.
     """
-    if 'db' not in g:
-        g.client = MongoClient(MONGO_URI)
-        g.db = g.client[DB_NAME]
-    return g.db
+    global _mongo_client, _mongo_client_pid
+    pid = os.getpid()
+    if _mongo_client is None or _mongo_client_pid != pid:
+        with _mongo_client_lock:
+            if _mongo_client is None or _mongo_client_pid != pid:
+                # Không close() client kế thừa từ process cha: các socket đó thuộc về process cha.
+                _mongo_client = MongoClient(
+                    MONGO_URI,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_MIN_POOL_SIZE,
+                    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                    connect=False,
+                    event_listeners=[CommandTimer()] if PROFILING_ENABLED else [],
+                )
+                _mongo_client_pid = pid
+    return _mongo_client
 
-@app.teardown_appcontext
-def close_db(error):
+def warmup_db():
+    """Mở sẵn kết nối (ping) để request đầu tiên không phải chịu thời gian handshake/auth."""
+    try:
+        get_client().admin.command("ping")
+        print("✅ MongoDB warm-up thành công")
+        return True
+    except Exception as e:
+        print(f"❌ Lỗi warm-up MongoDB: {e}")
+        return False
+
+def get_db():
     """
-    Tự động đóng kết nối MongoDB sau khi request kết thúc.
-    Điều này giúp Railway nhận diện App đang 'rảnh' để cho đi ngủ.
+    Lấy database từ client dùng chung và lưu vào `g` của request hiện tại.
+    Kết nối nhàn rỗi sẽ tự đóng sau MONGO_MAX_IDLE_TIME_MS nên App vẫn có thể 'ngủ'.
     """
-    client = g.pop('client', None)
-    if client:
-        client.close()
+    if 'db' not in g:
+        g.db = get_client()[DB_NAME]
+    return g.db
 
 def get_collection(name):
     """Helper để lấy collection từ kết nối hiện tại"""
     return get_db()[name]
 
+if MONGO_WARMUP and MONGO_URI:
+    warmup_db()
+
 # ==============================================================================
 
 def send_email_resend(to_email, subject, html_body):
@@ -93,6 +198,94 @@ def send_email_resend(to_email, subject, html_body):
         print(f"❌ Lỗi ngoại lệ khi gửi email: {e}")
         return False
 
+# ==============================================================================
+# PHIÊN ĐĂNG NHẬP & CACHE TÀI KHOẢN
+# ==============================================================================
+# /login trả về token ký (email, username, role, dấu vân tay mật khẩu). Các API kiểm tra chữ ký
+# rồi đối chiếu với tài khoản trong cache LRU (hết hạn sau ACCOUNT_CACHE_TTL giây), nên thường
+# không cần truy vấn admins/users. Đổi mật khẩu thì xoá cache của worker hiện tại: token cũ bị từ chối
+# ngay ở worker này, ở các worker khác sau khi bản cache hết hạn (tối đa ACCOUNT_CACHE_TTL giây).
+
+_session_serializer = URLSafeTimedSerializer(SECRET_KEY, salt="session-token")
+_account_cache = OrderedDict()  # email -> (hết hạn lúc, tài khoản hoặc None nếu email không tồn tại)
+_account_cache_lock = threading.Lock()
+
+def _password_fingerprint(password_hash):
+    return hashlib.sha256((password_hash or "").encode()).hexdigest()[:16]
+
+def _account_from_doc(doc, role):
+    return {"email": doc["email"], "username": doc.get("username"), "role": role,
+            "pw": _password_fingerprint(doc.get("password"))}
+
+def load_account(email):
+    """Tài khoản theo email từ DB; admin được ưu tiên như ở /login."""
+    admin = get_collection("admins").find_one({"email": email}, {"email": 1, "username": 1, "password": 1})
+    if admin: return _account_from_doc(admin, "admin")
+    user = get_collection("users").find_one({"email": email}, {"email": 1, "username": 1, "password": 1})
+    return _account_from_doc(user, "user") if user else None
+
+def _cache_account(email, account):
+    with _account_cache_lock:
+        _account_cache[email] = (time.monotonic() + ACCOUNT_CACHE_TTL, account)
+        _account_cache.move_to_end(email)
+        while len(_account_cache) > ACCOUNT_CACHE_SIZE:
+            _account_cache.popitem(last=False)
+
+def get_account(email):
+    """Tài khoản theo email, đọc DB khi chưa có trong cache hoặc đã hết hạn."""
+    if not email: return None
+    with _account_cache_lock:
+        cached = _account_cache.get(email)
+        if cached and cached[0] > time.monotonic():
+            _account_cache.move_to_end(email)
+            return cached[1]
+    account = load_account(email)
+    _cache_account(email, account)
+    return account
+
+def invalidate_account(email):
+    """Gọi sau khi đổi mật khẩu: lần kiểm tra sau trong process này đọc lại DB và token cấp trước đó bị từ chối."""
+    with _account_cache_lock:
+        _account_cache.pop(email, None)
+
+def issue_session_token(account):
+    return _session_serializer.dumps({key: account[key] for key in ("email", "username", "role", "pw")})
+
+def request_token():
+    """Token của request: header 'Authorization: Bearer ...' hoặc tham số token (link ảnh, link tải file)."""
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "): return auth[7:].strip() or None
+    return request.values.get("token") or None
+
+def get_current_account(email=None):
+    """
+    (tài khoản, lỗi) của request hiện tại; lỗi là response (json, status).
+    Có token thì xác thực bằng token; không có thì tra theo email (tham số email nếu không truyền vào) như các client cũ.
+    """
+    token = request_token()
+    if token:
+        try:
+            claims = _session_serializer.loads(token, max_age=SESSION_TOKEN_MAX_AGE)
+        except SignatureExpired:
+            return None, (jsonify({"error": "Phiên đăng nhập đã hết hạn"}), 401)
+        except BadSignature:
+            return None, (jsonify({"error": "Phiên đăng nhập không hợp lệ"}), 401)
+        account = get_account(claims.get("email"))
+        if not account or account["pw"] != claims.get("pw"):
+            return None, (jsonify({"error": "Phiên đăng nhập không còn hiệu lực"}), 401)
+        return account, None
+    email = email or request.values.get("email")
+    if not email: return None, (jsonify({"error": "Thiếu email"}), 400)
+    account = get_account(email)
+    if not account: return None, (jsonify({"error": "🚫 Email không tồn tại"}), 403)
+    return account, None
+
+def get_request_user():
+    """(username, lỗi): username None nếu là admin (xem toàn bộ dữ liệu), ngược lại chỉ xem dữ liệu của mình."""
+    account, error = get_current_account()
+    if error: return None, error
+    return (None if account["role"] == "admin" else account["username"]), None
+
 # ---- Trang chủ (đăng nhập chính) ----
 @app.route("/")
 def index():
@@ -111,19 +304,21 @@ def login():
     # CẬP NHẬT: Dùng get_collection thay vì biến global
     admin = get_collection("admins").find_one({"email": email})
     if admin and check_password_hash(admin.get("password", ""), password):
-        return jsonify({
-            "success": True, "message": "✅ Đăng nhập thành công",
-            "username": admin["username"], "email": admin["email"], "role": "admin"
-        })
+        return login_success(admin, "admin")
     
     user = get_collection("users").find_one({"email": email})
     if user and check_password_hash(user.get("password", ""), password):
-        return jsonify({
-            "success": True, "message": "✅ Đăng nhập thành công",
-            "username": user["username"], "email": user["email"], "role": "user"
-        })
+        return login_success(user, "user")
     return jsonify({"success": False, "message": "🚫 Email hoặc mật khẩu không đúng!"}), 401
 
+def login_success(doc, role):
+    account = _account_from_doc(doc, role)
+    _cache_account(doc["email"], account)
+    return jsonify({
+        "success": True, "message": "✅ Đăng nhập thành công",
+        "username": doc["username"], "email": doc["email"], "role": role, "token": issue_session_token(account)
+    })
+
 @app.route("/request-reset-password", methods=["POST"])
 def request_reset_password():
     email = request.form.get("email")
@@ -205,13 +400,15 @@ def reset_password(token):
         admins_col = get_collection("admins")
         users_col = get_collection("users")
         
-        account = admins_col.find_one({"email": email}) or users_col.find_one({"email": email})
+        admin = admins_col.find_one({"email": email})
+        account = admin or users_col.find_one({"email": email})
         if not account:
             return """<!DOCTYPE html><html lang="vi">...<p>🚫 Email không tồn tại!</p>...</html>""", 404
 
         hashed_pw = generate_password_hash(new_password)
-        collection_to_update = admins_col if "username" in account else users_col
+        collection_to_update = admins_col if admin else users_col
         collection_to_update.update_one({"email": email}, {"$set": {"password": hashed_pw}})
+        invalidate_account(email)
         
         reset_tokens_col.delete_one({"token": token}) # Remove used token
 
@@ -239,15 +436,57 @@ def forgot_password():
         admins_col = get_collection("admins")
         users_col = get_collection("users")
         
-        account = admins_col.find_one({"email": email}) or users_col.find_one({"email": email})
+        admin = admins_col.find_one({"email": email})
+        account = admin or users_col.find_one({"email": email})
         if not account:
              return """<!DOCTYPE html><html lang="vi">...<p>🚫 Email không tồn tại!</p>...</html>""", 404
         
         hashed_pw = generate_password_hash(new_password)
-        collection_to_update = admins_col if "username" in account else users_col
+        collection_to_update = admins_col if admin else users_col
         collection_to_update.update_one({"email": email}, {"$set": {"password": hashed_pw}})
+        invalidate_account(email)
         return """<!DOCTYPE html><html lang="vi">...<div class="success">✅ Thay đổi mật khẩu thành công!</div>...</html>"""
 
+# ---- Tìm kiếm theo mã/tên nhân viên ----
+# Từ khoá được chuẩn hoá (chữ thường, bỏ dấu) và so khớp tiền tố (đã escape) trên SearchKeys, có index.
+# SearchKeys do job backfill_search_keys ghi; document chưa có SearchKeys vẫn khớp theo chuỗi con như trước.
+# SEARCH_USE_DIRECTORY=1: tra employee_directory ra danh sách EmployeeId rồi lọc bằng $in; nhân viên mới
+# chưa có trong danh bạ (job backfill chưa chạy) vẫn tìm được qua check-in chưa có SearchKeys.
+SEARCH_USE_DIRECTORY = os.getenv("SEARCH_USE_DIRECTORY", "0") == "1"
+EMPLOYEE_DIRECTORY = "employee_directory"
+
+def normalize_search_text(value):
+    """'Nguyễn  Văn Đức' -> 'nguyen van duc'."""
+    text = unicodedata.normalize("NFD", str(value or "").replace("đ", "d").replace("Đ", "D"))
+    return " ".join("".join(ch for ch in text if not unicodedata.combining(ch)).lower().split())
+
+def search_keys(*values):
+    """Các khoá tìm kiếm: mỗi giá trị đã chuẩn hoá và các phần đuôi bắt đầu từ một từ ('nguyen van a', 'van a', 'a')."""
+    keys = []
+    for value in values:
+        words = normalize_search_text(value).split()
+        for index in range(len(words)):
+            key = " ".join(words[index:])
+            if key not in keys: keys.append(key)
+    return keys
+
+def search_condition(search, db=None):
+    """Điều kiện lọc alt_checkins theo từ khoá tìm kiếm (None nếu từ khoá rỗng)."""
+    term = normalize_search_text(search)
+    if not term: return None
+    prefix = {"$regex": f"^{re.escape(term)}"}
+    legacy = re.compile(re.escape(search.strip()), re.IGNORECASE)
+    not_backfilled = {"SearchKeys": {"$exists": False}, "$or": [{"EmployeeId": legacy}, {"EmployeeName": legacy}]}
+    if SEARCH_USE_DIRECTORY:
+        directory = (db if db is not None else get_db())[EMPLOYEE_DIRECTORY]
+        emp_ids = [doc["_id"] for doc in directory.find({"SearchKeys": prefix}, {"_id": 1})]
+        return {"$or": [{"EmployeeId": {"$in": emp_ids}}, not_backfilled]}
+    return {"$or": [{"SearchKeys": prefix}, not_backfilled]}
+
+def add_search_condition(conditions, search, db=None):
+    condition = search_condition(search, db)
+    if condition: conditions.append(condition)
+
 # ---- Build leave query (lọc theo dateType)----
 def build_leave_query(filter_type, start_date_str, end_date_str, search, date_type="CheckinTime", username=None):
     today = datetime.now(VN_TZ)
@@ -284,20 +523,32 @@ def build_leave_query(filter_type, start_date_str, end_date_str, search, date_ty
             date_filter = {"ApprovalDate1": {"$gte": start_dt, "$lte": end_dt}}
         elif date_type == "ApprovalDate2":
             date_filter = {"ApprovalDate2": {"$gte": start_dt, "$lte": end_dt}}
+        elif date_type == "LeaveDate":
+            add_leave_date_filter(conditions, start_dt, end_dt)
 
     if date_filter:
         conditions.append(date_filter)
 
-    if search:
-        regex = re.compile(search, re.IGNORECASE)
-        conditions.append({"$or": [{"EmployeeId": regex}, {"EmployeeName": regex}]})
+    add_search_condition(conditions, search)
     if username:
         conditions.append({"EmployeeName": username})
 
     return {"$and": conditions}
 
+# ---- Lọc theo ngày check-in (VnDate) ----
+def vn_date_filter(start_day, end_day, legacy_checkin_date_filter):
+    """
+    Lọc theo ngày check-in trong [start_day, end_day] bằng truy vấn khoảng trên VnDate
+    (ngày của CheckinDate dạng BSON date, có index). Document chưa được backfill VnDate
+    vẫn được so khớp bằng điều kiện CheckinDate cũ nên kết quả không đổi.
+    """
+    return {"$or": [
+        {"VnDate": {"$gte": start_day, "$lte": end_day}},
+        {"VnDate": None, "CheckinDate": legacy_checkin_date_filter}
+    ]}
+
 # ---- Build attendance query ----
-def build_attendance_query(filter_type, start_date, end_date, search, username=None):
+def build_attendance_query(filter_type, start_date, end_date, search, username=None, db=None):
     today = datetime.now(VN_TZ)
     conditions = [{"CheckType": {"$in": ["checkin", "checkout"]}}]
     date_filter = {}
@@ -306,23 +557,191 @@ def build_attendance_query(filter_type, start_date, end_date, search, username=N
         end_dt = datetime.strptime(end_date, "%Y-%m-%d").replace(hour=23, minute=59, second=59, tzinfo=VN_TZ)
         date_filter = {"Timestamp": {"$gte": start_dt, "$lte": end_dt}}
     elif filter_type == "hôm nay":
-        date_filter = {"CheckinDate": today.strftime("%d/%m/%Y")}
+        day = datetime(today.year, today.month, today.day)
+        date_filter = vn_date_filter(day, day, today.strftime("%d/%m/%Y"))
     elif filter_type == "tuần":
         start_dt = (today - timedelta(days=today.weekday())).replace(hour=0, minute=0, second=0)
         end_dt = (start_dt + timedelta(days=6)).replace(hour=23, minute=59, second=59)
         date_filter = {"Timestamp": {"$gte": start_dt, "$lte": end_dt}}
     elif filter_type == "tháng":
-        date_filter = {"CheckinDate": {"$regex": f"/{today.month:02d}/{today.year}$"}}
+        _, last_day = calendar.monthrange(today.year, today.month)
+        date_filter = vn_date_filter(datetime(today.year, today.month, 1), datetime(today.year, today.month, last_day),
+                                     {"$regex": f"/{today.month:02d}/{today.year}$"})
     elif filter_type == "năm":
-        date_filter = {"CheckinDate": {"$regex": f"/{today.year}$"}}
+        date_filter = vn_date_filter(datetime(today.year, 1, 1), datetime(today.year, 12, 31), {"$regex": f"/{today.year}$"})
     if date_filter: conditions.append(date_filter)
-    if search:
-        regex = re.compile(search, re.IGNORECASE)
-        conditions.append({"$or": [{"EmployeeId": regex}, {"EmployeeName": regex}]})
+    add_search_condition(conditions, search, db)
     if username:
         conditions.append({"EmployeeName": username})
     return {"$and": conditions}
 
+def attendance_hours_query(filter_type, start_date, end_date, search, username=None):
+    """
+    Query tính giờ làm cho danh sách khi không đọc từ bảng tổng hợp: cửa sổ của bộ lọc được mở rộng
+    về đầu tháng của ngày đầu tiên, để MonthlyHours là tổng cộng dồn từ đầu tháng như bảng tổng hợp.
+    """
+    today = datetime.now(VN_TZ)
+    if filter_type == "custom" and start_date and end_date:
+        first, last = datetime.strptime(start_date, "%Y-%m-%d"), end_date
+    elif filter_type == "hôm nay":
+        first, last = today, today.strftime("%Y-%m-%d")
+    elif filter_type == "tuần":
+        first = today - timedelta(days=today.weekday())
+        last = (first + timedelta(days=6)).strftime("%Y-%m-%d")
+    else:  # "tháng", "năm" đã bắt đầu từ đầu tháng, "tất cả" không lọc ngày
+        return build_attendance_query(filter_type, start_date, end_date, search, username=username)
+    return build_attendance_query("custom", first.strftime("%Y-%m-01"), last, search, username=username)
+
+# ---- Phân trang / sắp xếp phía server ----
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+DEFAULT_PAGE_SIZE = 20
+
+# Tên cột trên giao diện -> field trong alt_checkins dùng để sắp xếp (chỉ các cột trong danh sách này).
+# Không có DailyHours/MonthlyHours: giờ làm hiển thị lấy từ bảng tổng hợp/aggregation, còn _dailySeconds
+# trong alt_checkins chỉ có khi chạy job materialize_attendance_hours nên có thể thiếu hoặc cũ.
+ATTENDANCE_SORT_FIELDS = {
+    "EmployeeId": "EmployeeId", "EmployeeName": "EmployeeName",
+    "CheckinDate": "Timestamp", "CreationTime": "Timestamp", "CheckinTime": "Timestamp", "Timestamp": "Timestamp",
+    "CheckType": "CheckType", "ProjectId": "ProjectId", "Tasks": "Tasks", "CheckinNote": "CheckinNote",
+    "Address": "Address"
+}
+LEAVE_SORT_FIELDS = {
+    "EmployeeId": "EmployeeId", "EmployeeName": "EmployeeName",
+    "CheckinDate": "DisplayDate", "CheckinTime": "CreationTime", "CreationTime": "CreationTime",
+    "Tasks": "Reason", "ApprovalDate1": "ApprovalDate1", "Status1": "Status1",
+    "ApprovalDate2": "ApprovalDate2", "Status2": "Status2", "Note": "LeaveNote"
+}
+
+def get_paging_args(sort_fields, default_sort):
+    """
+    Đọc page, pageSize, sort, order, cursor từ query string.
+    Trả về None nếu client không gửi page/pageSize/cursor (API trả về mảng đầy đủ như trước).
+    """
+    args = request.args
+    if not any(key in args for key in ("page", "pageSize", "cursor")): return None
+    try: page = max(int(args.get("page", 1)), 1)
+    except ValueError: page = 1
+    try: page_size = min(max(int(args.get("pageSize", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError: page_size = DEFAULT_PAGE_SIZE
+    return {
+        "page": page, "page_size": page_size,
+        "sort": sort_fields.get(args.get("sort", ""), default_sort),
+        "direction": ASCENDING if args.get("order", "desc").lower() == "asc" else DESCENDING,
+        "cursor": args.get("cursor") or None
+    }
+
+def encode_page_cursor(doc, sort_field):
+    """Cursor (opaque) = giá trị sắp xếp + _id của document cuối trang."""
+    return base64.urlsafe_b64encode(json_util.dumps([doc.get(sort_field), doc["_id"]]).encode()).decode()
+
+# Thứ tự MongoDB so sánh giá trị khác kiểu khi sắp xếp (null/thiếu field đứng trước tất cả)
+SORT_TYPE_ORDER = ("number", "string", "object", "objectId", "bool", "date")
+
+def _sort_type(value):
+    if isinstance(value, datetime): return "date"
+    if isinstance(value, str): return "string"
+    return "number"
+
+def decode_page_cursor(token):
+    """(giá trị sắp xếp, _id) của cursor; None nếu không hợp lệ (giá trị chỉ được là null/ngày/chuỗi/số)."""
+    try:
+        value, last_id = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(last_id, ObjectId): return None
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (datetime, str, int, float))): return None
+    return value, last_id
+
+def keyset_condition(field, direction, value, last_id):
+    """
+    Điều kiện "sau document (value, last_id)" theo thứ tự sắp xếp (field, _id).
+    Với MongoDB, null/thiếu field đứng trước mọi giá trị khi tăng dần và sau cùng khi giảm dần.
+    $gt/$lt chỉ so sánh trong cùng kiểu, nên các kiểu đứng sau trong SORT_TYPE_ORDER (ví dụ
+    Timestamp dạng chuỗi cũ so với BSON date) được thêm bằng điều kiện $type.
+    """
+    op = "$gt" if direction == ASCENDING else "$lt"
+    tie = {field: value, "_id": {op: last_id}}
+    if value is None:
+        return {"$or": [{field: {"$ne": None}}, tie]} if direction == ASCENDING else tie
+    rank = SORT_TYPE_ORDER.index(_sort_type(value))
+    later_types = SORT_TYPE_ORDER[rank + 1:] if direction == ASCENDING else SORT_TYPE_ORDER[:rank]
+    branches = [{field: {op: value}}, tie] + [{field: {"$type": type_name}} for type_name in later_types]
+    if direction == DESCENDING: branches.append({field: None})
+    return {"$or": branches}
+
+def find_page(collection, query, projection, paging):
+    """
+    Lấy một trang ngay trong MongoDB: sort (field, _id) + skip/limit, hoặc keyset theo cursor
+    (không cần skip, dùng cho trang sâu). Trả về (items, total, next_cursor).
+    """
+    sort = [(paging["sort"], paging["direction"]), ("_id", paging["direction"])]
+    fields = dict(projection or {})
+    fields.pop("_id", None)
+    if any(value not in (0, False) for value in fields.values()):
+        fields[paging["sort"]] = 1  # projection dạng chọn field: cần giá trị sắp xếp để tạo cursor
+    page_query, skip = query, (paging["page"] - 1) * paging["page_size"]
+    after = decode_page_cursor(paging["cursor"]) if paging["cursor"] else None
+    # Field kiểu mảng (Tasks) không so sánh keyset được -> quay về skip theo page
+    if after and not isinstance(after[0], list):
+        page_query, skip = {"$and": [query, keyset_condition(paging["sort"], paging["direction"], *after)]}, 0
+    items = list(collection.find(page_query, fields or None).sort(sort).skip(skip).limit(paging["page_size"]))
+    next_cursor = encode_page_cursor(items[-1], paging["sort"]) if len(items) == paging["page_size"] else None
+    return with_public_ids(items), collection.count_documents(query), next_cursor
+
+def with_public_ids(items):
+    """Đổi _id (ObjectId) thành chuỗi Id để client gọi các API theo bản ghi (vd. ảnh check-in)."""
+    for item in items:
+        if "_id" in item: item["Id"] = str(item.pop("_id"))
+    return items
+
+def paged_response(items, total, paging, next_cursor=None):
+    return jsonify({
+        "items": items, "total": total, "page": paging["page"],
+        "pageSize": paging["page_size"], "nextCursor": next_cursor
+    })
+
+# ---- Chọn field trả về (projection) ----
+# Ảnh check-in (base64) rất nặng: không trả về trong danh sách, lấy riêng qua /api/attendances/<id>/photo
+IMAGE_FIELDS = ("FaceImage", "PhotoURL")
+NO_IMAGE_PROJECTION = {"_id": 0, **{field: 0 for field in IMAGE_FIELDS}}
+HAS_PHOTO_PROJECTION = {"HasPhoto": {"$or": [{"$gt": [{"$ifNull": [f"${field}", ""]}, ""]} for field in IMAGE_FIELDS]}}
+FIELD_NAME_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+
+# Field mặc định của từng API danh sách và field luôn cần để tính các cột dẫn xuất
+ATTENDANCE_LIST_FIELDS = (
+    "EmployeeId", "EmployeeName", "CheckinDate", "Timestamp", "CheckType", "ProjectId",
+    "Tasks", "Address", "Latitude", "Longitude", "CheckinNote"
+)
+ATTENDANCE_REQUIRED_FIELDS = ("EmployeeId", "CheckinDate", "Timestamp")
+LEAVE_LIST_FIELDS = (
+    "EmployeeId", "EmployeeName", "DisplayDate", "CreationTime", "Tasks", "Reason",
+    "ApprovalDate1", "Status1", "ApprovalDate2", "Status2", "LeaveNote", "LeaveStart", "LeaveEnd"
+)
+LEAVE_REQUIRED_FIELDS = LEAVE_LIST_FIELDS
+
+def list_projection(default_fields, required_fields, photo_flag=False):
+    """
+    Projection cho API danh sách: mặc định chỉ các field giao diện cần (không có ảnh),
+    ?fields=a,b,c để chọn field khác (field cần cho cột dẫn xuất luôn được thêm).
+    photo_flag=True: thêm HasPhoto (có ảnh hay không) khi ảnh không được yêu cầu trực tiếp.
+    """
+    requested = [field.strip() for field in request.args.get("fields", "").split(",")]
+    fields = [field for field in requested if FIELD_NAME_RE.match(field)] or list(default_fields)
+    projection = {field: 1 for field in (*fields, *required_fields)}
+    if photo_flag and not any(field in projection for field in IMAGE_FIELDS):
+        projection.update(HAS_PHOTO_PROJECTION)
+    return projection
+
+def decode_image_field(value):
+    """FaceImage dạng data URI, base64 thô hoặc binary -> (bytes, mimetype); None nếu không giải mã được."""
+    if isinstance(value, (bytes, bytearray)): return bytes(value), "image/jpeg"
+    if not isinstance(value, str) or not value: return None
+    mimetype = "image/jpeg"
+    match = re.match(r"^data:([\w/+.-]+);base64,", value)
+    if match: mimetype, value = match.group(1), value[match.end():]
+    try: return base64.b64decode(value), mimetype
+    except ValueError: return None
+
 # ---- Helper functions ----
 def calculate_leave_days_for_month(record, export_year, export_month):
     # ... (Giữ nguyên hàm này) ...
@@ -387,146 +806,408 @@ def get_formatted_approval_date(approval_date):
     try: return approval_date.astimezone(VN_TZ).strftime("%d/%m/%Y %H:%M:%S") if isinstance(approval_date, datetime) else str(approval_date)
     except: return str(approval_date)
 
+# ---- JSON & nén phản hồi ----
+# Có orjson thì jsonify dùng orjson, giữ nguyên định dạng của Flask (ngày kiểu HTTP date, key sắp xếp).
+# Phản hồi JSON/NDJSON được nén br (nếu có brotli) hoặc gzip theo Accept-Encoding.
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+NDJSON_MIMETYPE = "application/x-ndjson"
+NDJSON_BATCH = 500
+COMPRESS_MIMETYPES = ("application/json", NDJSON_MIMETYPE)
+
+class JSONProvider(DefaultJSONProvider):
+    """jsonify của Flask, thời gian serialize được tính vào bước "json" khi bật PROFILING_ENABLED."""
+    def response(self, *args, **kwargs):
+        with metrics_step("json"): return super().response(*args, **kwargs)
+
+class OrjsonProvider(JSONProvider):
+    def _options(self, indent=False):
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys: options |= orjson.OPT_SORT_KEYS
+        return options | orjson.OPT_INDENT_2 if indent else options
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        with metrics_step("json"):
+            body = orjson.dumps(obj, default=self.default, option=self._options(indent)) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+app.json = OrjsonProvider(app) if orjson else JSONProvider(app)
+
+def wants_ndjson():
+    return request.args.get("format") == "ndjson" or request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+def ndjson_response(docs, prepare):
+    """
+    Phản hồi NDJSON (mỗi dòng một bản ghi) gửi dần theo lô: đọc NDJSON_BATCH bản ghi từ cursor,
+    prepare(lô) gắn các field hiển thị rồi ghi ra ngay, trình duyệt hiển thị được trước khi có đủ kết quả.
+    """
+    docs = iter(docs)
+    def generate():
+        while True:
+            batch = with_public_ids(list(islice(docs, NDJSON_BATCH)))
+            if not batch: return
+            prepare(batch)
+            with metrics_step("json"): lines = "".join(f"{app.json.dumps(item)}\n" for item in batch)
+            yield lines
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+def _response_encoding():
+    if brotli and request.accept_encodings["br"]: return "br"
+    if request.accept_encodings["gzip"]: return "gzip"
+    return None
+
+def _compress_stream(chunks, encoding):
+    """Nén từng khối của phản hồi stream, flush sau mỗi khối để trình duyệt nhận được ngay."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        step, finish = lambda data: compressor.process(data) + compressor.flush(), compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: định dạng gzip
+        step, finish = lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            yield step(chunk.encode() if isinstance(chunk, str) else chunk)
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"): chunks.close()
+
+@app.after_request
+def compress_response(response):
+    if (response.mimetype not in COMPRESS_MIMETYPES or response.status_code != 200
+            or response.direct_passthrough or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = _response_encoding()
+    if not encoding: return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE: return response
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY) if encoding == "br"
+                          else gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak: response.set_etag(etag, weak=True)  # bản nén khác byte với bản gốc
+    return response
+
+# ---- Đo thời gian request (PROFILING_ENABLED) ----
+# Mỗi request có một RequestProfile: thời gian MongoDB (command monitoring), serialize JSON, ghi workbook
+# và phần xử lý Python còn lại. Gửi về trong header Server-Timing, ghi một dòng log JSON và cộng vào
+# histogram theo route ở /metrics. Phản hồi stream (NDJSON): log và histogram ghi khi gửi xong.
+metrics_registry = MetricsRegistry()
+
+@app.before_request
+def start_request_profile():
+    if PROFILING_ENABLED and request.endpoint not in ("static", "metrics"):
+        g.profile = start_profile(request.url_rule.rule if request.url_rule else "<unmatched>")
+
+@app.after_request
+def finish_request_profile(response):
+    # Đăng ký sau compress_response nên chạy trước: thời gian nén không nằm trong Server-Timing
+    profile = g.pop("profile", None)
+    if profile is None: return response
+    response.headers["Server-Timing"] = profile.server_timing()
+    method, path, status = request.method, request.path, response.status_code
+    def finish():
+        metrics_registry.observe(profile, status)
+        print(profile.log_line(method, path, status), flush=True)
+        end_profile()
+    # send_file (direct_passthrough) không gọi call_on_close: file đã ghi xong, chỉ còn gửi đi
+    if response.is_streamed and not response.direct_passthrough: response.call_on_close(finish)
+    else: finish()
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if not PROFILING_ENABLED: return jsonify({"error": "Chưa bật PROFILING_ENABLED"}), 404
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Không có quyền"}), 401
+    return Response(metrics_registry.render() + result_cache.render_metrics(), mimetype="text/plain",
+                    headers={"Cache-Control": "no-store"})
+
+# ---- Cache phản hồi danh sách (ETag/Last-Modified) ----
+# Phiên bản của một view = số bản ghi + giá trị lớn nhất của các trường ngày trong cửa sổ query
+# (một $group thay vì tính lại cả danh sách). Trình duyệt gửi lại ETag -> 304; worker đã có bản
+# cùng phiên bản trong cache -> trả lại ngay; có bản ghi mới thì phiên bản đổi và bản cũ bị thay.
+# LISTING_CACHE_SIZE=0 tắt cả ETag (không chạy $group) trừ khi trình duyệt còn gửi phiên bản cũ.
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", "128"))
+LISTING_CACHE_MAX_BYTES = int(os.getenv("LISTING_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))  # mỗi phản hồi
+LISTING_CACHE_TOTAL_BYTES = int(os.getenv("LISTING_CACHE_TOTAL_BYTES", str(32 * 1024 * 1024)))  # cả cache, mỗi worker
+LISTING_CACHE_CONTROL = "private, no-cache"
+ATTENDANCE_VERSION_FIELDS = ("Timestamp",)
+LEAVE_VERSION_FIELDS = ("CreationTime", "ApprovalDate1", "ApprovalDate2")
+
+_listing_cache = OrderedDict()  # (route, người xem, tham số) -> (etag, last_modified, body)
+_listing_cache_bytes = 0
+_listing_cache_lock = threading.Lock()
+
+def listing_version(collection, query, date_fields, username, extra=None, closed=False):
+    """
+    Khoá cache của request + ETag/Last-Modified của kết quả hiện tại trong DB (extra: thêm vào phiên bản).
+    closed=True (kỳ đã đóng): thống kê của query lấy từ result_cache, không chạy lại $group.
+    Trả về None (không chạy $group, không gắn ETag) khi tắt cache danh sách và request không hỏi phiên bản.
+    """
+    if LISTING_CACHE_SIZE <= 0 and not (request.if_none_match or request.if_modified_since): return None
+    group = {"_id": None, "count": {"$sum": 1}}
+    for index, field in enumerate(date_fields):
+        group[f"max{index}"] = {"$max": f"${field}"}
+    def compute(): return next(collection.aggregate([{"$match": query}, {"$group": group}]), {})
+    stats = result_cache.get_or_compute("listing_version", [collection.name, query, date_fields], compute, True) if closed else compute()
+    viewer = ("admin",) if username is None else ("user", username)
+    params = tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k not in ("email", "token")))
+    # JSON và NDJSON (chọn qua header Accept) là hai bản khác nhau của cùng URL
+    key = (request.path, viewer, params, "ndjson" if wants_ndjson() else "json")
+    # Tham số request thay cho query (query của "hôm nay"/"tuần"... chứa thời điểm hiện tại), kèm ngày
+    # hôm nay vì cửa sổ của các bộ lọc tương đối đổi theo ngày
+    etag = hashlib.sha1(json_util.dumps(
+        [key, datetime.now(VN_TZ).strftime("%Y-%m-%d"), stats, extra, HOURS_ENGINE], sort_keys=True).encode()).hexdigest()
+    dates = [value for name, value in stats.items() if name.startswith("max") and isinstance(value, datetime)]
+    last_modified = max((d if d.tzinfo else d.replace(tzinfo=timezone.utc)) for d in dates) if dates else None
+    return {"key": key, "etag": etag, "last_modified": last_modified}
+
+def _listing_headers(response, version):
+    response.set_etag(version["etag"])
+    if version["last_modified"]: response.last_modified = version["last_modified"]
+    response.headers["Cache-Control"] = LISTING_CACHE_CONTROL
+    response.vary.add("Accept")
+    return response
+
+def cached_listing(version):
+    """304 nếu trình duyệt đã có đúng phiên bản, bản đã cache nếu dữ liệu chưa đổi, ngược lại None."""
+    if version is None: return None
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(version["etag"])
+    else:
+        since, last_modified = request.if_modified_since, version["last_modified"]
+        not_modified = bool(since and last_modified and last_modified.replace(microsecond=0) <= since)
+    if not_modified:
+        return _listing_headers(Response(status=304), version)
+    with _listing_cache_lock:
+        cached = _listing_cache.get(version["key"])
+        if cached and cached[0] == version["etag"]:
+            _listing_cache.move_to_end(version["key"])
+            return _listing_headers(Response(cached[2], mimetype="application/json"), version)
+    return None
+
+def store_listing(version, response):
+    """
+    Gắn ETag/Last-Modified cho phản hồi vừa tính và lưu vào cache (bỏ qua lỗi, phản hồi stream và quá lớn).
+    Cache giới hạn cả số bản (LISTING_CACHE_SIZE) lẫn tổng dung lượng (LISTING_CACHE_TOTAL_BYTES), bỏ bản cũ nhất trước.
+    """
+    global _listing_cache_bytes
+    if version is None or response.status_code != 200: return response
+    body = None if response.is_streamed else response.get_data()
+    if LISTING_CACHE_SIZE > 0 and body is not None and len(body) <= min(LISTING_CACHE_MAX_BYTES, LISTING_CACHE_TOTAL_BYTES):
+        with _listing_cache_lock:
+            previous = _listing_cache.pop(version["key"], None)
+            if previous: _listing_cache_bytes -= len(previous[2])
+            _listing_cache[version["key"]] = (version["etag"], version["last_modified"], body)
+            _listing_cache_bytes += len(body)
+            while len(_listing_cache) > LISTING_CACHE_SIZE or _listing_cache_bytes > LISTING_CACHE_TOTAL_BYTES:
+                _listing_cache_bytes -= len(_listing_cache.popitem(last=False)[1][2])
+    return _listing_headers(response, version)
+
+# ---- Cache kết quả theo kỳ (dòng Excel xuất, phiên bản danh sách của kỳ đã đóng) ----
+# Kỳ đã đóng của chấm công coi như không đổi: khoá chỉ gồm tham số. Kỳ đang mở thêm mốc dữ liệu mới nhất
+# (_id lớn nhất của check-in, mốc job bảng tổng hợp), có check-in mới thì khoá đổi. Đơn nghỉ luôn kèm mốc
+# _id/ApprovalDate vì đơn của kỳ cũ vẫn có thể được duyệt sau.
+result_cache = make_result_cache(
+    RESULT_CACHE_URL, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+    closed_ttl=RESULT_CACHE_CLOSED_TTL, open_ttl=RESULT_CACHE_OPEN_TTL
+)
+
+def period_is_closed(end_day):
+    """Kỳ kết thúc trước tháng hiện tại (giờ VN) và đã qua PERIOD_CLOSE_GRACE_DAYS ngày (dữ liệu đồng bộ trễ)."""
+    end = _as_day(end_day) if end_day else None
+    if end is None: return False
+    today = datetime.now(VN_TZ)
+    return end < datetime(today.year, today.month, 1) and end + timedelta(days=PERIOD_CLOSE_GRACE_DAYS) < datetime(today.year, today.month, today.day)
+
+def _latest_value(collection, field, query=None):
+    """Giá trị lớn nhất của field (đọc một phần tử cuối của index)."""
+    doc = collection.find_one(query or {}, {field: 1}, sort=[(field, DESCENDING)])
+    return doc.get(field) if doc else None
+
+def attendance_data_marker(db):
+    # _id tăng theo thứ tự ghi; Timestamp dạng chuỗi cũ luôn đứng trước mọi BSON date nên không làm đổi max(Timestamp)
+    latest = _latest_value(db["alt_checkins"], "_id", {"CheckType": {"$in": ["checkin", "checkout"]}})
+    return [latest, _load_high_water_mark(db, SUMMARY_STATE_ID) if ATTENDANCE_SUMMARY_ENABLED else None]
+
+def leave_data_marker(db):
+    """Đơn mới nhất (_id) và lần duyệt mới nhất: đơn cũ vẫn có thể được duyệt sau."""
+    return [_latest_value(db["alt_checkins"], field) for field in ("_id", "ApprovalDate1", "ApprovalDate2")]
+
+@app.route("/api/cache-stats", methods=["GET"])
+def cache_stats():
+    username, error = get_request_user()
+    if error: return error
+    if username is not None: return jsonify({"error": "Chỉ admin xem được thống kê cache"}), 403
+    return jsonify(result_cache.stats())
+
 # ---- API lấy dữ liệu chấm công ----
+def attendance_summary_hours(items):
+    return get_summary_hours(get_db(), {(item.get("EmployeeId"), item.get("CheckinDate")) for item in items})
+
+def add_attendance_hours(items, daily_hours_map, monthly_hours_map):
+    """Gắn giờ làm trong ngày, cộng dồn tháng và giờ check-in (giờ VN) cho từng bản ghi."""
+    for item in items:
+        emp_id, date_str = item.get("EmployeeId"), item.get("CheckinDate")
+        daily_sec = daily_hours_map.get((emp_id, date_str), 0)
+        item['DailyHours'], item['_dailySeconds'] = format_seconds(daily_sec), daily_sec
+        monthly_sec = monthly_hours_map.get((emp_id, date_str), 0)
+        item['MonthlyHours'], item['_monthlySeconds'] = format_seconds(monthly_sec), monthly_sec
+        if item.get('Timestamp'):
+            timestamp = to_vn_time(item['Timestamp'])
+            item['CheckinTime'] = timestamp.strftime('%H:%M:%S') if timestamp else ""
+    return items
+
 @app.route("/api/attendances", methods=["GET"])
 def get_attendances():
     try:
-        email = request.args.get("email")
-        # CẬP NHẬT: Dùng get_collection
-        admins_col = get_collection("admins")
-        users_col = get_collection("users")
-        
-        admin = admins_col.find_one({"email": email})
-        user = users_col.find_one({"email": email})
-        
-        if not admin and not user: return jsonify({"error": "🚫 Email không tồn tại"}), 403
-        username = None if admin else user["username"]
-        query = build_attendance_query(
-            request.args.get("filter", "hôm nay").lower(),
-            request.args.get("startDate"), request.args.get("endDate"),
-            request.args.get("search", "").strip(), username=username
-        )
+        username, error = get_request_user()
+        if error: return error
+        filter_args = (request.args.get("filter", "hôm nay").lower(), request.args.get("startDate"),
+                       request.args.get("endDate"), request.args.get("search", "").strip())
+        query = build_attendance_query(*filter_args, username=username)
         
         # CẬP NHẬT: Dùng get_collection("alt_checkins")
         alt_checkins_col = get_collection("alt_checkins")
-        all_relevant_data = list(alt_checkins_col.find(query, {"_id": 0}))
-        
-        daily_hours_map, monthly_hours_map = {}, {}
-        emp_data = {}
-        for rec in all_relevant_data:
-            emp_id = rec.get("EmployeeId")
-            if emp_id: emp_data.setdefault(emp_id, []).append(rec)
-        
-        for emp_id, records in emp_data.items():
-            daily_groups = {}
-            for rec in records:
-                date_str = rec.get("CheckinDate")
-                if date_str: daily_groups.setdefault(date_str, []).append(rec)
-            
-            for date_str, day_records in daily_groups.items():
-                checkins = []
-                for r in day_records:
-                    if r.get('CheckType') == 'checkin' and r.get('Timestamp'):
-                        try:
-                            if isinstance(r['Timestamp'], str):
-                                timestamp = datetime.strptime(r['Timestamp'], "%Y-%m-%d %H:%M:%S")
-                            elif isinstance(r['Timestamp'], datetime):
-                                timestamp = r['Timestamp']
-                            else:
-                                continue
-                            checkins.append(timestamp)
-                        except (ValueError, TypeError):
-                            continue
-                checkins = sorted(checkins)
-                checkouts = []
-                for r in day_records:
-                    if r.get('CheckType') == 'checkout' and r.get('Timestamp'):
-                        try:
-                            if isinstance(r['Timestamp'], str):
-                                timestamp = datetime.strptime(r['Timestamp'], "%Y-%m-%d %H:%M:%S")
-                            elif isinstance(r['Timestamp'], datetime):
-                                timestamp = r['Timestamp']
-                            else:
-                                continue
-                            checkouts.append(timestamp)
-                        except (ValueError, TypeError):
-                            continue
-                checkouts = sorted(checkouts)
-                daily_seconds = 0
-                if checkins and checkouts and checkouts[-1] > checkins[0]:
-                    daily_seconds = (checkouts[-1] - checkins[0]).total_seconds()
-                daily_hours_map[(emp_id, date_str)] = daily_seconds
-                
-                h, rem = divmod(daily_seconds, 3600)
-                m, s = divmod(rem, 60)
-                daily_hours = f"{int(h)}h {int(m)}m {int(s)}s" if daily_seconds > 0 else ""
-                
-                # CẬP NHẬT: Dùng alt_checkins_col để update
-                alt_checkins_col.update_many(
-                    {"EmployeeId": emp_id, "CheckinDate": date_str, "CheckType": {"$in": ["checkin", "checkout"]}},
-                    {"$set": {"DailyHours": daily_hours, "_dailySeconds": daily_seconds}}
-                )
-            
-            monthly_groups = {}
-            for (map_emp_id, map_date_str), daily_seconds in daily_hours_map.items():
-                if map_emp_id == emp_id:
-                    try: month_key = datetime.strptime(map_date_str, "%d/%m/%Y").strftime("%Y-%m")
-                    except: continue
-                    monthly_groups.setdefault(month_key, []).append((map_date_str, daily_seconds))
-            
-            for month, days in monthly_groups.items():
-                sorted_days = sorted(days, key=lambda x: datetime.strptime(x[0], "%d/%m/%Y"))
-                running_total = 0
-                for date_str, daily_seconds in sorted_days:
-                    running_total += daily_seconds
-                    monthly_hours_map[(emp_id, date_str)] = running_total
-                    h, rem = divmod(running_total, 3600)
-                    m, s = divmod(rem, 60)
-                    monthly_hours = f"{int(h)}h {int(m)}m {int(s)}s" if running_total > 0 else ""
-                    
-                    # CẬP NHẬT: Dùng alt_checkins_col để update
-                    alt_checkins_col.update_many(
-                        {"EmployeeId": emp_id, "CheckinDate": date_str, "CheckType": {"$in": ["checkin", "checkout"]}},
-                        {"$set": {"MonthlyHours": monthly_hours, "_monthlySeconds": running_total}}
-                    )
+        # Giờ làm đọc từ bảng tổng hợp (khi bảng đã cập nhật tới check-in mới nhất) thì phiên bản
+        # gồm cả mốc của job cập nhật bảng đó
+        summary_mark = current_summary_mark(get_db())
+        closed = request.args.get("filter", "").lower() == "custom" and period_is_closed(request.args.get("endDate"))
+        version = listing_version(alt_checkins_col, query, ATTENDANCE_VERSION_FIELDS, username, extra=summary_mark, closed=closed)
+        cached = cached_listing(version)
+        if cached: return cached
+        paging = get_paging_args(ATTENDANCE_SORT_FIELDS, "Timestamp")
+        projection = list_projection(ATTENDANCE_LIST_FIELDS, ATTENDANCE_REQUIRED_FIELDS, photo_flag=True)
+        if not paging and wants_ndjson():
+            # Giờ làm từ bảng tổng hợp đọc theo từng lô; tính bằng aggregation thì tính một lần trước khi gửi
+            hours = None if summary_mark else get_attendance_hours(
+                alt_checkins_col, attendance_hours_query(*filter_args, username=username), engine=HOURS_ENGINE)
+            def prepare(batch): add_attendance_hours(batch, *(hours or attendance_summary_hours(batch)))
+            return store_listing(version, ndjson_response(alt_checkins_col.find(query, projection), prepare))
+        if paging:
+            all_relevant_data, total, next_cursor = find_page(alt_checkins_col, query, projection, paging)
+        else:
+            all_relevant_data = with_public_ids(list(alt_checkins_col.find(query, projection)))
         
-        for item in all_relevant_data:
-            emp_id, date_str = item.get("EmployeeId"), item.get("CheckinDate")
-            daily_sec = daily_hours_map.get((emp_id, date_str), 0)
-            h, rem = divmod(daily_sec, 3600)
-            m, s = divmod(rem, 60)
-            item['DailyHours'], item['_dailySeconds'] = (f"{int(h)}h {int(m)}m {int(s)}s" if daily_sec > 0 else ""), daily_sec
-            monthly_sec = monthly_hours_map.get((emp_id, date_str), 0)
-            h, rem = divmod(monthly_sec, 3600)
-            m, s = divmod(rem, 60)
-            item['MonthlyHours'], item['_monthlySeconds'] = (f"{int(h)}h {int(m)}m {int(s)}s" if monthly_sec > 0 else ""), monthly_sec
-            if item.get('Timestamp'):
-                try:
-                    if isinstance(item['Timestamp'], str):
-                        timestamp = datetime.strptime(item['Timestamp'], "%Y-%m-%d %H:%M:%S")
-                    elif isinstance(item['Timestamp'], datetime):
-                        timestamp = item['Timestamp']
-                    else:
-                        timestamp = None
-                    item['CheckinTime'] = timestamp.astimezone(VN_TZ).strftime('%H:%M:%S') if timestamp else ""
-                except (ValueError, TypeError):
-                    item['CheckinTime'] = ""
-        return jsonify(all_relevant_data)
+        # Chỉ đọc: giờ làm lấy từ daily_attendance_summary (hoặc tính bằng aggregation nếu tắt/chưa cập nhật),
+        # việc ghi DailyHours/MonthlyHours vào DB do job materialize_attendance_hours đảm nhiệm.
+        if summary_mark:
+            daily_hours_map, monthly_hours_map = attendance_summary_hours(all_relevant_data)
+        else:
+            daily_hours_map, monthly_hours_map = get_attendance_hours(
+                alt_checkins_col, attendance_hours_query(*filter_args, username=username), engine=HOURS_ENGINE)
+        add_attendance_hours(all_relevant_data, daily_hours_map, monthly_hours_map)
+        if paging: return store_listing(version, paged_response(all_relevant_data, total, paging, next_cursor))
+        return store_listing(version, jsonify(all_relevant_data))
     except Exception as e:
         print(f"❌ Lỗi tại get_attendances: {e}")
         return jsonify({"error": str(e)}), 500
 
+# ---- API ảnh check-in (tải riêng, có cache phía trình duyệt) ----
+PHOTO_CACHE_MAX_AGE = int(os.getenv("PHOTO_CACHE_MAX_AGE", "86400"))
+
+@app.route("/api/attendances/<record_id>/photo", methods=["GET"])
+def get_attendance_photo(record_id):
+    try:
+        username, error = get_request_user()
+        if error: return error
+
+        try: query = {"_id": ObjectId(record_id)}
+        except InvalidId: return jsonify({"error": "Không tìm thấy ảnh"}), 404
+        if username: query["EmployeeName"] = username
+        cache_control = f"private, max-age={PHOTO_CACHE_MAX_AGE}, immutable"
+
+        # Ảnh của một lần check-in không đổi: ETag là id bản ghi, trình duyệt đã có thì khỏi đọc ảnh từ DB
+        if record_id in request.if_none_match and get_collection("alt_checkins").count_documents(query, limit=1):
+            response = Response(status=304)
+            response.set_etag(record_id)
+            response.headers["Cache-Control"] = cache_control
+            return response
+
+        doc = get_collection("alt_checkins").find_one(query, {field: 1 for field in IMAGE_FIELDS})
+        for field in IMAGE_FIELDS:
+            value = (doc or {}).get(field)
+            if isinstance(value, str) and value.startswith(("http://", "https://")):
+                response = redirect(value)
+            else:
+                decoded = decode_image_field(value)
+                if not decoded: continue
+                response = Response(decoded[0], mimetype=decoded[1])
+                response.set_etag(record_id)
+            response.headers["Cache-Control"] = cache_control
+            return response
+        return jsonify({"error": "Không tìm thấy ảnh"}), 404
+    except Exception as e:
+        print(f"❌ Lỗi tại get_attendance_photo: {e}")
+        return jsonify({"error": str(e)}), 500
+
 # ---- API lấy dữ liệu nghỉ phép ----
+def leave_filter_window(filter_type, start_date_str, end_date_str):
+    """(ngày đầu, ngày cuối) của bộ lọc theo ngày nghỉ, None nếu không xác định được."""
+    filter_start_dt, filter_end_dt = None, None
+    today = datetime.now(VN_TZ)
+    if filter_type == "custom" and start_date_str and end_date_str:
+        try:
+            filter_start_dt = datetime.strptime(start_date_str, "%Y-%m-%d").date()
+            filter_end_dt = datetime.strptime(end_date_str, "%Y-%m-%d").date()
+        except (ValueError, TypeError): pass
+    else:
+        if filter_type == "hôm nay": filter_start_dt = filter_end_dt = today.date()
+        elif filter_type == "tuần":
+            filter_start_dt = (today - timedelta(days=today.weekday())).date()
+            filter_end_dt = (filter_start_dt + timedelta(days=6))
+        elif filter_type == "tháng":
+            filter_start_dt = today.replace(day=1).date()
+            _, last_day = calendar.monthrange(today.year, today.month)
+            filter_end_dt = today.replace(day=last_day).date()
+        elif filter_type == "năm":
+            filter_start_dt = today.replace(month=1, day=1).date()
+            filter_end_dt = today.replace(month=12, day=31).date()
+    if not filter_start_dt or not filter_end_dt: return None
+    return _as_day(filter_start_dt), _as_day(filter_end_dt)
+
+def format_leave_items(items):
+    """Định dạng đơn nghỉ để hiển thị: ngày duyệt, trạng thái, thời gian tạo (giờ VN), ngày nghỉ dd/mm/YYYY, lý do."""
+    def reformat_date(match):
+        return datetime.strptime(match.group(0), "%Y-%m-%d").strftime("%d/%m/%Y")
+    for item in items:
+        item["ApprovalDate1"] = get_formatted_approval_date(item.get("ApprovalDate1"))
+        item["ApprovalDate2"] = get_formatted_approval_date(item.get("ApprovalDate2"))
+        item["Status1"] = item.get("Status1", "")
+        item["Status2"] = item.get("Status2", "")
+        item["Note"] = item.get("LeaveNote", "")
+        timestamp = to_vn_time(item.get('CreationTime'))
+        item['CheckinTime'] = timestamp.strftime('%d/%m/%Y %H:%M:%S') if timestamp else ""
+
+        display_date = item.get('DisplayDate', "")
+        if display_date:
+            display_date = re.sub(r"\d{4}-\d{2}-\d{2}", reformat_date, display_date)
+
+        item['CheckinDate'] = display_date
+        tasks = item.get("Tasks", [])
+        tasks_str = (", ".join(tasks) if isinstance(tasks, list) else str(tasks or "")).replace("Nghỉ phép: ", "")
+        item['Tasks'] = item.get("Reason") or tasks_str
+    return items
+
 @app.route("/api/leaves", methods=["GET"])
 def get_leaves():
     try:
-        email = request.args.get("email")
-        # CẬP NHẬT: Dùng get_collection
-        admin = get_collection("admins").find_one({"email": email})
-        user = get_collection("users").find_one({"email": email})
-        if not admin and not user: return jsonify({"error": "🚫 Email không tồn tại"}), 403
-        
-        username = None if admin else user["username"]
+        username, error = get_request_user()
+        if error: return error
         date_type = request.args.get("dateType", "CheckinDate")
         filter_type = request.args.get("filter", "tất cả").lower()
         start_date_str = request.args.get("startDate")
@@ -536,82 +1217,43 @@ def get_leaves():
         query = build_leave_query(filter_type, start_date_str, end_date_str, search, date_type, username=username)
         
         # CẬP NHẬT: Dùng get_collection("alt_checkins")
-        data = list(get_collection("alt_checkins").find(query, {"_id": 0}))
-
-        # ... (Logic xử lý date_type == "LeaveDate" giữ nguyên) ...
+        leaves_col = get_collection("alt_checkins")
+        version = listing_version(leaves_col, query, LEAVE_VERSION_FIELDS, username)
+        cached = cached_listing(version)
+        if cached: return cached
+        paging = get_paging_args(LEAVE_SORT_FIELDS, "CreationTime")
+        # Lọc theo ngày nghỉ: build_leave_query đã lọc theo LeaveStart/LeaveEnd, chỉ còn đơn chưa backfill cần lọc ở đây
+        leave_window = None
         if date_type == "LeaveDate" and filter_type != "tất cả":
-            filter_start_dt, filter_end_dt = None, None
-            today = datetime.now(VN_TZ)
-            if filter_type == "custom" and start_date_str and end_date_str:
-                try:
-                    filter_start_dt = datetime.strptime(start_date_str, "%Y-%m-%d").date()
-                    filter_end_dt = datetime.strptime(end_date_str, "%Y-%m-%d").date()
-                except (ValueError, TypeError): pass
-            else:
-                if filter_type == "hôm nay": filter_start_dt = filter_end_dt = today.date()
-                elif filter_type == "tuần":
-                    filter_start_dt = (today - timedelta(days=today.weekday())).date()
-                    filter_end_dt = (filter_start_dt + timedelta(days=6))
-                elif filter_type == "tháng":
-                    filter_start_dt = today.replace(day=1).date()
-                    _, last_day = calendar.monthrange(today.year, today.month)
-                    filter_end_dt = today.replace(day=last_day).date()
-                elif filter_type == "năm":
-                    filter_start_dt = today.replace(month=1, day=1).date()
-                    filter_end_dt = today.replace(month=12, day=31).date()
-
-            if filter_start_dt and filter_end_dt:
-                filtered_data = []
-                for item in data:
-                    display_date = item.get("DisplayDate", "")
-                    if not display_date: continue
-                    record_start_dt, record_end_dt = None, None
-                    try:
-                        if "đến" in display_date:
-                            dates = re.findall(r"\d{4}-\d{2}-\d{2}", display_date)
-                            if len(dates) == 2:
-                                record_start_dt = datetime.strptime(dates[0], "%Y-%m-%d").date()
-                                record_end_dt = datetime.strptime(dates[1], "%Y-%m-%d").date()
-                        else:
-                            date_part = display_date.split()[0]
-                            record_start_dt = record_end_dt = datetime.strptime(date_part, "%Y-%m-%d").date()
-                        
-                        if record_start_dt and record_end_dt:
-                            if record_start_dt <= filter_end_dt and record_end_dt >= filter_start_dt:
-                                filtered_data.append(item)
-                    except (ValueError, TypeError, IndexError): continue
-                data = filtered_data
+            leave_window = leave_filter_window(filter_type, start_date_str, end_date_str)
+        next_cursor = None
+        projection = list_projection(LEAVE_LIST_FIELDS, LEAVE_REQUIRED_FIELDS)
+        if not paging and wants_ndjson():
+            leaves = leaves_col.find(query, projection)
+            if leave_window: leaves = (item for item in leaves if leave_matches_range(item, *leave_window))
+            return store_listing(version, ndjson_response(leaves, format_leave_items))
+        if paging and not leave_window:
+            data, total, next_cursor = find_page(leaves_col, query, projection, paging)
+        elif paging:
+            # Lọc theo ngày nghỉ còn làm bằng Python: sắp xếp trong MongoDB, phân trang sau khi lọc
+            data = with_public_ids(list(leaves_col.find(query, projection).sort(
+                [(paging["sort"], paging["direction"]), ("_id", paging["direction"])])))
+        else:
+            data = with_public_ids(list(leaves_col.find(query, projection)))
+
+        if leave_window:
+            data = [item for item in data if leave_matches_range(item, *leave_window)]
+            if paging:
+                total = len(data)
+                offset = (paging["page"] - 1) * paging["page_size"]
+                data = data[offset:offset + paging["page_size"]]
 
         if not data:
-            return jsonify([])
-
-        for item in data:
-            item["ApprovalDate1"] = get_formatted_approval_date(item.get("ApprovalDate1"))
-            item["ApprovalDate2"] = get_formatted_approval_date(item.get("ApprovalDate2"))
-            item["Status1"] = item.get("Status1", "")
-            item["Status2"] = item.get("Status2", "")
-            item["Note"] = item.get("LeaveNote", "")
-            if item.get('CreationTime'):
-                try:
-                    timestamp = item['CreationTime'] if isinstance(item['CreationTime'], datetime) else datetime.fromisoformat(item['CreationTime'].replace('Z', '+00:00'))
-                    item['CheckinTime'] = timestamp.astimezone(VN_TZ).strftime('%d/%m/%Y %H:%M:%S')
-                except (ValueError, TypeError):
-                    item['CheckinTime'] = ""
-            else:
-                item['CheckinTime'] = ""
-            
-            display_date = item.get('DisplayDate', "")
-            if display_date:
-                def reformat_date(match):
-                    return datetime.strptime(match.group(0), "%Y-%m-%d").strftime("%d/%m/%Y")
-                display_date = re.sub(r"\d{4}-\d{2}-\d{2}", reformat_date, display_date)
-            
-            item['CheckinDate'] = display_date
-            tasks = item.get("Tasks", [])
-            tasks_str = (", ".join(tasks) if isinstance(tasks, list) else str(tasks or "")).replace("Nghỉ phép: ", "")
-            item['Tasks'] = item.get("Reason") or tasks_str
-
-        return jsonify(data)
+            return store_listing(version, paged_response([], total, paging) if paging else jsonify([]))
+
+        format_leave_items(data)
+        if paging: return store_listing(version, paged_response(data, total, paging, next_cursor))
+        return store_listing(version, jsonify(data))
     except Exception as e:
         import traceback
         print(f"❌ Lỗi tại get_leaves: {e}")
@@ -655,200 +1297,170 @@ def get_export_filename(prefix, start_date, end_date, export_date_str):
         return f"{prefix} {file_prefix}_{export_date_str}.xlsx"
     except: return f"{prefix} {start_date} đến {end_date}_{export_date_str}.xlsx"
 
-def add_leave_date_filter(conditions, start_date, end_date):
-    # ... (Giữ nguyên hàm này) ...
-    try:
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-        query_start = start_dt.replace(day=1).strftime("%Y-%m-%d")
-        conditions.append({
-            "$or": [
-                {"LeaveDate": {"$gte": query_start, "$lte": end_date}},
-                {"StartDate": {"$gte": query_start, "$lte": end_date}},
-                {"EndDate": {"$gte": query_start, "$lte": end_date}},
-                {"$and": [{"StartDate": {"$lte": end_date}}, {"EndDate": {"$gte": query_start}}]}
-            ]
-        })
-    except: pass
+def _as_day(value):
+    """datetime/chuỗi 'YYYY-MM-DD...' -> datetime 00:00 của ngày đó (None nếu không hợp lệ)."""
+    if isinstance(value, datetime): return datetime(value.year, value.month, value.day)
+    try: return datetime.strptime(str(value).strip()[:10], "%Y-%m-%d")
+    except ValueError: return None
+
+def parse_leave_interval(doc):
+    """
+    (ngày bắt đầu, ngày kết thúc) của một đơn nghỉ, dạng datetime 00:00; None nếu không xác định được.
+    Ưu tiên DisplayDate ('YYYY-MM-DD ...' hoặc 'Từ YYYY-MM-DD đến YYYY-MM-DD'),
+    sau đó StartDate/EndDate, cuối cùng LeaveDate.
+    """
+    display_date = str(doc.get("DisplayDate") or "").strip()
+    dates = re.findall(r"\d{4}-\d{2}-\d{2}", display_date)
+    if "đến" in display_date and len(dates) >= 2: values = dates[:2]
+    elif re.match(r"\d{4}-\d{2}-\d{2}", display_date): values = [dates[0], dates[0]]
+    elif display_date: return None
+    elif doc.get("StartDate") or doc.get("EndDate"):
+        values = [doc.get("StartDate") or doc.get("EndDate"), doc.get("EndDate") or doc.get("StartDate")]
+    elif doc.get("LeaveDate"): values = [doc["LeaveDate"], doc["LeaveDate"]]
+    else: return None
+    start, end = _as_day(values[0]), _as_day(values[1])
+    if start is None or end is None: return None
+    return (start, end) if start <= end else (end, start)
+
+def add_leave_date_filter(conditions, start_day, end_day):
+    """
+    Đơn nghỉ có [LeaveStart, LeaveEnd] giao với [start_day, end_day]: truy vấn khoảng trên index
+    leaveend_leavestart. Đơn chưa có LeaveStart (chưa backfill) vẫn được trả về, qua index
+    leavestart_displaydate, để lọc tiếp bằng is_leave_in_range.
+    """
+    start, end = _as_day(start_day), _as_day(end_day)
+    conditions.append({"$or": [
+        {"LeaveEnd": {"$gte": start}, "LeaveStart": {"$lte": end}},
+        {"LeaveStart": None, "DisplayDate": {"$gt": ""}}
+    ]})
 
 def is_leave_in_range(display_date, start_dt, end_dt):
-    # ... (Giữ nguyên hàm này) ...
-    if not display_date: return False
-    display_date = display_date.strip()
-    record_start = record_end = None
-    match_single = re.match(r"(\d{4}-\d{2}-\d{2})", display_date)
-    if match_single:
-        try: record_start = record_end = datetime.strptime(match_single.group(1), "%Y-%m-%d")
-        except: return False
+    interval = parse_leave_interval({"DisplayDate": display_date})
+    if interval is None: return False
+    return interval[0] <= end_dt and interval[1] >= start_dt
+
+def leave_matches_range(rec, start_dt, end_dt):
+    """Kết quả của add_leave_date_filter: đơn đã có LeaveStart đã được lọc trong MongoDB."""
+    return rec.get("LeaveStart") is not None or is_leave_in_range(rec.get("DisplayDate", ""), start_dt, end_dt)
+
+# ---- Xuất Excel: dựng dữ liệu từng sheet (dùng chung cho cả ba route) ----
+ATTENDANCE_TEMPLATE = "templates/Copy of Form chấm công.xlsx"
+LEAVE_TEMPLATE = "templates/Copy of Form nghỉ phép.xlsx"
+COMBINED_TEMPLATE = "templates/Form kết hợp.xlsx"
+LEAVE_COLUMNS = 9
+# "stream": workbook write-only, bộ nhớ không tăng theo số dòng; "template": ghi vào file mẫu như cũ
+EXCEL_EXPORT_MODE = os.getenv("EXCEL_EXPORT_MODE", "stream")
+# Dựng dòng chấm công song song theo nhân viên (export_rows): số process ("auto" = số CPU, 0/1 = tuần tự),
+# chỉ dùng khi có từ EXPORT_PARALLEL_MIN_RECORDS bản ghi. Mặc định tắt: mỗi worker gunicorn có pool riêng
+# và chi phí pickle bản ghi/dòng qua lại, chỉ bật khi đo được nhanh hơn (benchmarks/check_parallel_export.py).
+EXPORT_PROCESSES = os.getenv("EXPORT_PROCESSES", "0")
+EXPORT_PROCESSES = (os.cpu_count() or 1) if EXPORT_PROCESSES == "auto" else int(EXPORT_PROCESSES)
+EXPORT_PARALLEL_MIN_RECORDS = int(os.getenv("EXPORT_PARALLEL_MIN_RECORDS", "20000"))
+
+def build_attendance_sheet(db, start_date, end_date, search, username):
+    """
+    Truy vấn check-in trong [start_date, end_date], lấy giờ làm và gom theo (nhân viên, ngày).
+    Không dùng request/g nên chạy được trong thread khác. Trả về các dòng của sheet chấm công
+    (generator; list nếu dựng song song bằng process pool).
+    """
+    alt_checkins_col = db["alt_checkins"]
+    attendance_query = build_attendance_query("custom", start_date, end_date, search, username=username, db=db)
+    data = list(alt_checkins_col.find(attendance_query, NO_IMAGE_PROJECTION))
+    start_day = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end_day = datetime.strptime(end_date, "%Y-%m-%d").date()
+
+    # Giờ làm (cộng dồn từ đầu tháng) lấy từ bảng tổng hợp, hoặc tính bằng aggregation nếu tắt/chưa cập nhật.
+    # Query theo Timestamp giờ VN nên ngày của mọi bản ghi nằm trong [start_day, end_day]: đọc theo
+    # (nhân viên, từng ngày trong khoảng) thay vì đổi giờ từng bản ghi trước khi gom nhóm.
+    if current_summary_mark(db):
+        days = [(start_day + timedelta(days=offset)).strftime("%d/%m/%Y") for offset in range((end_day - start_day).days + 1)]
+        daily_hours_map, monthly_hours_map = get_summary_hours(
+            db, {(emp_id, day) for emp_id in {rec.get("EmployeeId") for rec in data} for day in days})
     else:
-        match_range = re.match(r"Từ\s+(\d{4}-\d{2}-\d{2})\s+đến\s+(\d{4}-\d{2}-\d{2})", display_date)
-        if match_range:
-            try:
-                record_start = datetime.strptime(match_range.group(1), "%Y-%m-%d")
-                record_end = datetime.strptime(match_range.group(2), "%Y-%m-%d")
-            except: return False
-    if not record_start or not record_end: return False
-    return record_start <= end_dt and record_end >= start_dt
+        query_start = datetime.strptime(start_date, "%Y-%m-%d").replace(day=1).strftime("%Y-%m-%d")
+        hours_query = build_attendance_query("custom", query_start, end_date, search, username=username, db=db)
+        daily_hours_map, monthly_hours_map = get_attendance_hours(alt_checkins_col, hours_query, day_key="Timestamp", engine=HOURS_ENGINE)
+
+    processes = EXPORT_PROCESSES if len(data) >= EXPORT_PARALLEL_MIN_RECORDS else 1
+    return attendance_rows(data, start_day, end_day, daily_hours_map, monthly_hours_map, processes=processes)
+
+def cached_attendance_sheet(db, start_date, end_date, search, username):
+    """
+    Các dòng của build_attendance_sheet qua result_cache (kỳ đang mở: theo mốc check-in mới nhất).
+    Tắt cache thì trả về generator như build_attendance_sheet, không giữ cả sheet trong bộ nhớ.
+    """
+    if not result_cache.enabled: return build_attendance_sheet(db, start_date, end_date, search, username)
+    closed = period_is_closed(end_date)
+    return result_cache.get_or_compute(
+        "attendance_sheet", [start_date, end_date, search, username, HOURS_ENGINE, ATTENDANCE_SUMMARY_ENABLED],
+        lambda: list(build_attendance_sheet(db, start_date, end_date, search, username)),
+        closed, None if closed else lambda: attendance_data_marker(db))
+
+def leave_export_rows(leaves, export_year, export_month):
+    """Mỗi đơn nghỉ -> một dòng: ngày nghỉ, số ngày nghỉ trong tháng xuất, ngày tạo, lý do, duyệt, ghi chú."""
+    def reformat_date(match): return datetime.strptime(match.group(0), "%Y-%m-%d").strftime("%d/%m/%Y")
+    if HOURS_ENGINE == "pandas":
+        from attendance_frames import leave_days_for_month
+        month_days = leave_days_for_month(leaves, export_year, export_month)
+    else:
+        month_days = (calculate_leave_days_for_month(rec, export_year, export_month) for rec in leaves)
+    for rec, (leave_days, is_overlap) in zip(leaves, month_days):
+        timestamp_str = ""
+        if rec.get("CreationTime"):
+            dt = to_vn_time(rec['CreationTime'])
+            timestamp_str = dt.strftime('%d/%m/%Y %H:%M:%S') if dt else str(rec.get("CreationTime"))
+        tasks_str = (", ".join(rec.get("Tasks", [])) if isinstance(rec.get("Tasks"), list) else str(rec.get("Tasks", ""))).replace("Nghỉ phép: ", "")
+        yield [
+            rec.get("EmployeeId", ""), rec.get("EmployeeName", ""),
+            re.sub(r"\d{4}-\d{2}-\d{2}", reformat_date, rec.get("DisplayDate", "").strip()),
+            leave_days if is_overlap else 0, timestamp_str, rec.get("Reason") or tasks_str,
+            get_formatted_approval_date(rec.get("ApprovalDate2")), rec.get("Status2", ""), rec.get("LeaveNote", "")
+        ]
+
+def find_export_leaves(db, start_dt, end_dt, search, username):
+    """Các đơn nghỉ phép giao với [start_dt, end_dt], theo thứ tự MongoDB trả về."""
+    base_conditions = [{"DisplayDate": {"$exists": True, "$ne": ""}}]
+    add_search_condition(base_conditions, search, db)
+    if username:
+        base_conditions.append({"EmployeeName": username})
+    add_leave_date_filter(base_conditions, start_dt, end_dt)
+
+    return [
+        rec for rec in db["alt_checkins"].find({"$and": base_conditions}, NO_IMAGE_PROJECTION)
+        if leave_matches_range(rec, start_dt, end_dt)
+    ]
+
+def build_leave_sheet(db, start_dt, end_dt, search, username, export_year, export_month):
+    """Đơn nghỉ phép giao với [start_dt, end_dt] -> generator các dòng của sheet nghỉ phép (chạy được trong thread khác)."""
+    return leave_export_rows(find_export_leaves(db, start_dt, end_dt, search, username), export_year, export_month)
+
+def cached_leave_sheet(db, start_dt, end_dt, search, username, export_year, export_month):
+    """Các dòng của build_leave_sheet qua result_cache, luôn theo mốc tạo/duyệt đơn mới nhất (tắt cache: generator)."""
+    if not result_cache.enabled: return build_leave_sheet(db, start_dt, end_dt, search, username, export_year, export_month)
+    return result_cache.get_or_compute(
+        "leave_sheet", [start_dt, end_dt, search, username, export_year, export_month],
+        lambda: list(build_leave_sheet(db, start_dt, end_dt, search, username, export_year, export_month)),
+        period_is_closed(end_dt), lambda: leave_data_marker(db))
+
+def send_export(template_path, sheets, prefix, start_date, end_date):
+    with metrics_step("excel"):
+        output = export_workbook(template_path, sheets, mode=request.args.get("mode", EXCEL_EXPORT_MODE))
+    export_date_str = datetime.now(VN_TZ).strftime('%d-%m-%Y')
+    filename = get_export_filename(prefix, start_date, end_date, export_date_str)
+    return send_file(output, as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE)
 
 @app.route("/api/export-excel", methods=["GET"])
 def export_to_excel():
     try:
-        email = request.args.get("email")
-        if not email: return jsonify({"error": "Thiếu email"}), 400
-        # CẬP NHẬT: Dùng get_collection
-        admin = get_collection("admins").find_one({"email": email})
-        user = get_collection("users").find_one({"email": email})
-        if not admin and not user: return jsonify({"error": "Email không tồn tại"}), 403
-        username = None if admin else user.get("username")
+        username, error = get_request_user()
+        if error: return error
 
         start_date, end_date = get_export_date_range()
         if not start_date or not end_date: return jsonify({"error": "Thiếu thông tin ngày xuất"}), 400
 
-        try:
-            start_dt_for_query = datetime.strptime(start_date, "%Y-%m-%d")
-            query_start = start_dt_for_query.replace(day=1).strftime("%Y-%m-%d")
-        except Exception as e:
-            print(f"Lỗi khi parse start_date: {e}")
-            return jsonify({"error": "Lỗi định dạng ngày"}), 400
-        
         search = request.args.get("search", "").strip()
-        attendance_query = build_attendance_query("custom", query_start, end_date, search, username=username)
-        # CẬP NHẬT: Dùng get_collection("alt_checkins")
-        data = list(get_collection("alt_checkins").find(attendance_query, {"_id": 0}))
-
-        template_path = "templates/Copy of Form chấm công.xlsx"
-        wb = load_workbook(template_path)
-        ws = wb.active
-        border = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
-        align_left = Alignment(horizontal="left", vertical="center", wrap_text=True)
-
-        def get_vn_date_str(rec):
-            ts = rec.get("Timestamp")
-            if not ts: return None
-            try:
-                if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                ts_vn = ts.astimezone(VN_TZ)
-                return ts_vn.strftime("%d/%m/%Y")
-            except Exception: return None
-
-        emp_data = {}
-        for rec in data:
-            emp_id = rec.get("EmployeeId")
-            if emp_id:
-                rec["_vn_date_str"] = get_vn_date_str(rec)
-                if rec["_vn_date_str"]: emp_data.setdefault(emp_id, []).append(rec)
-
-        daily_hours_map = {}
-        for emp_id, records in emp_data.items():
-            daily_groups = {}
-            for rec in records:
-                date_str = rec.get("_vn_date_str") 
-                if date_str: daily_groups.setdefault(date_str, []).append(rec)
-
-            for date_str, day_records in daily_groups.items():
-                checkins = []
-                checkouts = []
-                for r in day_records:
-                    ts = r.get("Timestamp")
-                    if not ts: continue
-                    try:
-                        if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                        if r.get("CheckType") == "checkin": checkins.append(ts)
-                        elif r.get("CheckType") == "checkout": checkouts.append(ts)
-                    except: continue
-                
-                daily_seconds = 0
-                if checkins and checkouts:
-                    first_in = min(checkins)
-                    last_out = max(checkouts)
-                    if last_out > first_in: daily_seconds = (last_out - first_in).total_seconds()
-                daily_hours_map[(emp_id, date_str)] = daily_seconds
-
-        monthly_hours_map = {}
-        for emp_id in emp_data.keys():
-            emp_daily_totals = { date_str: secs for (e_id, date_str), secs in daily_hours_map.items() if e_id == emp_id }
-            monthly_groups = {}
-            for date_str, secs in emp_daily_totals.items():
-                try:
-                    month_key = datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m")
-                    monthly_groups.setdefault(month_key, []).append((date_str, secs))
-                except ValueError: continue
-
-            sorted_month_keys = sorted(monthly_groups.keys())
-            for month_key in sorted_month_keys:
-                month_days = monthly_groups[month_key]
-                sorted_days = sorted(month_days, key=lambda x: datetime.strptime(x[0], "%d/%m/%Y"))
-                running_total = 0
-                for date_str, daily_sec in sorted_days:
-                    running_total += daily_sec
-                    h, rem = divmod(running_total, 3600)
-                    m, s = divmod(rem, 60)
-                    monthly_hours_map[(emp_id, date_str)] = f"{int(h)}h {int(m)}m {int(s)}s" if running_total > 0 else ""
-
-        grouped = {}
-        for d in data:
-            date_str = d.get("_vn_date_str", "")
-            if not date_str: continue
-            try:
-                rec_date = datetime.strptime(date_str, "%d/%m/%Y")
-                start_dt_obj = datetime.strptime(start_date, "%Y-%m-%d")
-                end_dt_obj = datetime.strptime(end_date, "%Y-%m-%d")
-                if start_dt_obj.date() <= rec_date.date() <= end_dt_obj.date():
-                    key = (d.get("EmployeeId", ""), d.get("EmployeeName", ""), date_str)
-                    grouped.setdefault(key, []).append(d)
-            except: continue
-
-        start_row = 2
-        for i, ((emp_id, emp_name, date_str), records) in enumerate(grouped.items()):
-            row = start_row + i
-            ws.cell(row=row, column=1, value=emp_id)
-            ws.cell(row=row, column=2, value=emp_name)
-            ws.cell(row=row, column=3, value=date_str) 
-
-            daily_sec = daily_hours_map.get((emp_id, date_str), 0)
-            h_d, rem_d = divmod(daily_sec, 3600)
-            m_d, s_d = divmod(rem_d, 60)
-            ws.cell(row=row, column=14, value=f"{int(h_d)}h {int(m_d)}m {int(s_d)}s" if daily_sec > 0 else "")
-            ws.cell(row=row, column=15, value=monthly_hours_map.get((emp_id, date_str), ""))
-
-            checkin_counter = 0
-            for rec in sorted(records, key=lambda x: x.get("Timestamp") or datetime.min):
-                if rec.get("CheckType") == "checkin" and checkin_counter < 9:
-                    time_str = ""
-                    if rec.get("Timestamp"):
-                        try:
-                            ts = rec["Timestamp"]
-                            if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                            time_str = ts.astimezone(VN_TZ).strftime("%H:%M:%S")
-                        except: time_str = ""
-                    tasks_str = ", ".join(rec.get("Tasks", [])) if isinstance(rec.get("Tasks"), list) else str(rec.get("Tasks", ""))
-                    cell_value = "; ".join(filter(None, [time_str, rec.get("ProjectId", ""), tasks_str, rec.get("Address", ""), rec.get("CheckinNote", "")]))
-                    ws.cell(row=row, column=4 + checkin_counter, value=cell_value)
-                    checkin_counter += 1
-                elif rec.get("CheckType") == "checkout":
-                    time_str = ""
-                    if rec.get("Timestamp"):
-                        try:
-                            ts = rec["Timestamp"]
-                            if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                            time_str = ts.astimezone(VN_TZ).strftime("%H:%M:%S")
-                        except: time_str = ""
-                    tasks_str = ", ".join(rec.get("Tasks", [])) if isinstance(rec.get("Tasks"), list) else str(rec.get("Tasks", ""))
-                    cell_value = "; ".join(filter(None, [time_str, rec.get("ProjectId", ""), tasks_str, rec.get("Address", ""), rec.get("CheckinNote", "")]))
-                    ws.cell(row=row, column=13, value=cell_value)
-
-            for col in range(1, 16):
-                cell = ws.cell(row=row, column=col)
-                cell.border = border
-                cell.alignment = align_left
-
-        export_date_str = datetime.now(VN_TZ).strftime('%d-%m-%Y')
-        filename = get_export_filename("Chấm công", start_date, end_date, export_date_str)
-
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-        return send_file(output, as_attachment=True, download_name=filename, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        rows = cached_attendance_sheet(get_db(), start_date, end_date, search, username)
+        return send_export(ATTENDANCE_TEMPLATE, [(None, ATTENDANCE_COLUMNS, rows)], "Chấm công", start_date, end_date)
 
     except Exception as e:
         print(f"Lỗi export: {e}")
@@ -859,97 +1471,17 @@ def export_to_excel():
 @app.route("/api/export-leaves-excel", methods=["GET"])
 def export_leaves_to_excel():
     try:
-        email = request.args.get("email")
-        if not email: return jsonify({"error": "Thiếu email"}), 400
-        # CẬP NHẬT: Dùng get_collection
-        admin = get_collection("admins").find_one({"email": email})
-        user_doc = get_collection("users").find_one({"email": email})
-        username = None if admin else user_doc.get("username") if user_doc else None
-        if not admin and not user_doc: return jsonify({"error": "Email không tồn tại"}), 403
+        username, error = get_request_user()
+        if error: return error
 
         start_date, end_date = get_export_date_range()
         if not start_date or not end_date: return jsonify({"error": "Thiếu thông tin ngày xuất"}), 400
-
-        try:
-            start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-            end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-            export_year = start_dt.year
-            export_month = start_dt.month
-        except:
-            today = datetime.now(VN_TZ)
-            start_dt = end_dt = today
-            export_year = today.year
-            export_month = today.month
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
 
         search = request.args.get("search", "").strip()
-        base_conditions = [{"DisplayDate": {"$exists": True, "$ne": ""}}]
-        if search:
-            regex = re.compile(search, re.IGNORECASE)
-            base_conditions.append({"$or": [{"EmployeeId": regex}, {"EmployeeName": regex}]})
-        if username:
-            base_conditions.append({"EmployeeName": username})
-
-        query = {"$and": base_conditions}
-        # CẬP NHẬT: Dùng get_collection("alt_checkins")
-        all_leaves_data = list(get_collection("alt_checkins").find(query, {"_id": 0}))
-
-        filtered_leaves = []
-        for rec in all_leaves_data:
-            display_date = rec.get("DisplayDate", "").strip()
-            if is_leave_in_range(display_date, start_dt, end_dt):
-                filtered_leaves.append(rec)
-
-        template_path = "templates/Copy of Form nghỉ phép.xlsx"
-        wb = load_workbook(template_path)
-        ws = wb.active
-
-        headers = ["Mã NV", "Tên NV", "Ngày Nghỉ", "Số ngày nghỉ", "Ngày tạo đơn", "Lý do",
-                   "Ngày Duyệt/Từ chối", "Trạng thái", "Ghi chú"]
-        for i, h in enumerate(headers, 1): ws.cell(row=1, column=i, value=h)
-
-        border = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
-        align_left = Alignment(horizontal="left", vertical="center", wrap_text=True)
-        current_row = 2
-
-        for rec in filtered_leaves:
-            display_date_raw = rec.get("DisplayDate", "").strip()
-            leave_days, is_overlap = calculate_leave_days_for_month(rec, export_year, export_month)
-            def reformat_date(match): return datetime.strptime(match.group(0), "%Y-%m-%d").strftime("%d/%m/%Y")
-            display_date = re.sub(r"\d{4}-\d{2}-\d{2}", reformat_date, display_date_raw)
-
-            ws.cell(row=current_row, column=1, value=rec.get("EmployeeId", ""))
-            ws.cell(row=current_row, column=2, value=rec.get("EmployeeName", ""))
-            ws.cell(row=current_row, column=3, value=display_date)
-            ws.cell(row=current_row, column=4, value=leave_days if is_overlap else 0)
-
-            timestamp_str = ""
-            if rec.get("CreationTime"):
-                try:
-                    ct = rec['CreationTime']
-                    dt = ct if isinstance(ct, datetime) else datetime.fromisoformat(ct.replace('Z', '+00:00'))
-                    timestamp_str = dt.astimezone(VN_TZ).strftime('%d/%m/%Y %H:%M:%S')
-                except: timestamp_str = str(rec.get("CreationTime"))
-            ws.cell(row=current_row, column=5, value=timestamp_str)
-
-            tasks_str = (", ".join(rec.get("Tasks", [])) if isinstance(rec.get("Tasks"), list) else str(rec.get("Tasks", ""))).replace("Nghỉ phép: ", "")
-            ws.cell(row=current_row, column=6, value=rec.get("Reason") or tasks_str)
-            ws.cell(row=current_row, column=7, value=get_formatted_approval_date(rec.get("ApprovalDate2")))
-            ws.cell(row=current_row, column=8, value=rec.get("Status2", ""))
-            ws.cell(row=current_row, column=9, value=rec.get("LeaveNote", ""))
-
-            for col in range(1, 10):
-                cell = ws.cell(row=current_row, column=col)
-                cell.border = border
-                cell.alignment = align_left
-            current_row += 1
-
-        export_date_str = datetime.now(VN_TZ).strftime('%d-%m-%Y')
-        filename = get_export_filename("Nghỉ phép", start_date, end_date, export_date_str)
-
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-        return send_file(output, as_attachment=True, download_name=filename, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        rows = cached_leave_sheet(get_db(), start_dt, end_dt, search, username, start_dt.year, start_dt.month)
+        return send_export(LEAVE_TEMPLATE, [(None, LEAVE_COLUMNS, rows)], "Nghỉ phép", start_date, end_date)
 
     except Exception as e:
         print(f"Lỗi export leaves: {e}")
@@ -960,219 +1492,960 @@ def export_leaves_to_excel():
 @app.route("/api/export-combined-excel", methods=["GET"])
 def export_combined_to_excel():
     try:
-        email = request.args.get("email")
-        if not email: return jsonify({"error": "Thiếu email"}), 400
-        # CẬP NHẬT: Dùng get_collection
-        admin = get_collection("admins").find_one({"email": email})
-        user = get_collection("users").find_one({"email": email})
-        if not admin and not user: return jsonify({"error": "Email không tồn tại"}), 403
-        username = None if admin else user.get("username")
+        username, error = get_request_user()
+        if error: return error
 
         start_date, end_date = get_export_date_range()
         if not start_date or not end_date: return jsonify({"error": "Thiếu thông tin ngày xuất"}), 400
+        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
 
-        try:
-            start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-            end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-        except:
-            today = datetime.now(VN_TZ)
-            start_dt = end_dt = today
-
-        try:
-            start_dt_for_query = datetime.strptime(start_date, "%Y-%m-%d")
-            query_start = start_dt_for_query.replace(day=1).strftime("%Y-%m-%d")
-        except Exception as e:
-            print(f"Lỗi khi parse start_date: {e}")
-            return jsonify({"error": "Lỗi định dạng ngày"}), 400
-        
+        # Hai sheet độc lập: truy vấn và dựng dòng song song, thời gian ~ max(chấm công, nghỉ phép).
+        # copy_context: lệnh MongoDB trong thread phụ vẫn được tính vào request này (PROFILING_ENABLED)
         search = request.args.get("search", "").strip()
-        attendance_query = build_attendance_query("custom", query_start, end_date, search, username=username)
-        # CẬP NHẬT: Dùng get_collection("alt_checkins")
-        attendance_data = list(get_collection("alt_checkins").find(attendance_query, {"_id": 0}))
+        db = get_db()
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="export-sheet") as pool:
+            attendance_rows = pool.submit(copy_context().run, lambda: list(cached_attendance_sheet(db, start_date, end_date, search, username)))
+            leave_rows = pool.submit(copy_context().run, lambda: list(cached_leave_sheet(db, start_dt, end_dt, search, username, end_dt.year, end_dt.month)))
+            sheets = [
+                ("Điểm danh", ATTENDANCE_COLUMNS, attendance_rows.result()),
+                ("Nghỉ phép", LEAVE_COLUMNS, leave_rows.result())
+            ]
+        return send_export(COMBINED_TEMPLATE, sheets, "Báo cáo tổng hợp", start_date, end_date)
 
-        base_conditions = [{"DisplayDate": {"$exists": True, "$ne": ""}}]
-        if search:
-            regex = re.compile(search, re.IGNORECASE)
-            base_conditions.append({"$or": [{"EmployeeId": regex}, {"EmployeeName": regex}]})
-        if username: base_conditions.append({"EmployeeName": username})
+    except Exception as e:
+        print(f"Lỗi export combined: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
 
-        leave_query = {"$and": base_conditions}
-        # CẬP NHẬT: Dùng get_collection("alt_checkins")
-        all_leave_data = list(get_collection("alt_checkins").find(leave_query, {"_id": 0}))
-
-        leave_data = []
-        for rec in all_leave_data:
-            display_date = rec.get("DisplayDate", "").strip()
-            if is_leave_in_range(display_date, start_dt, end_dt): leave_data.append(rec)
-
-        template_path = "templates/Form kết hợp.xlsx"
-        wb = load_workbook(template_path)
-        border = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
-        align_left = Alignment(horizontal="left", vertical="center", wrap_text=True)
-
-        # ================= SHEET: ĐIỂM DANH =================
-        ws_att = wb["Điểm danh"]
-        def get_vn_date_str_att(rec):
-            ts = rec.get("Timestamp")
-            if not ts: return None
-            try:
-                if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                ts_vn = ts.astimezone(VN_TZ)
-                return ts_vn.strftime("%d/%m/%Y")
-            except Exception: return None
-
-        daily_hours_map = {}
-        emp_data = {}
-        for rec in attendance_data:
-            emp_id = rec.get("EmployeeId")
-            if emp_id:
-                rec["_vn_date_str"] = get_vn_date_str_att(rec)
-                if rec["_vn_date_str"]: emp_data.setdefault(emp_id, []).append(rec)
-
-        for emp_id, records in emp_data.items():
-            daily_groups = {}
-            for rec in records:
-                date_str = rec.get("_vn_date_str")
-                if date_str: daily_groups.setdefault(date_str, []).append(rec)
-
-            for date_str, day_records in daily_groups.items():
-                checkins = []
-                checkouts = []
-                for r in day_records:
-                    ts = r.get("Timestamp")
-                    if not ts: continue
-                    try:
-                        if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                        if r.get("CheckType") == "checkin": checkins.append(ts)
-                        elif r.get("CheckType") == "checkout": checkouts.append(ts)
-                    except: continue
-                daily_seconds = 0
-                if checkins and checkouts:
-                    first_in = min(checkins)
-                    last_out = max(checkouts)
-                    if last_out > first_in: daily_seconds = (last_out - first_in).total_seconds()
-                daily_hours_map[(emp_id, date_str)] = daily_seconds
-
-        monthly_hours_map = {}
-        for emp_id in emp_data.keys():
-            emp_daily_totals = { date_str: secs for (e_id, date_str), secs in daily_hours_map.items() if e_id == emp_id }
-            monthly_groups = {}
-            for date_str, secs in emp_daily_totals.items():
-                try:
-                    month_key = datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m")
-                    monthly_groups.setdefault(month_key, []).append((date_str, secs))
-                except ValueError: continue
-            sorted_month_keys = sorted(monthly_groups.keys())
-            for month_key in sorted_month_keys:
-                month_days = monthly_groups[month_key]
-                sorted_days = sorted(month_days, key=lambda x: datetime.strptime(x[0], "%d/%m/%Y"))
-                running_total = 0
-                for date_str, daily_sec in sorted_days:
-                    running_total += daily_sec
-                    h, rem = divmod(running_total, 3600)
-                    m, s = divmod(rem, 60)
-                    monthly_hours_map[(emp_id, date_str)] = f"{int(h)}h {int(m)}m {int(s)}s" if running_total > 0 else ""
-
-        grouped = {}
-        for d in attendance_data:
-            date_str = d.get("_vn_date_str", "")
-            if not date_str: continue
-            try:
-                rec_date = datetime.strptime(date_str, "%d/%m/%Y")
-                if start_dt.date() <= rec_date.date() <= end_dt.date():
-                    key = (d.get("EmployeeId", ""), d.get("EmployeeName", ""), date_str)
-                    grouped.setdefault(key, []).append(d)
-            except: continue
-
-        start_row = 2
-        for i, ((emp_id, emp_name, date_str), records) in enumerate(grouped.items()):
-            row = start_row + i
-            ws_att.cell(row=row, column=1, value=emp_id)
-            ws_att.cell(row=row, column=2, value=emp_name)
-            ws_att.cell(row=row, column=3, value=date_str)
-            daily_sec = daily_hours_map.get((emp_id, date_str), 0)
-            h_d, rem_d = divmod(daily_sec, 3600)
-            m_d, s_d = divmod(rem_d, 60)
-            ws_att.cell(row=row, column=14, value=f"{int(h_d)}h {int(m_d)}m {int(s_d)}s" if daily_sec > 0 else "")
-            ws_att.cell(row=row, column=15, value=monthly_hours_map.get((emp_id, date_str), ""))
-            checkin_counter = 0
-            for rec in sorted(records, key=lambda x: x.get("Timestamp") or datetime.min):
-                if rec.get("CheckType") == "checkin" and checkin_counter < 9:
-                    time_str = ""
-                    if rec.get("Timestamp"):
-                        try:
-                            ts = rec["Timestamp"]
-                            if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                            time_str = ts.astimezone(VN_TZ).strftime("%H:%M:%S")
-                        except: time_str = ""
-                    tasks_str = ", ".join(rec.get("Tasks", [])) if isinstance(rec.get("Tasks"), list) else str(rec.get("Tasks", ""))
-                    cell_value = "; ".join(filter(None, [time_str, rec.get("ProjectId", ""), tasks_str, rec.get("Address", ""), rec.get("CheckinNote", "")]))
-                    ws_att.cell(row=row, column=4 + checkin_counter, value=cell_value)
-                    checkin_counter += 1
-                elif rec.get("CheckType") == "checkout":
-                    time_str = ""
-                    if rec.get("Timestamp"):
-                        try:
-                            ts = rec["Timestamp"]
-                            if isinstance(ts, str): ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                            time_str = ts.astimezone(VN_TZ).strftime("%H:%M:%S")
-                        except: time_str = ""
-                    tasks_str = ", ".join(rec.get("Tasks", [])) if isinstance(rec.get("Tasks"), list) else str(rec.get("Tasks", ""))
-                    cell_value = "; ".join(filter(None, [time_str, rec.get("ProjectId", ""), tasks_str, rec.get("Address", ""), rec.get("CheckinNote", "")]))
-                    ws_att.cell(row=row, column=13, value=cell_value)
-            for col in range(1, 16):
-                cell = ws_att.cell(row=row, column=col)
-                cell.border = border
-                cell.alignment = align_left
-
-        # ================= SHEET: NGHỈ PHÉP =================
-        ws_leave = wb["Nghỉ phép"]
-        headers = ["Mã NV", "Tên NV", "Ngày Nghỉ", "Số ngày nghỉ", "Ngày tạo đơn", "Lý do", "Ngày Duyệt/Từ chối", "Trạng thái", "Ghi chú"]
-        for i, h in enumerate(headers, 1): ws_leave.cell(row=1, column=i, value=h)
-        current_row_leave = 2
-        export_year = end_dt.year
-        export_month = end_dt.month
-        for rec in leave_data:
-            display_date_raw = rec.get("DisplayDate", "").strip()
-            leave_days, is_overlap = calculate_leave_days_for_month(rec, export_year, export_month)
-            def reformat_date(match): return datetime.strptime(match.group(0), "%Y-%m-%d").strftime("%d/%m/%Y")
-            display_date = re.sub(r"\d{4}-\d{2}-\d{2}", reformat_date, display_date_raw)
-            ws_leave.cell(row=current_row_leave, column=1, value=rec.get("EmployeeId", ""))
-            ws_leave.cell(row=current_row_leave, column=2, value=rec.get("EmployeeName", ""))
-            ws_leave.cell(row=current_row_leave, column=3, value=display_date)
-            ws_leave.cell(row=current_row_leave, column=4, value=leave_days if is_overlap else 0)
-            timestamp_str = ""
-            if rec.get("CreationTime"):
-                try:
-                    ct = rec['CreationTime']
-                    dt = ct if isinstance(ct, datetime) else datetime.fromisoformat(ct.replace('Z', '+00:00'))
-                    timestamp_str = dt.astimezone(VN_TZ).strftime('%d/%m/%Y %H:%M:%S')
-                except: timestamp_str = str(rec.get("CreationTime"))
-            ws_leave.cell(row=current_row_leave, column=5, value=timestamp_str)
-            tasks_str = (", ".join(rec.get("Tasks", [])) if isinstance(rec.get("Tasks"), list) else str(rec.get("Tasks", ""))).replace("Nghỉ phép: ", "")
-            ws_leave.cell(row=current_row_leave, column=6, value=rec.get("Reason") or tasks_str)
-            ws_leave.cell(row=current_row_leave, column=7, value=get_formatted_approval_date(rec.get("ApprovalDate2")))
-            ws_leave.cell(row=current_row_leave, column=8, value=rec.get("Status2", ""))
-            ws_leave.cell(row=current_row_leave, column=9, value=rec.get("LeaveNote", ""))
-            for col in range(1, 10):
-                cell = ws_leave.cell(row=current_row_leave, column=col)
-                cell.border = border
-                cell.alignment = align_left
-            current_row_leave += 1
-
-        export_date_str = datetime.now(VN_TZ).strftime('%d-%m-%Y')
-        filename = get_export_filename("Báo cáo tổng hợp", start_date, end_date, export_date_str)
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-        return send_file(output, as_attachment=True, download_name=filename, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+# ---- Xuất Excel nhiều tháng (quý/năm): ZIP mỗi tháng một file, hoặc một file mỗi tháng một sheet ----
+# Cả khoảng chỉ truy vấn và tính giờ làm một lần rồi chia dòng theo tháng; đơn nghỉ vắt qua cuối tháng
+# có mặt ở mọi tháng nó giao, số ngày nghỉ tính riêng cho từng tháng như khi xuất từng tháng.
+BULK_EXPORT_MAX_MONTHS = int(os.getenv("BULK_EXPORT_MAX_MONTHS", "24"))
+ZIP_MIMETYPE = "application/zip"
+# report -> (file mẫu, tiền tố tên file, [(sheet mẫu, số cột, dữ liệu, tên sheet khi gộp một file)])
+BULK_EXPORT_REPORTS = {
+    "attendance": (ATTENDANCE_TEMPLATE, "Chấm công", [(None, ATTENDANCE_COLUMNS, "attendance", "Chấm công")]),
+    "leave": (LEAVE_TEMPLATE, "Nghỉ phép", [(None, LEAVE_COLUMNS, "leave", "Nghỉ phép")]),
+    "combined": (COMBINED_TEMPLATE, "Báo cáo tổng hợp", [
+        ("Điểm danh", ATTENDANCE_COLUMNS, "attendance", "Điểm danh"),
+        ("Nghỉ phép", LEAVE_COLUMNS, "leave", "Nghỉ phép")
+    ]),
+}
+
+def get_bulk_export_months():
+    """
+    Các tháng cần xuất, từ year (+ quarter 1-4) hoặc startDate/endDate:
+    [(năm, tháng, ngày đầu, ngày cuối)] với ngày dạng 'YYYY-MM-DD', tháng đầu/cuối cắt theo khoảng; [] nếu sai.
+    """
+    year, quarter = request.args.get("year"), request.args.get("quarter")
+    try:
+        if year and not request.args.get("startDate"):
+            first_month, last_month = (3 * int(quarter) - 2, 3 * int(quarter)) if quarter else (1, 12)
+            if not 1 <= first_month <= last_month <= 12: return []
+            start = datetime(int(year), first_month, 1)
+            end = datetime(int(year), last_month, calendar.monthrange(int(year), last_month)[1])
+        else:
+            start = datetime.strptime(request.args.get("startDate", ""), "%Y-%m-%d")
+            end = datetime.strptime(request.args.get("endDate", ""), "%Y-%m-%d")
+    except (ValueError, OverflowError): return []
+    months = []
+    month_start = start.replace(day=1)
+    while month_start <= end:
+        month_end = month_start.replace(day=calendar.monthrange(month_start.year, month_start.month)[1])
+        months.append((month_start.year, month_start.month,
+                       max(month_start, start).strftime("%Y-%m-%d"), min(month_end, end).strftime("%Y-%m-%d")))
+        month_start = month_end + timedelta(days=1)
+    return months
+
+def attendance_rows_by_month(db, months, search, username):
+    """Dòng chấm công của cả khoảng (một lần truy vấn, giờ làm cộng dồn theo từng tháng) chia theo (năm, tháng)."""
+    by_month = {(year, month): [] for year, month, _, _ in months}
+    for row in cached_attendance_sheet(db, months[0][2], months[-1][3], search, username):
+        date_str = row[2]  # 'dd/mm/YYYY'
+        by_month[(int(date_str[6:]), int(date_str[3:5]))].append(row)
+    return by_month
+
+def leave_rows_by_month(db, months, search, username):
+    """Đơn nghỉ giao với cả khoảng (một lần truy vấn) xếp vào các tháng nó giao, dòng tính theo từng tháng."""
+    leaves = find_export_leaves(db, _as_day(months[0][2]), _as_day(months[-1][3]), search, username)
+    windows = [(_as_day(start), _as_day(end)) for _, _, start, end in months]
+    leaves_by_month = [[] for _ in months]
+    for rec in leaves:
+        # Đơn đã backfill dùng LeaveStart/LeaveEnd (như bộ lọc trong MongoDB), đơn cũ đọc DisplayDate
+        if rec.get("LeaveStart") is not None: interval = (_as_day(rec["LeaveStart"]), _as_day(rec["LeaveEnd"]))
+        else: interval = parse_leave_interval({"DisplayDate": rec.get("DisplayDate", "")})
+        if interval is None or None in interval: continue
+        for index, (month_start, month_end) in enumerate(windows):
+            if interval[0] <= month_end and interval[1] >= month_start:
+                leaves_by_month[index].append(rec)
+    return {(year, month): list(leave_export_rows(month_leaves, year, month))
+            for (year, month, _, _), month_leaves in zip(months, leaves_by_month)}
+
+def send_bulk_export(report, months, rows, output_format):
+    """output_format "sheets": một workbook, mỗi tháng một (bộ) sheet; ngược lại ZIP mỗi tháng một workbook."""
+    template_path, prefix, sheet_specs = BULK_EXPORT_REPORTS[report]
+    mode = request.args.get("mode", EXCEL_EXPORT_MODE)
+    export_date_str = datetime.now(VN_TZ).strftime('%d-%m-%Y')
+    filename = get_export_filename(prefix, months[0][2], months[-1][3], export_date_str)
+    if output_format == "sheets":
+        sheets = [(sheet_name, columns, rows[kind][(year, month)], f"{title} {month:02d}-{year}")
+                  for year, month, _, _ in months for sheet_name, columns, kind, title in sheet_specs]
+        with metrics_step("excel"):
+            output = export_workbook(template_path, sheets, mode=mode)
+        return send_file(output, as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE)
+
+    output = tempfile.TemporaryFile()
+    try:
+        # xlsx đã được nén: lưu nguyên (ZIP_STORED) thay vì nén lần nữa
+        with metrics_step("excel"), zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+            for year, month, start_date, end_date in months:
+                sheets = [(sheet_name, columns, rows[kind][(year, month)]) for sheet_name, columns, kind, _ in sheet_specs]
+                with export_workbook(template_path, sheets, mode=mode) as workbook, \
+                        archive.open(get_export_filename(prefix, start_date, end_date, export_date_str), "w") as entry:
+                    shutil.copyfileobj(workbook, entry)
+    except Exception:
+        output.close()
+        raise
+    output.seek(0)
+    return send_file(output, as_attachment=True, download_name=f"{filename[:-len('.xlsx')]}.zip", mimetype=ZIP_MIMETYPE)
+
+@app.route("/api/export-bulk-excel", methods=["GET"])
+def export_bulk_excel():
+    """Xuất nhiều tháng: report=attendance|leave|combined, year (+ quarter) hoặc startDate/endDate, output=zip|sheets."""
+    try:
+        username, error = get_request_user()
+        if error: return error
+
+        report = request.args.get("report", "combined")
+        if report not in BULK_EXPORT_REPORTS: return jsonify({"error": "Loại báo cáo không hợp lệ"}), 400
+        months = get_bulk_export_months()
+        if not months: return jsonify({"error": "Thiếu thông tin ngày xuất"}), 400
+        if len(months) > BULK_EXPORT_MAX_MONTHS:
+            return jsonify({"error": f"Chỉ xuất tối đa {BULK_EXPORT_MAX_MONTHS} tháng mỗi lần"}), 400
+
+        search = request.args.get("search", "").strip()
+        db = get_db()
+        builders = {"attendance": attendance_rows_by_month, "leave": leave_rows_by_month}
+        kinds = {kind for _, _, kind, _ in BULK_EXPORT_REPORTS[report][2]}
+        with ThreadPoolExecutor(max_workers=len(kinds), thread_name_prefix="export-sheet") as pool:
+            futures = {kind: pool.submit(copy_context().run, builders[kind], db, months, search, username) for kind in kinds}
+            rows = {kind: future.result() for kind, future in futures.items()}
+        return send_bulk_export(report, months, rows, request.args.get("output", "zip"))
 
     except Exception as e:
-        print(f"Lỗi export combined: {e}")
+        print(f"Lỗi export bulk: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+# ==============================================================================
+# JOB XUẤT EXCEL CHẠY NỀN (KẾT QUẢ LƯU TRÊN Ổ ĐĨA)
+# ==============================================================================
+# POST tạo job, worker pool dựng file bằng chính các route xuất Excel ở trên, client hỏi trạng thái
+# rồi tải file. Trạng thái job là file JSON cạnh file kết quả nên mọi worker gunicorn cùng máy đều đọc được.
+# Serverless tắt mặc định: thread nền bị dừng khi đã trả response và /tmp riêng từng instance, nên
+# POST trả về 501 và giao diện tải trực tiếp từ route xuất Excel.
+
+EXPORT_JOBS_ENABLED = os.getenv("EXPORT_JOBS_ENABLED", "0" if IS_SERVERLESS else "1") == "1"
+EXPORT_JOB_DIR = os.getenv("EXPORT_JOB_DIR", os.path.join(tempfile.gettempdir(), "attendance_export_jobs"))
+EXPORT_JOB_TTL = int(os.getenv("EXPORT_JOB_TTL", "3600"))  # giây giữ file kết quả
+EXPORT_JOB_WORKERS = int(os.getenv("EXPORT_JOB_WORKERS", "2"))
+EXPORT_JOB_PARAMS = ("email", "month", "year", "startDate", "endDate", "search", "filter", "dateType", "mode",
+                     "report", "quarter", "output")
+EXPORT_JOB_VIEWS = {
+    "attendance": ("/api/export-excel", export_to_excel),
+    "leave": ("/api/export-leaves-excel", export_leaves_to_excel),
+    "combined": ("/api/export-combined-excel", export_combined_to_excel),
+    "bulk": ("/api/export-bulk-excel", export_bulk_excel),
+}
+
+_export_executor = None
+_export_executor_pid = None
+_export_jobs_lock = threading.Lock()
+
+def _get_export_executor():
+    """Worker pool dùng chung cho process, tạo lại sau khi fork (giống get_client)."""
+    global _export_executor, _export_executor_pid
+    with _export_jobs_lock:
+        if _export_executor is None or _export_executor_pid != os.getpid():
+            _export_executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix="export-job")
+            _export_executor_pid = os.getpid()
+    return _export_executor
+
+def _export_job_path(job_id, ext="json"):
+    return os.path.join(EXPORT_JOB_DIR, f"{job_id}.{ext}")
+
+def read_export_job(job_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""): return None
+    try:
+        with open(_export_job_path(job_id), encoding="utf-8") as f: return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_export_job(job):
+    """Ghi trạng thái job (ghi file tạm rồi os.replace để người đọc không thấy file dở dang)."""
+    job["updated_at"] = time.time()
+    path = _export_job_path(job["id"])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f: json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def export_job_id(kind, params):
+    """Cùng loại + cùng tham số -> cùng id, nên các yêu cầu giống nhau dùng chung một job."""
+    return hashlib.sha256(json.dumps([kind, sorted(params.items())], ensure_ascii=False).encode()).hexdigest()[:32]
+
+def _export_job_alive(job, now):
+    """Job còn dùng được: đang chờ/chạy (chưa bị treo quá TTL) hoặc đã xong và chưa hết hạn."""
+    if job["status"] in ("queued", "running"): return now - job["updated_at"] < EXPORT_JOB_TTL
+    return job["status"] == "done" and now < job["expires_at"] and os.path.exists(_export_job_path(job["id"], "xlsx"))
+
+def purge_export_jobs():
+    """Xoá job (và file kết quả) đã hết hạn hoặc lỗi quá TTL."""
+    now = time.time()
+    for name in os.listdir(EXPORT_JOB_DIR):
+        if not name.endswith(".json"): continue
+        job = read_export_job(name[:-5])
+        if job is None or _export_job_alive(job, now) or (job["status"] == "error" and now < job["expires_at"]): continue
+        for ext in ("json", "xlsx", "lock"):
+            try: os.remove(_export_job_path(job["id"], ext))
+            except OSError: pass
+
+def _claim_export_job(job_id):
+    """
+    Tạo file <id>.lock bằng O_EXCL: trong mọi worker cùng máy chỉ một process tạo và chạy job job_id,
+    file được xoá khi job xong. File bị bỏ lại (worker chết giữa chừng) quá EXPORT_JOB_TTL thì chiếm lại.
+    """
+    path = _export_job_path(job_id, "lock")
+    for attempt in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if attempt or time.time() - os.path.getmtime(path) < EXPORT_JOB_TTL: return False
+                os.remove(path)
+            except OSError:
+                return False
+    return False
+
+def _release_export_job(job_id):
+    try: os.remove(_export_job_path(job_id, "lock"))
+    except OSError: pass
+
+def submit_export_job(kind, params):
+    """
+    Tạo job xuất Excel, hoặc trả về job giống hệt đang chờ/chạy (kể cả ở worker khác). Job đã xong
+    thì chạy lại (dữ liệu có thể đã đổi từ lần trước), file cũ bị thay khi job mới xong.
+    """
+    os.makedirs(EXPORT_JOB_DIR, exist_ok=True)
+    purge_export_jobs()
+    job_id = export_job_id(kind, params)
+    job = {
+        "id": job_id, "kind": kind, "params": params, "status": "queued",
+        "filename": None, "error": None, "created_at": time.time(), "expires_at": None
+    }
+    if not _claim_export_job(job_id):
+        # Process khác đang giữ job; file trạng thái có thể chưa kịp ghi thì trả về bản đang chờ
+        return read_export_job(job_id) or job
+    try:
+        _write_export_job(job)
+        _get_export_executor().submit(run_export_job, job_id)
+    except Exception:
+        _release_export_job(job_id)
+        raise
+    return job
+
+def run_export_job(job_id):
+    """Dựng file bằng route xuất Excel tương ứng trong một request context giả lập, lưu vào EXPORT_JOB_DIR."""
+    job = read_export_job(job_id)
+    if job is None:
+        _release_export_job(job_id)
+        return
+    job["status"] = "running"
+    _write_export_job(job)
+    path, view = EXPORT_JOB_VIEWS[job["kind"]]
+    try:
+        with app.test_request_context(path, query_string=job["params"]):
+            response = app.make_response(view())
+            try:
+                if response.status_code != 200:
+                    raise RuntimeError((response.get_json(silent=True) or {}).get("error") or response.status)
+                artifact_path = _export_job_path(job_id, "xlsx")
+                tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.response: f.write(chunk)
+                os.replace(tmp_path, artifact_path)
+                job["filename"] = parse_options_header(response.headers.get("Content-Disposition", ""))[1].get("filename")
+            finally:
+                response.close()
+        job["status"] = "done"
+    except Exception as e:
+        print(f"❌ Lỗi job xuất Excel {job_id}: {e}")
+        job.update(status="error", error=str(e))
+    job["expires_at"] = time.time() + EXPORT_JOB_TTL
+    _write_export_job(job)
+    _release_export_job(job_id)
+
+def export_job_status(job):
+    status = {key: job[key] for key in ("id", "kind", "status", "filename", "error", "created_at", "expires_at")}
+    auth = {"email": job["params"]["email"], "token": request_token()}
+    status["statusUrl"] = url_for("get_export_job", job_id=job["id"], **auth)
+    if job["status"] == "done":
+        status["downloadUrl"] = url_for("download_export_job", job_id=job["id"], **auth)
+    return status
+
+def _find_own_export_job(job_id):
+    """Job theo id, chỉ trả về cho đúng tài khoản đã tạo job."""
+    account, error = get_current_account()
+    if error: return None
+    job = read_export_job(job_id)
+    if job is None or job["params"].get("email") != account["email"]: return None
+    return job
+
+@app.route("/api/export-jobs", methods=["POST"])
+def create_export_job():
+    if not EXPORT_JOBS_ENABLED: return jsonify({"error": "Server không chạy job xuất nền, hãy tải trực tiếp"}), 501
+    try:
+        params = {**request.args.to_dict(), **request.form.to_dict(), **(request.get_json(silent=True) or {})}
+        kind = params.pop("type", None)
+        if kind not in EXPORT_JOB_VIEWS: return jsonify({"error": "Loại xuất không hợp lệ"}), 400
+        account, error = get_current_account(params.get("email"))
+        if error: return error
+        # Job chạy lại route xuất với tham số email (không kèm token), tài khoản lấy từ cache
+        params["email"] = account["email"]
+        params = {key: str(params[key]) for key in EXPORT_JOB_PARAMS if params.get(key) not in (None, "")}
+        return jsonify(export_job_status(submit_export_job(kind, params))), 202
+    except Exception as e:
+        print(f"❌ Lỗi tại create_export_job: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/export-jobs/<job_id>", methods=["GET"])
+def get_export_job(job_id):
+    job = _find_own_export_job(job_id)
+    if job is None: return jsonify({"error": "Không tìm thấy job"}), 404
+    return jsonify(export_job_status(job))
+
+@app.route("/api/export-jobs/<job_id>/download", methods=["GET"])
+def download_export_job(job_id):
+    job = _find_own_export_job(job_id)
+    if job is None: return jsonify({"error": "Không tìm thấy job"}), 404
+    artifact_path = _export_job_path(job_id, "xlsx")
+    if job["status"] != "done" or not os.path.exists(artifact_path):
+        return jsonify({"error": "File chưa sẵn sàng", "status": job["status"]}), 409
+    filename = job["filename"] or f"{job['kind']}.xlsx"
+    return send_file(artifact_path, as_attachment=True, download_name=filename,
+                     mimetype=ZIP_MIMETYPE if filename.endswith(".zip") else XLSX_MIMETYPE)
+
+# ==============================================================================
+# JOB GHI GIỜ LÀM (DailyHours/MonthlyHours) VÀO alt_checkins
+# ==============================================================================
+
+def _load_high_water_mark(db, state_id, full=False):
+    """Đọc _id lớn nhất đã xử lý của một job (None nếu chạy lại toàn bộ)."""
+    if full: return None
+    return (db["job_state"].find_one({"_id": state_id}) or {}).get("last_id")
+
+def _save_high_water_mark(db, state_id, last_id, max_id):
+    if max_id is None or max_id == last_id: return
+    db["job_state"].update_one(
+        {"_id": state_id},
+        {"$set": {"last_id": max_id, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+# Job nền chạy trong mọi worker gunicorn: chỉ process đang giữ lease trong job_state được chạy,
+# các process khác chờ lease hết hạn (process giữ lease dừng/chết) rồi tranh lại.
+JOB_LEASE_TTL = int(os.getenv("JOB_LEASE_TTL", "120"))
+
+def acquire_job_lease(db, name, ttl=JOB_LEASE_TTL):
+    """Lấy hoặc gia hạn lease của job name (hết hạn sau ttl giây). Trả về True nếu process này đang giữ lease."""
+    now = datetime.now(timezone.utc)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        db["job_state"].update_one(
+            {"_id": f"lease:{name}", "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:  # lease còn hạn của process khác
+        return False
+
+def _iter_new_checkins(collection, last_id, projection):
+    """Duyệt các check-in/check-out có _id lớn hơn mốc đã xử lý, theo thứ tự _id."""
+    query = {"CheckType": {"$in": ["checkin", "checkout"]}}
+    if last_id: query["_id"] = {"$gt": last_id}
+    return collection.find(query, projection).sort("_id", 1)
+
+HOURS_JOB_STATE_ID = "attendance_hours"
+HOURS_JOB_BATCH_SIZE = int(os.getenv("HOURS_JOB_BATCH_SIZE", "1000"))
+HOURS_JOB_INTERVAL = int(os.getenv("HOURS_JOB_INTERVAL", "0"))
+
+def materialize_attendance_hours(db, full=False):
+    """
+    Ghi DailyHours/_dailySeconds/MonthlyHours/_monthlySeconds cho các ngày có check-in mới.
+    Mốc xử lý (high-water mark) là _id lớn nhất đã thấy, lưu trong collection job_state.
+    Chỉ các ngày thay đổi và các ngày sau đó trong cùng tháng (tổng cộng dồn) được ghi lại,
+    bằng bulk_write UpdateMany không theo thứ tự.
+    Trả về số ngày đã cập nhật.
+    """
+    alt_checkins_col = db["alt_checkins"]
+    last_id = _load_high_water_mark(db, HOURS_JOB_STATE_ID, full)
+
+    # (EmployeeId, năm, tháng) -> ngày thay đổi sớm nhất trong tháng
+    changed_months = {}
+    max_id = last_id
+    for doc in _iter_new_checkins(alt_checkins_col, last_id, {"EmployeeId": 1, "CheckinDate": 1}):
+        max_id = doc["_id"]
+        emp_id, date_str = doc.get("EmployeeId"), doc.get("CheckinDate")
+        if not emp_id or not date_str: continue
+        try: day = datetime.strptime(date_str, "%d/%m/%Y")
+        except ValueError: continue
+        key = (emp_id, day.year, day.month)
+        if key not in changed_months or day < changed_months[key]:
+            changed_months[key] = day
+
+    # Gom nhân viên theo tháng để mỗi tháng chỉ cần một truy vấn
+    emps_by_month = {}
+    for emp_id, year, month in changed_months:
+        emps_by_month.setdefault((year, month), []).append(emp_id)
+
+    ops = []
+    updated_days = 0
+    for (year, month), emp_ids in emps_by_month.items():
+        daily_hours_map, monthly_hours_map = get_attendance_hours(alt_checkins_col, {
+            "CheckType": {"$in": ["checkin", "checkout"]},
+            "EmployeeId": {"$in": emp_ids},
+            **vn_date_filter(datetime(year, month, 1), datetime(year, month, calendar.monthrange(year, month)[1]),
+                             {"$regex": f"/{month:02d}/{year}$"})
+        }, engine=HOURS_ENGINE)
+        for (emp_id, date_str), daily_seconds in daily_hours_map.items():
+            try: day = datetime.strptime(date_str, "%d/%m/%Y")
+            except ValueError: continue
+            first_changed = changed_months.get((emp_id, year, month))
+            if first_changed is None or day < first_changed: continue
+            monthly_seconds = monthly_hours_map.get((emp_id, date_str), 0)
+            ops.append(UpdateMany(
+                {"EmployeeId": emp_id, "CheckinDate": date_str, "CheckType": {"$in": ["checkin", "checkout"]}},
+                {"$set": {
+                    "DailyHours": format_seconds(daily_seconds), "_dailySeconds": daily_seconds,
+                    "MonthlyHours": format_seconds(monthly_seconds), "_monthlySeconds": monthly_seconds
+                }}
+            ))
+            if len(ops) >= HOURS_JOB_BATCH_SIZE:
+                alt_checkins_col.bulk_write(ops, ordered=False)
+                updated_days += len(ops)
+                ops = []
+    if ops:
+        alt_checkins_col.bulk_write(ops, ordered=False)
+        updated_days += len(ops)
+
+    _save_high_water_mark(db, HOURS_JOB_STATE_ID, last_id, max_id)
+    return updated_days
+
+# ==============================================================================
+# BẢNG TỔNG HỢP NGÀY CÔNG (daily_attendance_summary)
+# ==============================================================================
+
+SUMMARY_COLLECTION = "daily_attendance_summary"
+SUMMARY_STATE_ID = "attendance_summary"
+ATTENDANCE_SUMMARY_ENABLED = os.getenv("ATTENDANCE_SUMMARY_ENABLED", "1") == "1"
+ATTENDANCE_SUMMARY_WATCH = os.getenv("ATTENDANCE_SUMMARY_WATCH", "0") == "1"
+
+def _vn_month_bounds(year, month):
+    """Khoảng [đầu tháng, đầu tháng sau) theo giờ VN."""
+    start = datetime(year, month, 1, tzinfo=VN_TZ)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=VN_TZ)
+    return start, end
+
+def _month_checkins_query(emp_ids, year, month):
+    """Check-in/check-out của các nhân viên trong một tháng VN (Timestamp dạng date hoặc chuỗi UTC)."""
+    start, end = _vn_month_bounds(year, month)
+    start_str = start.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    end_str = end.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return {
+        "CheckType": {"$in": ["checkin", "checkout"]},
+        "EmployeeId": {"$in": emp_ids},
+        "$or": [
+            {"Timestamp": {"$gte": start, "$lt": end}},
+            {"Timestamp": {"$gte": start_str, "$lt": end_str}}
+        ]
+    }
+
+def refresh_attendance_summary(db, full=False):
+    """
+    Cập nhật daily_attendance_summary cho các tháng có check-in mới (theo mốc _id trong job_state).
+    Mỗi document: EmployeeId, Date ('dd/mm/YYYY' theo giờ VN), Day, FirstIn, LastOut, Seconds,
+    CheckinCount, MonthSeconds. Cả tháng của nhân viên được tính lại để tổng cộng dồn luôn đúng.
+    Trả về số ngày đã ghi.
+    """
+    alt_checkins_col = db["alt_checkins"]
+    summary_col = db[SUMMARY_COLLECTION]
+    last_id = _load_high_water_mark(db, SUMMARY_STATE_ID, full)
+
+    emps_by_month = {}
+    max_id = last_id
+    for doc in _iter_new_checkins(alt_checkins_col, last_id, {"EmployeeId": 1, "Timestamp": 1}):
+        max_id = doc["_id"]
+        ts_vn = to_vn_time(doc.get("Timestamp"))
+        if not doc.get("EmployeeId") or ts_vn is None: continue
+        emps_by_month.setdefault((ts_vn.year, ts_vn.month), set()).add(doc["EmployeeId"])
+
+    ops = []
+    written_days = 0
+    now = datetime.now(timezone.utc)
+    for (year, month), emp_ids in emps_by_month.items():
+        emp_ids = list(emp_ids)
+        days = load_attendance_days(alt_checkins_col, _month_checkins_query(emp_ids, year, month), day_key="Timestamp", engine=HOURS_ENGINE)
+        dates_by_emp = {emp_id: [] for emp_id in emp_ids}
+        for day in days:
+            dates_by_emp.setdefault(day["EmployeeId"], []).append(day["Date"])
+            ops.append(UpdateOne(
+                {"EmployeeId": day["EmployeeId"], "Date": day["Date"]},
+                {"$set": {
+                    "Day": day.get("DayDate"), "FirstIn": day.get("FirstIn"), "LastOut": day.get("LastOut"),
+                    "Seconds": day["Seconds"], "CheckinCount": day.get("CheckinCount", 0),
+                    "MonthSeconds": day["MonthSeconds"], "UpdatedAt": now
+                }},
+                upsert=True
+            ))
+        # Xoá các ngày không còn check-in nào trong tháng vừa tính lại
+        month_start, month_end = datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
+        for emp_id, dates in dates_by_emp.items():
+            ops.append(DeleteMany({"EmployeeId": emp_id, "Day": {"$gte": month_start, "$lt": month_end}, "Date": {"$nin": dates}}))
+        if len(ops) >= HOURS_JOB_BATCH_SIZE:
+            summary_col.bulk_write(ops, ordered=False)
+            written_days += sum(1 for op in ops if isinstance(op, UpdateOne))
+            ops = []
+    if ops:
+        summary_col.bulk_write(ops, ordered=False)
+        written_days += sum(1 for op in ops if isinstance(op, UpdateOne))
+
+    _save_high_water_mark(db, SUMMARY_STATE_ID, last_id, max_id)
+    return written_days
+
+def rebuild_attendance_summary(db):
+    """Xoá và dựng lại toàn bộ daily_attendance_summary từ alt_checkins."""
+    db[SUMMARY_COLLECTION].delete_many({})
+    db["job_state"].delete_one({"_id": SUMMARY_STATE_ID})
+    ensure_indexes(db, [SUMMARY_COLLECTION])
+    return refresh_attendance_summary(db, full=True)
+
+def watch_attendance_summary(db, keep_running=None):
+    """
+    Theo dõi change stream của alt_checkins (cần replica set, ví dụ Atlas) và chạy catch-up
+    mỗi khi có check-in mới. Các sự kiện đến dồn dập được gom lại thành một lần cập nhật;
+    sự kiện bị lỡ khi mất kết nối vẫn được bắt lại nhờ mốc _id.
+    keep_running(): gọi sau mỗi lần chờ sự kiện (khoảng 1 giây), trả về False thì dừng theo dõi.
+    """
+    refresh_attendance_summary(db)
+    pipeline = [{"$match": {"operationType": "insert", "fullDocument.CheckType": {"$in": ["checkin", "checkout"]}}}]
+    with db["alt_checkins"].watch(pipeline) as stream:
+        while stream.alive and (keep_running is None or keep_running()):
+            if stream.try_next() is None: continue
+            while stream.try_next() is not None: pass
+            refresh_attendance_summary(db)
+
+def current_summary_mark(db):
+    """
+    Mốc _id của bảng tổng hợp nếu bảng đã được cập nhật tới check-in mới nhất, ngược lại None.
+    Bảng chưa dựng (job chưa chạy) hoặc đang chậm hơn dữ liệu thì giờ làm tính bằng aggregation
+    như khi tắt ATTENDANCE_SUMMARY_ENABLED, để không trả về giờ làm trống hoặc cũ.
+    """
+    if not ATTENDANCE_SUMMARY_ENABLED: return None
+    mark = _load_high_water_mark(db, SUMMARY_STATE_ID)
+    if mark is None: return None
+    latest = _latest_value(db["alt_checkins"], "_id", {"CheckType": {"$in": ["checkin", "checkout"]}})
+    return mark if mark == latest else None
+
+def get_summary_hours(db, keys):
+    """
+    Đọc giờ làm từ daily_attendance_summary cho tập key (EmployeeId, 'dd/mm/YYYY').
+    Trả về (daily_hours_map, monthly_hours_map) giống get_attendance_hours.
+    """
+    daily_hours_map, monthly_hours_map = {}, {}
+    keys = {(emp_id, date_str) for emp_id, date_str in keys if emp_id and date_str}
+    if not keys: return daily_hours_map, monthly_hours_map
+    emp_ids = list({emp_id for emp_id, _ in keys})
+    dates = list({date_str for _, date_str in keys})
+    cursor = db[SUMMARY_COLLECTION].find(
+        {"EmployeeId": {"$in": emp_ids}, "Date": {"$in": dates}},
+        {"_id": 0, "EmployeeId": 1, "Date": 1, "Seconds": 1, "MonthSeconds": 1}
+    )
+    for doc in cursor:
+        key = (doc["EmployeeId"], doc["Date"])
+        daily_hours_map[key] = doc.get("Seconds", 0)
+        if doc.get("MonthSeconds"): monthly_hours_map[key] = doc["MonthSeconds"]
+    return daily_hours_map, monthly_hours_map
+
+# ==============================================================================
+# MIGRATION: BACKFILL VnDate TỪ CheckinDate
+# ==============================================================================
+
+def backfill_vn_date(db, batch_size=1000, progress=None):
+    """
+    Ghi VnDate (BSON date, 00:00 UTC của ngày trong CheckinDate 'dd/mm/YYYY') cho các check-in chưa có.
+    Chạy theo lô _id nên có thể dừng và chạy lại bất cứ lúc nào; CheckinDate không hợp lệ
+    được ghi VnDate = null để không bị xử lý lại. Trả về số document đã cập nhật.
+    """
+    collection = db["alt_checkins"]
+    query = {"CheckType": {"$in": ["checkin", "checkout"]}, "VnDate": {"$exists": False}}
+    set_vn_date = [{"$set": {"VnDate": {"$cond": [
+        {"$eq": [{"$type": "$CheckinDate"}, "string"]},
+        {"$dateFromString": {"dateString": "$CheckinDate", "format": "%d/%m/%Y", "onError": None, "onNull": None}},
+        None
+    ]}}}]
+    updated = 0
+    while True:
+        ids = [doc["_id"] for doc in collection.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+        if not ids: break
+        updated += collection.update_many({"_id": {"$in": ids}}, set_vn_date).modified_count
+        if progress: progress(updated)
+    return updated
+
+# ==============================================================================
+# MIGRATION: LeaveStart/LeaveEnd CHO ĐƠN NGHỈ PHÉP
+# ==============================================================================
+
+LEAVE_DATE_SOURCE_FIELDS = ("DisplayDate", "StartDate", "EndDate", "LeaveDate")
+
+def backfill_leave_dates(db, batch_size=1000, full=False, progress=None):
+    """
+    Ghi LeaveStart/LeaveEnd (BSON date, 00:00 của ngày) cho các đơn nghỉ, tính bằng parse_leave_interval.
+    Mặc định chỉ xử lý đơn chưa có LeaveStart; full=True tính lại mọi đơn (khi DisplayDate bị sửa).
+    Chạy theo lô _id nên có thể dừng và chạy lại; đơn không xác định được ngày được ghi null.
+    Trả về số document đã cập nhật.
+    """
+    collection = db["alt_checkins"]
+    query = {"$or": [{field: {"$exists": True, "$nin": [None, ""]}} for field in LEAVE_DATE_SOURCE_FIELDS]}
+    if not full: query["LeaveStart"] = {"$exists": False}
+    projection = {field: 1 for field in LEAVE_DATE_SOURCE_FIELDS}
+    last_id, updated = None, 0
+    while True:
+        batch_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+        docs = list(collection.find(batch_query, projection).sort("_id", 1).limit(batch_size))
+        if not docs: break
+        ops = []
+        for doc in docs:
+            leave_start, leave_end = parse_leave_interval(doc) or (None, None)
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"LeaveStart": leave_start, "LeaveEnd": leave_end}}))
+        collection.bulk_write(ops, ordered=False)
+        updated += len(ops)
+        last_id = docs[-1]["_id"]
+        if progress: progress(updated)
+    return updated
+
+# ==============================================================================
+# MIGRATION: SearchKeys VÀ DANH BẠ NHÂN VIÊN CHO TÌM KIẾM
+# ==============================================================================
+
+SEARCH_SOURCE_FIELDS = ("EmployeeId", "EmployeeName")
+
+def backfill_search_keys(db, batch_size=1000, full=False, progress=None):
+    """
+    Ghi SearchKeys (search_keys của EmployeeId, EmployeeName) cho alt_checkins và cập nhật employee_directory
+    (_id = EmployeeId, EmployeeName gần nhất, SearchKeys gộp mọi tên đã gặp).
+    Mặc định chỉ xử lý document chưa có SearchKeys; full=True tính lại tất cả (khi đổi cách chuẩn hoá).
+    Chạy theo lô _id nên có thể dừng và chạy lại. Trả về số document đã cập nhật.
+    """
+    collection = db["alt_checkins"]
+    query = {"$or": [{field: {"$exists": True, "$nin": [None, ""]}} for field in SEARCH_SOURCE_FIELDS]}
+    if not full: query["SearchKeys"] = {"$exists": False}
+    projection = {field: 1 for field in SEARCH_SOURCE_FIELDS}
+    last_id, updated = None, 0
+    while True:
+        batch_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+        docs = list(collection.find(batch_query, projection).sort("_id", 1).limit(batch_size))
+        if not docs: break
+        ops, directory = [], {}
+        for doc in docs:
+            emp_id, name = doc.get("EmployeeId"), doc.get("EmployeeName")
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"SearchKeys": search_keys(emp_id, name)}}))
+            if emp_id:
+                entry = directory.setdefault(emp_id, {"name": name, "keys": []})
+                entry["name"] = name or entry["name"]
+                entry["keys"] += [key for key in search_keys(emp_id, name) if key not in entry["keys"]]
+        collection.bulk_write(ops, ordered=False)
+        if directory:
+            db[EMPLOYEE_DIRECTORY].bulk_write([
+                UpdateOne({"_id": emp_id}, {"$set": {"EmployeeName": entry["name"]},
+                                            "$addToSet": {"SearchKeys": {"$each": entry["keys"]}}}, upsert=True)
+                for emp_id, entry in directory.items()
+            ], ordered=False)
+        updated += len(ops)
+        last_id = docs[-1]["_id"]
+        if progress: progress(updated)
+    return updated
+
+# ==============================================================================
+# MIGRATION: CHUẨN HOÁ Timestamp/CreationTime SANG BSON DATE
+# ==============================================================================
+
+NORMALIZE_STATE_ID = "normalize_timestamps"
+
+def normalize_timestamps(db, dry_run=False, batch_size=1000, restart=False, progress=None):
+    """
+    Chuyển Timestamp/CreationTime dạng chuỗi trong alt_checkins sang BSON date (UTC).
+    Xử lý theo lô _id và lưu mốc vào job_state nên có thể dừng rồi chạy tiếp;
+    dry_run chỉ đếm, không ghi. Giá trị không parse được giữ nguyên và được đếm vào "failed".
+    """
+    collection = db["alt_checkins"]
+    last_id = None if (restart or dry_run) else _load_high_water_mark(db, NORMALIZE_STATE_ID)
+    stats = {"scanned": 0, "converted": 0, "failed": 0}
+    while True:
+        query = {"$or": [{"Timestamp": {"$type": "string"}}, {"CreationTime": {"$type": "string"}}]}
+        if last_id: query["_id"] = {"$gt": last_id}
+        docs = list(collection.find(query, {"Timestamp": 1, "CreationTime": 1}).sort("_id", 1).limit(batch_size))
+        if not docs: break
+        ops = []
+        for doc in docs:
+            fields = {}
+            for field in ("Timestamp", "CreationTime"):
+                if not isinstance(doc.get(field), str): continue
+                parsed = parse_timestamp_string(doc[field])
+                if parsed is None: stats["failed"] += 1
+                else: fields[field] = parsed
+            if fields: ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+        stats["scanned"] += len(docs)
+        stats["converted"] += len(ops)
+        if not dry_run:
+            if ops: collection.bulk_write(ops, ordered=False)
+            _save_high_water_mark(db, NORMALIZE_STATE_ID, last_id, docs[-1]["_id"])
+        last_id = docs[-1]["_id"]
+        if progress: progress(stats)
+    return stats
+
+# ==============================================================================
+# QUẢN LÝ INDEX
+# ==============================================================================
+
+# collection -> [(keys, options)], mỗi index ứng với một dạng truy vấn đang dùng trong app
+INDEX_SPECS = {
+    "alt_checkins": [
+        # build_attendance_query: lọc theo khoảng Timestamp (tuần/custom/xuất Excel)
+        ([("CheckType", 1), ("Timestamp", 1)], {"name": "checktype_timestamp"}),
+        # build_attendance_query: lọc theo VnDate (hôm nay/tháng/năm), CheckinDate cho document chưa backfill
+        ([("CheckType", 1), ("VnDate", 1)], {"name": "checktype_vndate"}),
+        ([("CheckType", 1), ("CheckinDate", 1)], {"name": "checktype_checkindate"}),
+        ([("EmployeeId", 1), ("CheckinDate", 1)], {"name": "employeeid_checkindate"}),
+        ([("EmployeeId", 1), ("Timestamp", 1)], {"name": "employeeid_timestamp"}),
+        # Tài khoản user chỉ xem dữ liệu của chính mình
+        ([("EmployeeName", 1), ("Timestamp", 1)], {"name": "employeename_timestamp"}),
+        # build_leave_query: {$or: [Tasks, Reason]} cần index cho từng nhánh
+        ([("Tasks", 1), ("CreationTime", 1)], {"name": "tasks_creationtime"}),
+        ([("Reason", 1), ("CreationTime", 1)], {"name": "reason_creationtime"}),
+        ([("CreationTime", 1)], {"name": "creationtime"}),
+        ([("ApprovalDate1", 1)], {"name": "approvaldate1"}),
+        ([("ApprovalDate2", 1)], {"name": "approvaldate2"}),
+        # Xuất Excel nghỉ phép: DisplayDate khác rỗng
+        ([("DisplayDate", 1)], {"name": "displaydate"}),
+        # add_leave_date_filter: LeaveEnd >= đầu kỳ loại ngay các đơn cũ; đơn chưa backfill theo LeaveStart = null
+        ([("LeaveEnd", 1), ("LeaveStart", 1)], {"name": "leaveend_leavestart"}),
+        ([("LeaveStart", 1), ("DisplayDate", 1)], {"name": "leavestart_displaydate"}),
+        # search_condition: tiền tố trên SearchKeys (multikey), document chưa backfill theo SearchKeys = null
+        ([("SearchKeys", 1), ("Timestamp", 1)], {"name": "searchkeys_timestamp"}),
+    ],
+    EMPLOYEE_DIRECTORY: [([("SearchKeys", 1)], {"name": "searchkeys"})],
+    "admins": [([("email", 1)], {"name": "email"})],
+    "users": [([("email", 1)], {"name": "email"})],
+    "reset_tokens": [([("token", 1)], {"name": "token"})],
+    SUMMARY_COLLECTION: [
+        ([("EmployeeId", 1), ("Date", 1)], {"name": "employeeid_date", "unique": True}),
+        ([("EmployeeId", 1), ("Day", 1)], {"name": "employeeid_day"}),
+    ],
+}
+
+def ensure_indexes(db, collections=None):
+    """
+    Tạo các index trong INDEX_SPECS (an toàn khi chạy lại nhiều lần).
+    Index trùng tên nhưng khác định nghĩa chỉ được báo lỗi, không làm dừng các index khác.
+    Trả về danh sách tên index đã đảm bảo.
+    """
+    ensured = []
+    for collection_name, specs in INDEX_SPECS.items():
+        if collections and collection_name not in collections: continue
+        for keys, options in specs:
+            try:
+                db[collection_name].create_index(keys, **options)
+                ensured.append(f"{collection_name}.{options['name']}")
+            except OperationFailure as e:
+                print(f"❌ Lỗi tạo index {collection_name}.{options['name']}: {e}")
+    return ensured
+
+def _canonical_queries():
+    """Các truy vấn điển hình của app, dùng để kiểm tra bằng explain()."""
+    queries = []
+    for filter_type in ["hôm nay", "tuần", "tháng", "năm"]:
+        queries.append(("alt_checkins", f"attendance {filter_type}", build_attendance_query(filter_type, None, None, "")))
+        queries.append(("alt_checkins", f"attendance {filter_type} (user)", build_attendance_query(filter_type, None, None, "", username="__explain__")))
+    today = datetime.now(VN_TZ).strftime("%Y-%m-%d")
+    queries.append(("alt_checkins", "attendance custom + search", build_attendance_query("custom", today, today, "NV")))
+    queries.append(("alt_checkins", "attendance tất cả + search", build_attendance_query("tất cả", None, None, "nguyen")))
+    queries.append((EMPLOYEE_DIRECTORY, "directory search", {"SearchKeys": {"$regex": "^nguyen"}}))
+    for date_type in ["CheckinTime", "ApprovalDate1", "ApprovalDate2", "LeaveDate"]:
+        queries.append(("alt_checkins", f"leaves tháng {date_type}", build_leave_query("tháng", None, None, "", date_type)))
+    queries.append(("alt_checkins", "leaves tất cả", build_leave_query("tất cả", None, None, "")))
+    export_leave_conditions = [{"DisplayDate": {"$exists": True, "$ne": ""}}]
+    add_leave_date_filter(export_leave_conditions, datetime.now(VN_TZ).replace(day=1), datetime.now(VN_TZ))
+    queries.append(("alt_checkins", "export leaves", {"$and": export_leave_conditions}))
+    queries.append((SUMMARY_COLLECTION, "summary lookup", {"EmployeeId": {"$in": ["__explain__"]}, "Date": {"$in": ["01/01/2000"]}}))
+    queries.append(("admins", "login", {"email": "__explain__"}))
+    queries.append(("users", "login", {"email": "__explain__"}))
+    return queries
+
+def _plan_stages(plan):
+    """Liệt kê tên các stage trong một plan của explain() (hỗ trợ cả định dạng classic và SBE)."""
+    if not isinstance(plan, dict): return []
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan", "winningPlan"):
+        stages += _plan_stages(plan.get(key))
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+def check_indexes(db):
+    """Chạy explain() cho từng truy vấn điển hình, trả về danh sách (collection, tên, stages) bị COLLSCAN."""
+    failures = []
+    for collection_name, name, query in _canonical_queries():
+        explain = db[collection_name].find(query).explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        if "COLLSCAN" in stages:
+            failures.append((collection_name, name, stages))
+    return failures
+
+def _attendance_jobs_loop():
+    while True:
+        try:
+            with app.app_context():
+                if not acquire_job_lease(get_db(), "attendance-jobs", JOB_LEASE_TTL + HOURS_JOB_INTERVAL):
+                    time.sleep(HOURS_JOB_INTERVAL)
+                    continue
+                if ATTENDANCE_SUMMARY_ENABLED and not ATTENDANCE_SUMMARY_WATCH:
+                    written = refresh_attendance_summary(get_db())
+                    if written: print(f"✅ Đã cập nhật bảng tổng hợp cho {written} ngày")
+                updated = materialize_attendance_hours(get_db())
+                if updated: print(f"✅ Đã cập nhật giờ làm cho {updated} ngày")
+                backfill_vn_date(get_db())
+                backfill_leave_dates(get_db())
+                backfill_search_keys(get_db())
+        except Exception as e:
+            print(f"❌ Lỗi job giờ làm: {e}")
+        time.sleep(HOURS_JOB_INTERVAL)
+
+def _attendance_summary_watch_loop():
+    while True:
+        try:
+            with app.app_context():
+                db = get_db()
+                if acquire_job_lease(db, "summary-watch"):
+                    # Gia hạn lease trong lúc theo dõi (mỗi JOB_LEASE_TTL / 3 giây), mất lease thì dừng
+                    renewed_at = [time.monotonic()]
+                    def keep_running():
+                        if time.monotonic() - renewed_at[0] < JOB_LEASE_TTL / 3: return True
+                        renewed_at[0] = time.monotonic()
+                        return acquire_job_lease(db, "summary-watch")
+                    watch_attendance_summary(db, keep_running)
+        except Exception as e:
+            print(f"❌ Lỗi change stream bảng tổng hợp: {e}")
+        time.sleep(max(HOURS_JOB_INTERVAL, 30))
+
+def start_hours_job():
+    """
+    Chạy các job giờ làm trong thread nền (không dùng trên serverless):
+    HOURS_JOB_INTERVAL > 0 bật cập nhật định kỳ, ATTENDANCE_SUMMARY_WATCH=1 bật change stream.
+    Mọi worker đều khởi động thread nhưng chỉ worker giữ lease (acquire_job_lease) chạy job.
+    """
+    if IS_SERVERLESS or not MONGO_URI: return []
+    threads = []
+    if HOURS_JOB_INTERVAL > 0:
+        threads.append(threading.Thread(target=_attendance_jobs_loop, name="hours-job", daemon=True))
+    if ATTENDANCE_SUMMARY_ENABLED and ATTENDANCE_SUMMARY_WATCH:
+        threads.append(threading.Thread(target=_attendance_summary_watch_loop, name="summary-watch", daemon=True))
+    for thread in threads: thread.start()
+    return threads
+
+@app.cli.command("materialize-hours")
+@click.option("--full", is_flag=True, help="Tính lại toàn bộ thay vì chỉ các check-in mới.")
+def materialize_hours_command(full):
+    """Ghi DailyHours/MonthlyHours vào alt_checkins (chạy bằng cron hoặc thủ công)."""
+    updated = materialize_attendance_hours(get_db(), full=full)
+    click.echo(f"Đã cập nhật giờ làm cho {updated} ngày")
+
+@app.cli.command("sync-attendance-summary")
+@click.option("--watch", is_flag=True, help="Tiếp tục theo dõi change stream sau khi cập nhật.")
+def sync_attendance_summary_command(watch):
+    """Cập nhật daily_attendance_summary cho các check-in mới."""
+    if watch:
+        watch_attendance_summary(get_db())
+        return
+    written = refresh_attendance_summary(get_db())
+    click.echo(f"Đã cập nhật bảng tổng hợp cho {written} ngày")
+
+@app.cli.command("rebuild-attendance-summary")
+def rebuild_attendance_summary_command():
+    """Dựng lại toàn bộ daily_attendance_summary."""
+    written = rebuild_attendance_summary(get_db())
+    click.echo(f"Đã dựng lại bảng tổng hợp với {written} ngày")
+
+@app.cli.command("backfill-vn-date")
+@click.option("--batch-size", default=1000, show_default=True, help="Số document mỗi lô.")
+def backfill_vn_date_command(batch_size):
+    """Migration một lần: ghi VnDate cho các check-in cũ."""
+    updated = backfill_vn_date(get_db(), batch_size=batch_size, progress=lambda n: click.echo(f"... {n} document"))
+    click.echo(f"Đã ghi VnDate cho {updated} document")
+
+@app.cli.command("backfill-leave-dates")
+@click.option("--batch-size", default=1000, show_default=True, help="Số document mỗi lô.")
+@click.option("--full", is_flag=True, help="Tính lại cho mọi đơn nghỉ, kể cả đơn đã có LeaveStart.")
+def backfill_leave_dates_command(batch_size, full):
+    """Migration: ghi LeaveStart/LeaveEnd cho các đơn nghỉ phép."""
+    updated = backfill_leave_dates(get_db(), batch_size=batch_size, full=full, progress=lambda n: click.echo(f"... {n} document"))
+    click.echo(f"Đã ghi LeaveStart/LeaveEnd cho {updated} document")
+
+@app.cli.command("backfill-search-keys")
+@click.option("--batch-size", default=1000, show_default=True, help="Số document mỗi lô.")
+@click.option("--full", is_flag=True, help="Tính lại cho mọi document, kể cả document đã có SearchKeys.")
+def backfill_search_keys_command(batch_size, full):
+    """Migration: ghi SearchKeys cho alt_checkins và dựng danh bạ nhân viên cho tìm kiếm."""
+    updated = backfill_search_keys(get_db(), batch_size=batch_size, full=full, progress=lambda n: click.echo(f"... {n} document"))
+    click.echo(f"Đã ghi SearchKeys cho {updated} document")
+
+@app.cli.command("normalize-timestamps")
+@click.option("--dry-run", is_flag=True, help="Chỉ đếm số document cần chuyển đổi, không ghi.")
+@click.option("--batch-size", default=1000, show_default=True, help="Số document mỗi lô.")
+@click.option("--restart", is_flag=True, help="Bỏ qua mốc đã lưu và quét lại từ đầu.")
+def normalize_timestamps_command(dry_run, batch_size, restart):
+    """Migration: chuyển Timestamp/CreationTime dạng chuỗi sang BSON date."""
+    report = lambda st: click.echo(f"... đã quét {st['scanned']}, chuyển đổi {st['converted']}, lỗi {st['failed']}")
+    stats = normalize_timestamps(get_db(), dry_run=dry_run, batch_size=batch_size, restart=restart, progress=report)
+    prefix = "[dry-run] " if dry_run else ""
+    click.echo(f"{prefix}Đã quét {stats['scanned']} document, chuyển đổi {stats['converted']}, không parse được {stats['failed']} giá trị")
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Tạo các index cần thiết cho các truy vấn của app."""
+    for name in ensure_indexes(get_db()):
+        click.echo(f"✅ {name}")
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    """Kiểm tra bằng explain() rằng không truy vấn điển hình nào phải quét toàn bộ collection."""
+    failures = check_indexes(get_db())
+    for collection_name, name, stages in failures:
+        click.echo(f"❌ {collection_name} [{name}]: {' -> '.join(stages)}")
+    if failures:
+        raise SystemExit(1)
+    click.echo("✅ Không có truy vấn nào dùng COLLSCAN")
+
+if MONGO_ENSURE_INDEXES and MONGO_URI:
+    with app.app_context():
+        try: ensure_indexes(get_db())
+        except Exception as e: print(f"❌ Lỗi tạo index khi khởi động: {e}")
+
+start_hours_job()
+
 # if __name__ == "__main__":
 #     app.run(host="0.0.0.0", port=5000, debug=False)
 
@@ -0,0 +1,166 @@
+"""
+Đo thời gian xử lý từng request (bật bằng PROFILING_ENABLED=1 trong main.py).
+
+- RequestProfile: bộ đếm của một request, gắn vào ContextVar nên các hàm không nhận request
+  (CommandTimer, step) vẫn ghi được vào đúng request; thread phụ cần chạy qua contextvars.copy_context().
+- CommandTimer: listener command monitoring của pymongo, cộng thời gian MongoDB, số lượt gọi,
+  số lệnh ghi và số document trả về (firstBatch/nextBatch của cursor).
+- step(name): đo một đoạn code ("json": serialize, "excel": ghi workbook); "app" là phần còn lại.
+- MetricsRegistry: histogram thời gian theo route và tổng các bộ đếm, xuất dạng text của Prometheus.
+"""
+import json
+import threading
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MEASURED_STEPS = ("mongo", "json", "excel")
+WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify"}
+
+_current = ContextVar("request_profile", default=None)
+
+class RequestProfile:
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.seconds = dict.fromkeys(MEASURED_STEPS, 0.0)
+        self.roundtrips = self.writes = self.documents = 0
+        self._lock = threading.Lock()  # combined export ghi từ nhiều thread
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.seconds[name] += seconds
+
+    def add_command(self, command_name, seconds, documents):
+        with self._lock:
+            self.seconds["mongo"] += seconds
+            self.roundtrips += 1
+            self.writes += command_name in WRITE_COMMANDS
+            self.documents += documents
+
+    def timings(self):
+        """Thời gian (giây) theo bước; "app" = tổng trừ các bước đã đo (xử lý Python còn lại)."""
+        total = time.perf_counter() - self.started
+        with self._lock:
+            timings = dict(self.seconds)
+        timings["app"] = max(0.0, total - sum(timings.values()))
+        timings["total"] = total
+        return timings
+
+    def server_timing(self):
+        """Giá trị header Server-Timing (ms), hiển thị trong tab Network của trình duyệt."""
+        timings = self.timings()
+        parts = [f'mongo;dur={timings["mongo"] * 1000:.1f};desc="{self.roundtrips} roundtrips, {self.documents} docs"']
+        parts += [f"{name};dur={timings[name] * 1000:.1f}" for name in ("app", "json", "excel") if timings[name]]
+        parts.append(f'total;dur={timings["total"] * 1000:.1f}')
+        return ", ".join(parts)
+
+    def log_line(self, method, path, status):
+        timings = self.timings()
+        return json.dumps({
+            "event": "request", "method": method, "path": path, "route": self.route, "status": status,
+            **{f"{name}_ms": round(value * 1000, 1) for name, value in timings.items()},
+            "mongo_roundtrips": self.roundtrips, "mongo_writes": self.writes, "mongo_documents": self.documents
+        }, ensure_ascii=False)
+
+def start_profile(route):
+    profile = RequestProfile(route)
+    _current.set(profile)
+    return profile
+
+def end_profile():
+    _current.set(None)
+
+@contextmanager
+def step(name):
+    """Cộng thời gian của khối lệnh vào bước name của request hiện tại (không có request đang đo thì bỏ qua)."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+class CommandTimer(monitoring.CommandListener):
+    """Listener gắn vào MongoClient; sự kiện chạy trên thread gửi lệnh nên đọc được ContextVar của request."""
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        profile = _current.get()
+        if profile is None: return
+        cursor = event.reply.get("cursor") if isinstance(event.reply, Mapping) else None
+        documents = len(cursor.get("firstBatch") or cursor.get("nextBatch") or []) if isinstance(cursor, Mapping) else 0
+        profile.add_command(event.command_name, event.duration_micros / 1e6, documents)
+
+    def failed(self, event):
+        profile = _current.get()
+        if profile is not None:
+            profile.add_command(event.command_name, event.duration_micros / 1e6, 0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+class MetricsRegistry:
+    """Histogram thời gian theo route + tổng theo bước/MongoDB, dùng chung trong process (mỗi worker một bản)."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._routes = {}  # route -> {"buckets": [...], "sum", "count", "steps", "roundtrips", "writes", "documents"}
+        self._statuses = {}  # (route, status) -> số request
+        self._lock = threading.Lock()
+
+    def observe(self, profile, status):
+        timings = profile.timings()
+        with self._lock:
+            route = self._routes.setdefault(profile.route, {
+                "buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0,
+                "steps": dict.fromkeys(MEASURED_STEPS + ("app",), 0.0), "roundtrips": 0, "writes": 0, "documents": 0})
+            for index, bound in enumerate(self.buckets):
+                if timings["total"] <= bound: route["buckets"][index] += 1
+            route["sum"] += timings["total"]
+            route["count"] += 1
+            for name in route["steps"]:
+                route["steps"][name] += timings[name]
+            route["roundtrips"] += profile.roundtrips
+            route["writes"] += profile.writes
+            route["documents"] += profile.documents
+            key = (profile.route, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def render(self):
+        """Text exposition format của Prometheus."""
+        with self._lock:
+            routes = {name: {**data, "buckets": list(data["buckets"]), "steps": dict(data["steps"])} for name, data in self._routes.items()}
+            statuses = dict(self._statuses)
+        lines = ["# HELP http_request_duration_seconds Thời gian xử lý request theo route.",
+                 "# TYPE http_request_duration_seconds histogram"]
+        for name, data in sorted(routes.items()):
+            for bound, count in zip(self.buckets, data["buckets"]):
+                lines.append(f"http_request_duration_seconds_bucket{_labels(route=name, le=bound)} {count}")
+            lines.append(f'http_request_duration_seconds_bucket{_labels(route=name, le="+Inf")} {data["count"]}')
+            lines.append(f"http_request_duration_seconds_sum{_labels(route=name)} {data['sum']:.6f}")
+            lines.append(f"http_request_duration_seconds_count{_labels(route=name)} {data['count']}")
+        lines += ["# HELP http_requests_total Số request theo route và mã trạng thái.", "# TYPE http_requests_total counter"]
+        for (name, status), count in sorted(statuses.items()):
+            lines.append(f"http_requests_total{_labels(route=name, status=status)} {count}")
+        lines += ["# HELP http_request_step_seconds_total Tổng thời gian theo bước (mongo, app, json, excel).",
+                  "# TYPE http_request_step_seconds_total counter"]
+        for name, data in sorted(routes.items()):
+            for step_name, seconds in data["steps"].items():
+                lines.append(f"http_request_step_seconds_total{_labels(route=name, step=step_name)} {seconds:.6f}")
+        for metric, field, help_text in (("mongo_roundtrips_total", "roundtrips", "Số lệnh gửi tới MongoDB."),
+                                         ("mongo_writes_total", "writes", "Số lệnh ghi (insert/update/delete)."),
+                                         ("mongo_documents_total", "documents", "Số document MongoDB trả về.")):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f"{metric}{_labels(route=name)} {data[field]}" for name, data in sorted(routes.items())]
+        return "\n".join(lines) + "\n"
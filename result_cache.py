@@ -0,0 +1,138 @@
+"""
+Cache kết quả đã tính (các dòng của file Excel xuất, phiên bản danh sách) theo (dấu vân tay truy vấn, kỳ).
+
+- Khoá gồm tham số truy vấn và mốc dữ liệu (marker, hàm chỉ được gọi khi cache bật) do người gọi truyền vào,
+  ví dụ _id lớn nhất (tăng theo thứ tự ghi): có bản ghi mới thì mốc đổi, khoá cũ không còn được đọc và tự hết hạn.
+- Kỳ đã đóng (closed=True) được giữ lâu (closed_ttl), kỳ đang mở chỉ giữ open_ttl.
+
+Hai backend cùng giao diện get/set trên bytes. Giá trị được ghi dạng Extended JSON (bson.json_util,
+chỉ gồm list/dict/chuỗi/số/ngày như các dòng Excel) thay vì pickle, nên ai ghi được vào Redis cũng
+không chạy được code trong app; người gọi sửa kết quả cũng không làm hỏng bản trong cache.
+- LRUBackend: trong process, giới hạn tổng dung lượng.
+- RedisBackend: Redis (hoặc server tương thích) cục bộ, các worker dùng chung; cần `pip install redis`.
+Số lần hit/miss đếm theo namespace trong từng process.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from bson import json_util
+
+try:
+    import redis  # tuỳ chọn: chỉ cần khi đặt RESULT_CACHE_URL
+except ImportError:
+    redis = None
+
+# Ngày đọc lại dạng naive UTC như pymongo trả về
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS.with_options(tz_aware=False)
+
+class LRUBackend:
+    name = "memory"
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # khoá -> (hết hạn lúc, bytes)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, data, ttl):
+        with self._lock:
+            if key in self._entries: self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, data)
+            self._size += len(data)
+            while self._size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self._size -= len(self._entries.pop(key)[1])
+
+class RedisBackend:
+    name = "redis"
+
+    def __init__(self, url, prefix="result-cache:"):
+        self.client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self.prefix = prefix
+
+    def get(self, key):
+        try: return self.client.get(self.prefix + key)
+        except redis.RedisError as e:
+            print(f"⚠️ Lỗi đọc cache Redis: {e}")
+            return None
+
+    def set(self, key, data, ttl):
+        try: self.client.set(self.prefix + key, data, ex=max(1, int(ttl)))
+        except redis.RedisError as e: print(f"⚠️ Lỗi ghi cache Redis: {e}")
+
+class ResultCache:
+    def __init__(self, backend, closed_ttl, open_ttl, max_entry_bytes):
+        self.backend = backend
+        self.closed_ttl = closed_ttl
+        self.open_ttl = open_ttl
+        self.max_entry_bytes = max_entry_bytes
+        self._stats = {}  # namespace -> {"hits", "misses", "stores", "skipped"}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def _count(self, namespace, field):
+        with self._lock:
+            stats = self._stats.setdefault(namespace, dict.fromkeys(("hits", "misses", "stores", "skipped"), 0))
+            stats[field] += 1
+
+    def get_or_compute(self, namespace, params, compute, closed, marker=None):
+        """Kết quả của compute() cho (namespace, params, marker()); closed chọn TTL dài (kỳ đã đóng) hay ngắn."""
+        if self.backend is None: return compute()
+        key = namespace + ":" + hashlib.sha1(
+            json_util.dumps([params, marker() if marker else None], sort_keys=True).encode()).hexdigest()
+        data = self.backend.get(key)
+        if data is not None:
+            self._count(namespace, "hits")
+            return json_util.loads(data, json_options=JSON_OPTIONS)
+        self._count(namespace, "misses")
+        value = compute()
+        data = json_util.dumps(value, json_options=JSON_OPTIONS).encode()
+        if len(data) <= self.max_entry_bytes:
+            self.backend.set(key, data, self.closed_ttl if closed else self.open_ttl)
+            self._count(namespace, "stores")
+        else:
+            self._count(namespace, "skipped")
+        return value
+
+    def stats(self):
+        with self._lock:
+            namespaces = {name: dict(values) for name, values in self._stats.items()}
+        for values in namespaces.values():
+            lookups = values["hits"] + values["misses"]
+            values["hit_ratio"] = round(values["hits"] / lookups, 3) if lookups else None
+        return {"backend": self.backend.name if self.backend else "off", "namespaces": namespaces}
+
+    def render_metrics(self):
+        """Số hit/miss dạng text của Prometheus (ghép vào /metrics)."""
+        lines = []
+        for metric, field in (("result_cache_hits_total", "hits"), ("result_cache_misses_total", "misses")):
+            lines += [f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{namespace="{name}"}} {values[field]}' for name, values in sorted(self.stats()["namespaces"].items())]
+        return "\n".join(lines) + "\n"
+
+def make_result_cache(url=None, max_bytes=64 * 1024 * 1024, closed_ttl=7 * 24 * 3600, open_ttl=600,
+                      max_entry_bytes=8 * 1024 * 1024):
+    """url (redis://...) -> RedisBackend; không có url -> LRUBackend(max_bytes); max_bytes = 0 -> tắt cache."""
+    if url:
+        if redis is None:
+            print("⚠️ Chưa cài redis (pip install redis): dùng cache trong process")
+        else:
+            return ResultCache(RedisBackend(url), closed_ttl, open_ttl, max_entry_bytes)
+    return ResultCache(LRUBackend(max_bytes) if max_bytes > 0 else None, closed_ttl, open_ttl, max_entry_bytes)